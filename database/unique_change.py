@@ -1,6 +1,7 @@
 import json
 from datetime import UTC, datetime
 
+import sqlalchemy
 from sqlalchemy.orm import Mapped, Session, mapped_column
 from sqlalchemy.types import JSON, BigInteger
 
@@ -41,3 +42,30 @@ class UniqueChange(Base):
             Number of Rows.
         """
         return session.query(UniqueChange).count()
+
+    @staticmethod
+    def get_latest(session: Session, hash_ids: list[int]) -> dict[int, dict]:
+        """
+        Get the most recently crawled change of each hash_id.
+
+        Parameters
+        ----------
+        session: sqlalchemy.orm.Session
+            The session to use for the query.
+
+        hash_ids: list
+            A list of hash_ids to get the changes for.
+
+        Returns
+        -------
+        Dict[int, dict]: A dictionary with the hash_id as key and the change as value.
+        """
+        stmt = (
+            sqlalchemy.select(UniqueChange.hash_id, UniqueChange.change)
+            .where(UniqueChange.hash_id.in_(hash_ids))
+            .order_by(UniqueChange.hash_id, UniqueChange.time_crawled.desc())
+            .distinct(UniqueChange.hash_id)
+        )
+        return {
+            hash_id: json.loads(change) for hash_id, change in session.execute(stmt)
+        }
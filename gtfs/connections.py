@@ -128,6 +128,35 @@ class Connections(Base):
             for r in result
         ]
 
+    @staticmethod
+    def get_columns_for_routing(
+        session: SessionType, from_ts: datetime, to_ts: datetime
+    ) -> list[tuple]:
+        """Fetch the connections departing in [from_ts, to_ts) as plain rows
+        with unix timestamps, ordered by dp_ts. Skips the ORM object construction
+        of get_for_routing, so that the rows can directly be turned into arrays."""
+        stmt = (
+            sqlalchemy.select(
+                sqlalchemy.cast(
+                    sqlalchemy.func.extract('epoch', Connections.dp_ts), BigInteger
+                ),
+                sqlalchemy.cast(
+                    sqlalchemy.func.extract('epoch', Connections.ar_ts), BigInteger
+                ),
+                Connections.dp_stop_id,
+                Connections.ar_stop_id,
+                Connections.trip_id,
+                Connections.is_regio,
+                Connections.dist_traveled,
+                Connections.dp_platform_id,
+                Connections.ar_platform_id,
+            )
+            .where(Connections.dp_ts >= from_ts)
+            .where(Connections.dp_ts < to_ts)
+            .order_by(Connections.dp_ts)
+        )
+        return session.execute(stmt).all()
+
 
 class ConnectionsTemp(Base):
     __tablename__ = 'csa_connections_temp'
@@ -6,6 +6,22 @@ from sqlalchemy.types import BigInteger
 from database.base import Base
 
 
+def is_regional(route_short_name: str) -> bool:
+    train_cat = route_short_name.split(' ')[0]
+    return train_cat not in {
+        'IC',
+        'EC',
+        'ECE',
+        'ICE',
+        'EN',
+        'RJ',
+        'RJX',
+        'TGV',
+        'FLX',
+        'NJ',
+    }
+
+
 class RouteType(enum.Enum):
     TRAM = 0
     UNDERGROUND = 1
@@ -50,16 +66,4 @@ class Routes(Base):
         )
 
     def is_regional(self):
-        train_cat = self.route_short_name.split(' ')[0]
-        return train_cat not in {
-            'IC',
-            'EC',
-            'ECE',
-            'ICE',
-            'EN',
-            'RJ',
-            'RJX',
-            'TGV',
-            'FLX',
-            'NJ',
-        }
+        return is_regional(self.route_short_name)
@@ -2,13 +2,64 @@ import enum
 from collections.abc import Generator
 
 import geopy.distance
+import numpy as np
 import sqlalchemy
+from scipy.spatial import cKDTree
 from sqlalchemy.orm import Mapped, mapped_column
 from sqlalchemy.types import BigInteger
 
 from database.base import Base
 from database.engine import sessionfactory
 
+# Same earth radius as used by geopy.distance.great_circle
+EARTH_RADIUS_M = 6_371_009
+
+
+def haversine_distances(
+    lat: float | np.ndarray, lon: float | np.ndarray, lats: np.ndarray, lons: np.ndarray
+) -> np.ndarray:
+    """Great circle distances in meters from (lat, lon) to each of (lats, lons)
+
+    Parameters
+    ----------
+    lat : float | np.ndarray
+        Latitude in degrees of the point to measure the distances from, or of
+        one point per distance
+    lon : float | np.ndarray
+        Longitude in degrees of the point to measure the distances from, or of
+        one point per distance
+    lats : np.ndarray
+        Latitudes in degrees
+    lons : np.ndarray
+        Longitudes in degrees
+
+    Returns
+    -------
+    np.ndarray
+        Distances in meters
+    """
+    lat = np.radians(lat)
+    lon = np.radians(lon)
+    lats = np.radians(lats)
+    lons = np.radians(lons)
+
+    a = (
+        np.sin((lats - lat) / 2) ** 2
+        + np.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def unit_vectors(lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+    """Points on the unit sphere for latitudes and longitudes in degrees. The
+    euclidean distance between them grows monotonically with the great circle
+    distance, so that they can be indexed by a KD-tree."""
+    lats = np.radians(lats)
+    lons = np.radians(lons)
+    return np.column_stack(
+        (np.cos(lats) * np.cos(lons), np.cos(lats) * np.sin(lons), np.sin(lats))
+    )
+
 
 class LocationType(enum.Enum):
     """
@@ -63,12 +114,29 @@ class Stops(Base):
 class StopSteffen:
     names_to_ids: dict[str, list[int]]
     stops: dict[int, Stops]
+    # Stations sorted by stop_id. The position of a station in these arrays is
+    # its dense station index.
+    station_ids: np.ndarray
+    station_lats: np.ndarray
+    station_lons: np.ndarray
+    station_index: dict[int, int]
+    # Spatial index of the stations by dense station index
+    station_tree: cKDTree
 
     def __init__(self) -> None:
         stops = self._get_stops()
 
         self.stops = {stop.stop_id: stop for stop in stops}
 
+        stations = sorted(self.stations(), key=lambda stop: stop.stop_id)
+        self.station_ids = np.array([stop.stop_id for stop in stations], dtype=np.int64)
+        self.station_lats = np.array([stop.stop_lat for stop in stations])
+        self.station_lons = np.array([stop.stop_lon for stop in stations])
+        self.station_index = {
+            stop_id: index for index, stop_id in enumerate(self.station_ids.tolist())
+        }
+        self.station_tree = cKDTree(unit_vectors(self.station_lats, self.station_lons))
+
         self.names_to_ids = {}
         for stop in self.stations():
             if stop.stop_name not in self.names_to_ids:
@@ -104,3 +172,40 @@ class StopSteffen:
         loc1 = self.get_location(stop_id1)
         loc2 = self.get_location(stop_id2)
         return geopy.distance.great_circle(loc1, loc2).meters
+
+    def get_distances_to(self, stop_id: int) -> np.ndarray:
+        """Distances in meters from every station (by dense station index) to stop_id"""
+        lat, lon = self.get_location(stop_id)
+        return haversine_distances(lat, lon, self.station_lats, self.station_lons)
+
+    def stations_near(
+        self, lat: float, lon: float, radius_m: float
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Stations within radius_m meters of (lat, lon), nearest first
+
+        Parameters
+        ----------
+        lat : float
+            Latitude in degrees
+        lon : float
+            Longitude in degrees
+        radius_m : float
+            Maximal great circle distance in meters
+
+        Returns
+        -------
+        tuple[np.ndarray, np.ndarray]
+            Dense station indices and their distances in meters
+        """
+        # Chord length of the great circle distance on the unit sphere
+        chord = 2 * np.sin(min(radius_m / EARTH_RADIUS_M, np.pi) / 2)
+        indices = np.array(
+            self.station_tree.query_ball_point(unit_vectors(lat, lon)[0], chord),
+            dtype=np.int64,
+        )
+        distances = haversine_distances(
+            lat, lon, self.station_lats[indices], self.station_lons[indices]
+        )
+        order = np.argsort(distances, kind='stable')
+        order = order[distances[order] <= radius_m]
+        return indices[order], distances[order]
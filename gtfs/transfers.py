@@ -1,18 +1,18 @@
 import enum
+import itertools
 from collections import namedtuple
 
-import geopy.distance
+import numpy as np
+import scipy.sparse
 import sqlalchemy
-from shapely import STRtree
-from shapely.geometry import Point
+from scipy.sparse.csgraph import connected_components, dijkstra
 from sqlalchemy.orm import Mapped, mapped_column
 from sqlalchemy.types import BigInteger
-from tqdm import tqdm
 
 from database.base import Base, create_all
 from database.engine import get_engine, sessionfactory
-from database.upsert import upsert_with_retry
-from gtfs.stops import StopSteffen
+from database.upsert_copy_from import tuples_to_csv, upsert_copy_from
+from gtfs.stops import EARTH_RADIUS_M, StopSteffen, haversine_distances
 
 
 class TransferType(enum.Enum):
@@ -61,6 +61,16 @@ class Transfers(Base):
         )
 
 
+class TransfersTemp(Base):
+    __tablename__ = 'gtfs_transfers_temp'
+
+    from_stop_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    to_stop_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    transfer_type: Mapped[TransferType]
+    min_transfer_time: Mapped[int]
+    distance: Mapped[int]
+
+
 def get_transfers() -> dict[int, list[Transfer]]:
     engine, Session = sessionfactory()
 
@@ -87,37 +97,142 @@ def get_transfers() -> dict[int, list[Transfer]]:
 WALKING_SPEED_M_S = 1.0
 MAX_WALKING_TIME_S = 30 * 60
 MAX_WALKING_DISTANCE_M = WALKING_SPEED_M_S * MAX_WALKING_TIME_S
-MAX_DEGREE_DISTANCE_SEARCH_SPACE = 0.5
+# Maximal size of the distance matrices computed at once for the closure
+MAX_CLOSURE_CHUNK_CELLS = 2**24
+
+
+def calculate_walking_distances(
+    stop_steffen: StopSteffen,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Pairs of stations closer than MAX_WALKING_DISTANCE_M, in both
+    directions
+
+    Parameters
+    ----------
+    stop_steffen : StopSteffen
+        Stations to walk between
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray, np.ndarray]
+        Dense station indices to walk from and to and the great circle
+        distances between them in meters
+    """
+    # Chord length of the walking distance on the unit sphere of station_tree
+    chord = 2 * np.sin(MAX_WALKING_DISTANCE_M / EARTH_RADIUS_M / 2)
+    pairs = stop_steffen.station_tree.query_pairs(chord, output_type='ndarray')
+    distances = haversine_distances(
+        stop_steffen.station_lats[pairs[:, 0]],
+        stop_steffen.station_lons[pairs[:, 0]],
+        stop_steffen.station_lats[pairs[:, 1]],
+        stop_steffen.station_lons[pairs[:, 1]],
+    )
+    walkable = distances < MAX_WALKING_DISTANCE_M
+    pairs = pairs[walkable]
+    distances = distances[walkable]
+    return (
+        np.concatenate((pairs[:, 0], pairs[:, 1])),
+        np.concatenate((pairs[:, 1], pairs[:, 0])),
+        np.concatenate((distances, distances)),
+    )
+
 
+def transitive_closure(
+    n_stations: int,
+    from_stations: np.ndarray,
+    to_stations: np.ndarray,
+    distances: np.ndarray,
+    limit: float = MAX_WALKING_DISTANCE_M,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Shortest walks up to limit between all stations that are connected by
+    walks. The connection scan only walks once between two trips, so it needs
+    a walk between every pair of stations it could reach by walking several
+    times. Without a limit, dense clusters of stations would get walks
+    between all of their stations, tens of kilometres long.
 
-def calculate_transfers_from_stops(stop_dicts):
-    s_index = STRtree(
-        [Point(stop['stop_lon'], stop['stop_lat']) for stop in stop_dicts]
+    Parameters
+    ----------
+    n_stations : int
+        Number of dense station indices
+    from_stations : np.ndarray
+        Dense station indices of the walks
+    to_stations : np.ndarray
+        Dense station indices the walks lead to
+    distances : np.ndarray
+        Distances of the walks in meters
+    limit : float, optional
+        Longest walk to add in meters, by default MAX_WALKING_DISTANCE_M
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray, np.ndarray]
+        Dense station indices to walk from and to and the distances of the
+        shortest walks between them in meters
+    """
+    graph = scipy.sparse.csr_matrix(
+        (distances, (from_stations, to_stations)), shape=(n_stations, n_stations)
+    )
+    _, components = connected_components(graph, directed=False)
+
+    # Stations and walks by component, with the stations numbered within their
+    # component
+    stations = np.argsort(components, kind='stable')
+    component_sizes = np.bincount(components)
+    component_starts = np.concatenate(([0], np.cumsum(component_sizes)))
+    local_index = np.empty(n_stations, dtype=np.int64)
+    local_index[stations] = (
+        np.arange(n_stations) - component_starts[components[stations]]
     )
-    for stop1 in tqdm(stop_dicts):
-        bbox = Point(stop1['stop_lon'], stop1['stop_lat']).buffer(
-            MAX_DEGREE_DISTANCE_SEARCH_SPACE
+    walks = np.argsort(components[from_stations], kind='stable')
+    walk_starts = np.searchsorted(
+        components[from_stations][walks], np.arange(len(component_sizes) + 1)
+    )
+
+    closed_from, closed_to, closed_distances = [], [], []
+    for component in np.nonzero(component_sizes > 1)[0]:
+        size = component_sizes[component]
+        members = stations[
+            component_starts[component] : component_starts[component + 1]
+        ]
+        component_walks = walks[walk_starts[component] : walk_starts[component + 1]]
+        subgraph = scipy.sparse.csr_matrix(
+            (
+                distances[component_walks],
+                (
+                    local_index[from_stations[component_walks]],
+                    local_index[to_stations[component_walks]],
+                ),
+            ),
+            shape=(size, size),
         )
-        nearby_stops_indices = s_index.query(bbox)
-        for i in nearby_stops_indices:
-            stop2 = stop_dicts[i]
-            if stop1['stop_id'] == stop2['stop_id']:
-                continue
-            distance = geopy.distance.great_circle(
-                (stop1['stop_lat'], stop1['stop_lon']),
-                (stop2['stop_lat'], stop2['stop_lon']),
-            ).meters
-            if distance < MAX_WALKING_DISTANCE_M:
-                yield Transfers(
-                    from_stop_id=stop1['stop_id'],
-                    to_stop_id=stop2['stop_id'],
-                    transfer_type=TransferType.RECOMMENDED,
-                    min_transfer_time=distance / WALKING_SPEED_M_S,
-                    distance=distance,
-                ).as_tuple()
-
-
-def calculate_transfers():
+        chunk_size = max(1, MAX_CLOSURE_CHUNK_CELLS // size)
+        for start in range(0, size, chunk_size):
+            sources = np.arange(start, min(start + chunk_size, size))
+            shortest = dijkstra(subgraph, indices=sources, limit=limit)
+            rows, columns = np.nonzero(np.isfinite(shortest))
+            is_walk = sources[rows] != columns
+            rows, columns = rows[is_walk], columns[is_walk]
+            closed_from.append(members[sources[rows]])
+            closed_to.append(members[columns])
+            closed_distances.append(shortest[rows, columns])
+
+    if not closed_from:
+        return from_stations, to_stations, distances
+    return (
+        np.concatenate(closed_from),
+        np.concatenate(closed_to),
+        np.concatenate(closed_distances),
+    )
+
+
+def calculate_transfers(closure: bool = False):
+    """Recompute all transfers between stations from their coordinates
+
+    Parameters
+    ----------
+    closure : bool, optional
+        Whether to add the transitive closure of the walks, by default False
+    """
     engine = get_engine()
 
     # Drop and recreate
@@ -126,11 +241,30 @@ def calculate_transfers():
     create_all(engine)
 
     stop_steffen = StopSteffen()
+    from_stations, to_stations, distances = calculate_walking_distances(stop_steffen)
+    if closure:
+        from_stations, to_stations, distances = transitive_closure(
+            len(stop_steffen.station_ids),
+            from_stations,
+            to_stations,
+            distances,
+            limit=MAX_WALKING_DISTANCE_M,
+        )
 
-    stop_dicts = [stop.as_dict() for stop in stop_steffen.stations()]
-    transfers = list(calculate_transfers_from_stops(stop_dicts))
-
-    upsert_with_retry(engine, Transfers.__table__, transfers)
+    # Same rounding as postgres when casting to integer
+    transfers = zip(
+        stop_steffen.station_ids[from_stations].tolist(),
+        stop_steffen.station_ids[to_stations].tolist(),
+        itertools.repeat(TransferType.RECOMMENDED.name),
+        np.rint(distances / WALKING_SPEED_M_S).astype(np.int64).tolist(),
+        np.rint(distances).astype(np.int64).tolist(),
+    )
+    upsert_copy_from(
+        table=Transfers.__table__,
+        temp_table=TransfersTemp.__table__,
+        csv=tuples_to_csv(list(transfers)),
+        engine=engine,
+    )
 
 
 if __name__ == '__main__':
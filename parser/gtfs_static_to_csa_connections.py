@@ -14,6 +14,12 @@ from gtfs.routes import Routes
 from gtfs.stop_times import StopTimes
 from gtfs.stops import StopSteffen
 from gtfs.trips import Trips
+from router.timetable import (
+    SNAPSHOT_RETENTION_DAYS,
+    affected_timetable_dates,
+    prune_snapshots,
+    write_snapshots,
+)
 
 
 def date_range(start_date: date, end_date: date):
@@ -98,10 +104,28 @@ def parse_connections():
     start_date = date(2024, 1, 1)
     end_date = date.today() + timedelta(days=1)
 
+    # Each service date affects the timetables of its neighbours, too
+    snapshot_dates = set()
     for service_date in tqdm(
         date_range(start_date, end_date), total=(end_date - start_date).days
     ):
         to_csa_connections(service_date, stop_steffen, engine, Session)
+        snapshot_dates.update(affected_timetable_dates(service_date))
+
+    # Rewrite the memory mapped timetables used by the router, once all
+    # connections they contain are parsed. Only the timetables that can still
+    # be searched are written, the snapshots of older ones are deleted.
+    first_snapshot_date = date.today() - timedelta(days=SNAPSHOT_RETENTION_DAYS)
+    with Session() as session:
+        write_snapshots(
+            session,
+            sorted(
+                snapshot_date
+                for snapshot_date in snapshot_dates
+                if snapshot_date >= first_snapshot_date
+            ),
+        )
+    prune_snapshots(first_snapshot_date)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,70 @@
+import time
+from datetime import datetime
+
+from database.engine import sessionfactory
+from router.benchmark_pareto import SEARCHES
+from router.router_csa import Pruning, RouterCSA, ScanStats
+
+
+def run_searches(
+    pruning: Pruning,
+    searches: list[tuple[str, str, datetime]],
+    session,
+) -> list[tuple[ScanStats, float, list | str]]:
+    """Route the searches with the pruning and return the scan statistics, the
+    duration and the result of each search"""
+    router = RouterCSA(pruning=pruning)
+    if router.pruning != pruning:
+        raise ValueError(f'{pruning} is not available, compute the landmarks first')
+
+    runs = []
+    for origin, destination, dp_ts in searches:
+        router.stats = ScanStats()
+        start = time.perf_counter()
+        try:
+            result = router.do_routing(origin, destination, dp_ts, session)
+        except Exception as e:
+            result = repr(e)
+        runs.append((router.stats, time.perf_counter() - start, result))
+    return runs
+
+
+def benchmark(searches: list[tuple[str, str, datetime]], session):
+    """Compare the connections scanned by the main and alternative searches
+    with each kind of pruning"""
+    runs = {pruning: run_searches(pruning, searches, session) for pruning in Pruning}
+    reference = runs[Pruning.DISTANCE]
+
+    for i, (origin, destination, dp_ts) in enumerate(searches):
+        print(f'{origin} -> {destination} at {dp_ts}:')
+        for pruning, pruning_runs in runs.items():
+            stats, duration, result = pruning_runs[i]
+            print(
+                f'{pruning.value:>24}:',
+                f'{stats.scanned_connections:9d} scanned',
+                f'{stats.pruned_connections:9d} pruned',
+                f'{duration * 1000:8.0f} ms',
+                'same result' if result == reference[i][2] else 'different result',
+            )
+
+    print('Total:')
+    for pruning, pruning_runs in runs.items():
+        scanned = sum(stats.scanned_connections for stats, _, _ in pruning_runs)
+        pruned = sum(stats.pruned_connections for stats, _, _ in pruning_runs)
+        duration = sum(duration for _, duration, _ in pruning_runs)
+        print(
+            f'{pruning.value:>24}:',
+            f'{scanned:9d} scanned',
+            f'{pruned:9d} pruned',
+            f'{duration * 1000:8.0f} ms',
+        )
+
+
+def main():
+    engine, Session = sessionfactory()
+    with Session() as session:
+        benchmark(SEARCHES, session)
+
+
+if __name__ == '__main__':
+    main()
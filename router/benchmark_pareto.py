@@ -0,0 +1,148 @@
+import os
+import pickle
+import time
+from collections import defaultdict
+from datetime import datetime
+
+from config import CACHE_PATH
+from database.engine import sessionfactory
+from router.datatypes import Reachability
+from router.labels import LabelContainers
+from router.pareto import ParetoBag, add_reachability_to_pareto
+
+RECORDING_PATH = CACHE_PATH + '/pareto_recording.pickle'
+
+SEARCHES = [
+    ('Berlin Hbf', 'Augsburg Hbf', datetime(2024, 2, 27, 13, 0, 0)),
+    ('Hamburg Hbf', 'München Hbf', datetime(2024, 2, 27, 8, 0, 0)),
+    ('Köln Hbf', 'Dresden Hbf', datetime(2024, 2, 27, 17, 0, 0)),
+    ('Tübingen Hbf', 'Stuttgart Hbf', datetime(2024, 2, 27, 7, 30, 0)),
+]
+
+
+def record_searches(
+    searches: list[tuple[str, str, datetime]],
+) -> list[tuple[bool, list[tuple]]]:
+    """Route the searches and record the sequence of reachabilities added to each
+    Pareto bag. Returns a list of (is_alternative, reachabilities) per bag, with
+    the reachabilities as tuples of their fields."""
+    from router.router_csa import RouterCSA
+
+    recording = defaultdict(list)
+    # Bags are reused between the CSA runs of a routing request, so the runs
+    # are told apart by counting the resets of the label containers.
+    search_number = 0
+
+    def counting_reset(labels: LabelContainers):
+        nonlocal search_number
+        search_number += 1
+        reset(labels)
+
+    def recorder(add, is_alternative):
+        def recording_add(bag: ParetoBag, reachability: Reachability) -> bool:
+            recording[search_number, id(bag), is_alternative].append(
+                tuple(getattr(reachability, field) for field in Reachability.__slots__)
+            )
+            return add(bag, reachability)
+
+        return recording_add
+
+    add, add_alternative = ParetoBag.add, ParetoBag.add_alternative
+    reset = LabelContainers.reset
+    ParetoBag.add = recorder(add, is_alternative=False)
+    ParetoBag.add_alternative = recorder(add_alternative, is_alternative=True)
+    LabelContainers.reset = counting_reset
+    try:
+        engine, Session = sessionfactory()
+        router = RouterCSA()
+        with Session() as session:
+            for origin, destination, dp_ts in searches:
+                router.do_routing(origin, destination, dp_ts, session)
+                search_number += 1
+    finally:
+        ParetoBag.add, ParetoBag.add_alternative = add, add_alternative
+        LabelContainers.reset = reset
+
+    return [
+        (is_alternative, reachabilities)
+        for (_, _, is_alternative), reachabilities in recording.items()
+    ]
+
+
+def to_reachability(fields: tuple) -> Reachability:
+    reachability = Reachability()
+    for field, value in zip(Reachability.__slots__, fields):
+        setattr(reachability, field, value)
+    return reachability
+
+
+def replay_reference(recording: list[tuple[bool, list[Reachability]]]) -> list[list]:
+    results = []
+    for is_alternative, reachabilities in recording:
+        pareto_set = []
+        for reachability in reachabilities:
+            pareto_set, _ = add_reachability_to_pareto(
+                reachability, pareto_set, is_alternative
+            )
+        results.append(pareto_set)
+    return results
+
+
+def replay_bags(recording: list[tuple[bool, list[Reachability]]]) -> list[list]:
+    results = []
+    for is_alternative, reachabilities in recording:
+        bag = ParetoBag()
+        add = bag.add_alternative if is_alternative else bag.add
+        for reachability in reachabilities:
+            add(reachability)
+        results.append(bag)
+    return results
+
+
+def benchmark(recording: list[tuple[bool, list[tuple]]], repeat: int = 5):
+    recording = [
+        (is_alternative, [to_reachability(fields) for fields in reachabilities])
+        for is_alternative, reachabilities in recording
+    ]
+    for is_alternative in (False, True):
+        part = [bag for bag in recording if bag[0] == is_alternative]
+        n_adds = sum(len(reachabilities) for _, reachabilities in part)
+
+        reference = [list(bag) for bag in replay_reference(part)]
+        bags = [list(bag) for bag in replay_bags(part)]
+        if reference != bags:
+            raise AssertionError('ParetoBag differs from the reference implementation')
+
+        print(
+            f'{"alternative" if is_alternative else "normal"} criteria:',
+            f'{len(part)} bags, {n_adds} adds',
+        )
+        for name, replay in (
+            ('reference', replay_reference),
+            ('ParetoBag', replay_bags),
+        ):
+            timings = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                replay(part)
+                timings.append(time.perf_counter() - start)
+            print(
+                f'{name:>12}: {min(timings) * 1000:8.1f} ms',
+                f'({min(timings) / max(n_adds, 1) * 1e9:6.0f} ns per add)',
+            )
+
+
+def main():
+    if os.path.isfile(RECORDING_PATH):
+        with open(RECORDING_PATH, 'rb') as f:
+            recording = pickle.load(f)
+    else:
+        recording = record_searches(SEARCHES)
+        with open(RECORDING_PATH, 'wb') as f:
+            pickle.dump(recording, f)
+
+    benchmark(recording)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,333 @@
+import time
+from datetime import date, datetime
+
+import numpy as np
+from sqlalchemy.orm import Session as SessionType
+
+from database.engine import sessionfactory
+from router.benchmark_pareto import SEARCHES
+from router.constants import FIRST_TRIP_INDEX, STANDART_SEARCH_WINDOW_HOURS
+from router.datatypes import StopEventChange
+from router.exceptions import NoRouteFound
+from router.router_csa import RouterCSA
+from router.timetable import CANCELLED_TS, SNAPSHOT_COLUMNS, Timetable, TimetableStore
+
+N_BATCHES = 10
+N_TRIPS_PER_BATCH = 500
+CANCEL_PROBABILITY = 0.1
+# Probability that a cancelled event of an earlier batch runs again
+RESTORE_PROBABILITY = 0.3
+DELAYS = (-60, 0, 60, 300, 1200, 3600)
+
+COLUMNS = [name for name, _ in SNAPSHOT_COLUMNS] + ['dp_stop', 'ar_stop', 'trip']
+
+
+class FixedTimetableStore(TimetableStore):
+    """The timetables of a store, with the given ones in place of its own"""
+
+    def __init__(self, store: TimetableStore, timetables: dict[date, Timetable]):
+        super().__init__(store.station_ids, store.max_size, store.snapshot_dir)
+        self.store = store
+        self.fixed = timetables
+
+    def get(self, session: SessionType, service_date: date) -> Timetable:
+        if service_date in self.fixed:
+            return self.fixed[service_date]
+        return self.store.get(session, service_date)
+
+    def prefetch(self, service_date: date):
+        pass
+
+
+def random_changes(
+    planned: Timetable, rng: np.random.Generator, n_trips: int
+) -> list[StopEventChange]:
+    """Changes of all events of random trips, as the crawler reports them: a
+    delay per trip that varies by a minute per stop, and cancellations of the
+    rest of some trips"""
+    changes = []
+    trips = rng.choice(
+        np.arange(FIRST_TRIP_INDEX, planned.n_trips), n_trips, replace=False
+    )
+    for trip in trips.tolist():
+        positions = planned.trip_rows(trip).tolist()
+        trip_id = planned.external_trip_id(trip)
+        delay = int(rng.choice(DELAYS))
+        cancelled_from = len(positions)
+        if rng.random() < CANCEL_PROBABILITY:
+            cancelled_from = int(rng.integers(len(positions)))
+        for i, position in enumerate(positions):
+            dp_ts = int(planned.dp_ts[position])
+            ar_ts = int(planned.ar_ts[position])
+            stop_delay = delay + int(rng.choice((-60, 0, 0, 60)))
+            cancelled = i >= cancelled_from
+            changes.append(
+                StopEventChange(
+                    trip_id=trip_id,
+                    stop_id=int(planned.dp_stop_id[position]),
+                    planned_ar_ts=None,
+                    planned_dp_ts=dp_ts,
+                    ar_ts=None,
+                    dp_ts=CANCELLED_TS if cancelled else dp_ts + stop_delay,
+                )
+            )
+            changes.append(
+                StopEventChange(
+                    trip_id=trip_id,
+                    stop_id=int(planned.ar_stop_id[position]),
+                    planned_ar_ts=ar_ts,
+                    planned_dp_ts=None,
+                    ar_ts=CANCELLED_TS if cancelled else ar_ts + stop_delay,
+                    dp_ts=None,
+                )
+            )
+    return changes
+
+
+def restored_changes(
+    changes: dict[tuple, StopEventChange], rng: np.random.Generator
+) -> list[StopEventChange]:
+    """Changes of some of the cancelled events that run again after all"""
+    return [
+        change._replace(
+            ar_ts=None if change.ar_ts is None else change.planned_ar_ts + 120,
+            dp_ts=None if change.dp_ts is None else change.planned_dp_ts + 120,
+        )
+        for change in changes.values()
+        if CANCELLED_TS in (change.ar_ts, change.dp_ts)
+        and rng.random() < RESTORE_PROBABILITY
+    ]
+
+
+def trip_changes(
+    planned: Timetable, trips: np.ndarray, cancelled: bool
+) -> list[StopEventChange]:
+    """Changes cancelling all events of the trips, or letting them run at their
+    planned times"""
+    changes = []
+    for trip in trips.tolist():
+        trip_id = planned.external_trip_id(trip)
+        for position in planned.trip_rows(trip).tolist():
+            dp_ts = int(planned.dp_ts[position])
+            ar_ts = int(planned.ar_ts[position])
+            changes.append(
+                StopEventChange(
+                    trip_id=trip_id,
+                    stop_id=int(planned.dp_stop_id[position]),
+                    planned_ar_ts=None,
+                    planned_dp_ts=dp_ts,
+                    ar_ts=None,
+                    dp_ts=CANCELLED_TS if cancelled else dp_ts,
+                )
+            )
+            changes.append(
+                StopEventChange(
+                    trip_id=trip_id,
+                    stop_id=int(planned.ar_stop_id[position]),
+                    planned_ar_ts=ar_ts,
+                    planned_dp_ts=None,
+                    ar_ts=CANCELLED_TS if cancelled else ar_ts,
+                    dp_ts=None,
+                )
+            )
+    return changes
+
+
+def rebuild(planned: Timetable, changes: dict[tuple, StopEventChange]) -> Timetable:
+    """Timetable built from scratch from the planned connections with the
+    real-time times of the changes, ordered like a timetable with real-time
+    changes: connections of changed trips come after the planned ones
+    departing at the same time"""
+    dp_events = {}
+    ar_events = {}
+    for change in changes.values():
+        if change.dp_ts is not None:
+            dp_events[change.trip_id, change.stop_id, change.planned_dp_ts] = (
+                change.dp_ts
+            )
+        if change.ar_ts is not None:
+            ar_events[change.trip_id, change.stop_id, change.planned_ar_ts] = (
+                change.ar_ts
+            )
+
+    rows = list(zip(*(getattr(planned, name).tolist() for name, _ in SNAPSHOT_COLUMNS)))
+    changed_trips = {
+        trip_id
+        for dp_ts, ar_ts, dp_stop_id, ar_stop_id, trip_id, *_ in rows
+        if (trip_id, dp_stop_id, dp_ts) in dp_events
+        or (trip_id, ar_stop_id, ar_ts) in ar_events
+    }
+    keyed_rows = []
+    for position, row in enumerate(rows):
+        dp_ts, ar_ts, dp_stop_id, ar_stop_id, trip_id, *rest = row
+        changed = trip_id in changed_trips
+        if changed:
+            dp_ts = dp_events.get((trip_id, dp_stop_id, dp_ts), dp_ts)
+            ar_ts = ar_events.get((trip_id, ar_stop_id, ar_ts), ar_ts)
+            if CANCELLED_TS in (dp_ts, ar_ts):
+                dp_ts = ar_ts = CANCELLED_TS
+            else:
+                ar_ts = max(ar_ts, dp_ts)
+        keyed_rows.append(
+            (
+                (dp_ts, changed, position),
+                (dp_ts, ar_ts, dp_stop_id, ar_stop_id, trip_id, *rest),
+            )
+        )
+    keyed_rows.sort()
+
+    timetable = Timetable.from_rows(
+        planned.service_date, [row for _, row in keyed_rows], version=planned.version
+    )
+    timetable.build_index(planned.station_ids)
+    if not np.array_equal(timetable.trip_ids, planned.trip_ids):
+        raise AssertionError('Rebuilt timetable has other trips')
+    timetable.routes = planned.routes
+    timetable.trip_route = planned.trip_route
+    timetable.trip_route_type = planned.trip_route_type
+    timetable.trip_agency = planned.trip_agency
+    timetable.agencies = planned.agencies
+    return timetable
+
+
+def check_timetable(timetable: Timetable, reference: Timetable):
+    """Check that the timetable is sorted by dp_ts, that its per-trip index
+    matches its connections and that it has the connections of the reference
+    in the same order"""
+    columns = dict(zip(COLUMNS, timetable.columns(0, len(timetable), *COLUMNS)))
+    if np.any(np.diff(columns['dp_ts']) < 0):
+        raise AssertionError('Timetable is not sorted by dp_ts')
+
+    trip_positions = np.argsort(columns['trip'], kind='stable')
+    trip_offsets = np.zeros(timetable.n_trips + 1, dtype=np.int64)
+    np.cumsum(
+        np.bincount(columns['trip'], minlength=timetable.n_trips),
+        out=trip_offsets[1:],
+    )
+    for trip in range(FIRST_TRIP_INDEX, timetable.n_trips):
+        if not np.array_equal(
+            timetable.trip_rows(trip),
+            trip_positions[trip_offsets[trip] : trip_offsets[trip + 1]],
+        ):
+            raise AssertionError(f'Per-trip index of trip {trip} is inconsistent')
+
+    if len(timetable) != len(reference):
+        raise AssertionError('Timetable differs from the rebuilt one')
+    for name, column in columns.items():
+        if not np.array_equal(column, getattr(reference, name)):
+            raise AssertionError(f'{name} differs from the rebuilt timetable')
+
+
+def route(
+    searches: list[tuple[str, str, datetime]],
+    router: RouterCSA,
+    store: TimetableStore,
+    session: SessionType,
+    timetable: Timetable,
+    clear_cache: bool = True,
+) -> list[str | None]:
+    """FPTF JSON of the searches departing and arriving at their times, on the
+    timetable and the other timetables of the store. None if no route is
+    found."""
+    router.timetables = FixedTimetableStore(store, {timetable.service_date: timetable})
+    if clear_cache:
+        router.results.clear()
+    results = []
+    for origin, destination, dp_ts in searches:
+        for search_for_arrival in (False, True):
+            try:
+                results.append(
+                    router.do_routing(
+                        origin,
+                        destination,
+                        dp_ts,
+                        session,
+                        search_for_arrival=search_for_arrival,
+                    )
+                )
+            except NoRouteFound:
+                results.append(None)
+    return results
+
+
+def check_restored_trips(
+    search: tuple[str, str, datetime],
+    router: RouterCSA,
+    store: TimetableStore,
+    session: SessionType,
+    planned: Timetable,
+):
+    """Check that a cached result is dropped once trips it does not ride run
+    again: cancel the trips departing at the origin of the search, route, let
+    them run again and route once more without clearing the cache"""
+    origin, _, dp_ts = search
+    from_ts = int(dp_ts.timestamp())
+    start_index, end_index = planned.window(
+        from_ts, from_ts + STANDART_SEARCH_WINDOW_HOURS * 60 * 60
+    )
+    dp_stop, trip = planned.columns(start_index, end_index, 'dp_stop', 'trip')
+    trips = np.unique(trip[dp_stop == router.stop_index(origin)])
+    if not len(trips):
+        return
+    cancelled = planned.with_changes(trip_changes(planned, trips, cancelled=True))
+    restored = cancelled.with_changes(trip_changes(planned, trips, cancelled=False))
+
+    route([search], router, store, session, cancelled)
+    cached = route([search], router, store, session, restored, clear_cache=False)
+    if cached != route([search], router, store, session, restored):
+        raise AssertionError(f'Cached result of {search} outlived restored trips')
+
+
+def benchmark(searches: list[tuple[str, str, datetime]], session: SessionType):
+    """Apply batches of random real-time changes to the timetable of the date
+    of the searches. After each batch, check that the timetable stays sorted,
+    that its per-trip index is consistent and that it routes the searches
+    like a timetable rebuilt from the changed connections, with and without
+    the results cached before the batch."""
+    router = RouterCSA()
+    store = router.timetables
+    planned = store.get(session, searches[0][2].date())
+    rng = np.random.default_rng(0)
+    # Latest change of each stop event, like TimetableStore.changes
+    changes: dict[tuple, StopEventChange] = {}
+    for search in searches:
+        check_restored_trips(search, router, store, session, planned)
+
+    timetable = planned
+    for batch in range(N_BATCHES):
+        batch_changes = random_changes(planned, rng, N_TRIPS_PER_BATCH)
+        batch_changes += restored_changes(changes, rng)
+        for change in batch_changes:
+            changes[change[:4]] = change
+
+        start = time.perf_counter()
+        timetable = timetable.with_changes(batch_changes)
+        apply_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        reference = rebuild(planned, changes)
+        rebuild_seconds = time.perf_counter() - start
+
+        check_timetable(timetable, reference)
+        # The cache still holds the results of the previous batch
+        cached = route(searches, router, store, session, timetable, clear_cache=False)
+        expected = route(searches, router, store, session, reference)
+        if route(searches, router, store, session, timetable) != expected:
+            raise AssertionError('Routing differs from the rebuilt timetable')
+        if cached != expected:
+            raise AssertionError('Cached results outlived the changes')
+        print(
+            f'batch {batch:2d}: {len(batch_changes):6d} changes,',
+            f'applied in {apply_seconds * 1000:7.1f} ms,',
+            f'rebuilt in {rebuild_seconds * 1000:7.1f} ms,',
+            f'{len(timetable.overlay):7d} connections of changed trips',
+        )
+
+
+def main():
+    engine, Session = sessionfactory()
+    with Session() as session:
+        benchmark(SEARCHES, session)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,336 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import date, datetime
+
+import numpy as np
+import sqlalchemy
+from sqlalchemy.dialects.postgresql import JSON
+from sqlalchemy.orm import Session as SessionType
+
+import router.router_csa as router_csa
+from config import CACHE_PATH
+from database.engine import sessionfactory
+from helpers.logger import logging
+from router.datatypes import ConnectionFilter, Location
+from router.exceptions import NoTimetableFound
+from router.router_csa import RouterCSA, arrival_service_date
+from router.timetable import Timetable, TimetableStore, snapshot_path
+
+BENCHMARK_DIR = CACHE_PATH + '/benchmark'
+QUERIES_PATH = BENCHMARK_DIR + '/queries.json'
+# Timetables of the benchmark, written once when the queries are recorded
+BENCHMARK_SNAPSHOT_DIR = BENCHMARK_DIR + '/timetables'
+N_BENCHMARK_QUERIES = 200
+
+PHASES = ('search', 'alternatives', 'reconstruction', 'fptf')
+PERCENTILES = (50, 95, 99)
+
+# Searches logged by the website, see webserver.db_logger.LogEntry
+connect_log = sqlalchemy.table(
+    'website_connect_log',
+    sqlalchemy.column('id'),
+    sqlalchemy.column('page'),
+    sqlalchemy.column('request_data', JSON),
+)
+
+
+def parse_search(page: str, request_data: dict) -> dict | None:
+    """Query of a search logged by /api/journeys or /api/trip, with the time of
+    day instead of the date. None if the request is not a search."""
+    try:
+        if page == '/api/journeys':
+            origin = request_data['origin']
+            destination = request_data['destination']
+            dp_ts = datetime.fromisoformat(request_data['departure'])
+        elif page == '/api/trip':
+            origin = request_data['start']
+            destination = request_data['destination']
+            dp_ts = datetime.strptime(request_data['date'], '%d.%m.%Y %H:%M')
+        else:
+            return None
+    except (KeyError, TypeError, ValueError):
+        return None
+    return {
+        'origin': origin,
+        'destination': destination,
+        'time': dp_ts.strftime('%H:%M'),
+        'search_for_arrival': bool(request_data.get('search_for_arrival', False)),
+        'only_regional': bool(request_data.get('only_regional', False)),
+    }
+
+
+def get_logged_searches(
+    session: SessionType, station_names: set[str], n_queries: int
+) -> list[dict]:
+    """The latest distinct searches of the website between known stations or
+    locations"""
+    stmt = (
+        sqlalchemy.select(connect_log.c.page, connect_log.c.request_data)
+        .where(connect_log.c.page.in_(['/api/journeys', '/api/trip']))
+        .order_by(connect_log.c.id.desc())
+    )
+    queries = []
+    seen = set()
+    for page, request_data in session.execute(stmt).yield_per(1000):
+        query = parse_search(page, request_data or {})
+        if query is None or any(
+            isinstance(place, str) and place not in station_names
+            for place in (query['origin'], query['destination'])
+        ):
+            continue
+        key = json.dumps(query, sort_keys=True)
+        if key in seen:
+            continue
+        seen.add(key)
+        queries.append(query)
+        if len(queries) == n_queries:
+            break
+    return queries
+
+
+def query_dp_ts(service_date: date, query: dict) -> datetime:
+    return datetime.combine(
+        service_date, datetime.strptime(query['time'], '%H:%M').time()
+    )
+
+
+def query_place(place: str | dict) -> str | Location:
+    if isinstance(place, dict):
+        return Location(lat=float(place['lat']), lon=float(place['lon']))
+    return place
+
+
+def timetable_dates(service_date: date, queries: list[dict]) -> set[date]:
+    """Service dates of the timetables the queries on service_date need"""
+    return {service_date} | {
+        arrival_service_date(query_dp_ts(service_date, query))
+        for query in queries
+        if query['search_for_arrival']
+    }
+
+
+def record_queries(router: RouterCSA, session: SessionType, service_date: date):
+    """Save the latest searches of the website as the benchmark queries on
+    service_date, together with the snapshots of the timetables they need.
+    Later runs replay the same queries on the same timetables."""
+    queries = get_logged_searches(
+        session, set(router.stop_steffen.names_to_ids), N_BENCHMARK_QUERIES
+    )
+    for snapshot_date in timetable_dates(service_date, queries):
+        Timetable.from_db(session, snapshot_date).to_snapshot(
+            snapshot_path(snapshot_date, BENCHMARK_SNAPSHOT_DIR)
+        )
+    with open(QUERIES_PATH, 'w') as f:
+        json.dump(
+            {'service_date': service_date.isoformat(), 'queries': queries},
+            f,
+            indent=1,
+        )
+    logging.info(f'Recorded {len(queries)} benchmark queries on {service_date}')
+
+
+class BenchmarkTimetableStore(TimetableStore):
+    """Only the timetables of the benchmark snapshots. Nothing is prefetched,
+    so that no background loading disturbs the measurements."""
+
+    def load(self, session, service_date, path, mtime) -> Timetable:
+        if mtime is None:
+            raise NoTimetableFound(f'No benchmark timetable for {service_date}')
+        return super().load(session, service_date, path, mtime)
+
+    def prefetch(self, service_date: date):
+        pass
+
+
+@dataclass
+class PhaseStats:
+    seconds: float = 0.0
+    scanned_connections: int = 0
+    created_labels: int = 0
+    # Number of journeys in the Pareto set at the destination, per scan
+    pareto_sizes: list[int] = field(default_factory=list)
+
+
+class PhaseRecorder:
+    """Statistics of the phases of a routing request. The time of a phase does
+    not include the phases nested in it, so the times add up to the duration
+    of the request."""
+
+    def __init__(self):
+        self.phases = {phase: PhaseStats() for phase in PHASES}
+        self.stack: list[str] = []
+        self.started = 0.0
+
+    @property
+    def current(self) -> PhaseStats:
+        return self.phases[self.stack[-1]]
+
+    @contextmanager
+    def phase(self, name: str):
+        now = time.perf_counter()
+        if self.stack:
+            self.current.seconds += now - self.started
+        self.stack.append(name)
+        self.started = now
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            self.current.seconds += now - self.started
+            self.stack.pop()
+            self.started = now
+
+
+@contextmanager
+def recording_phases(recorder: PhaseRecorder):
+    """Record the phases of all requests routed by RouterCSA. The alternatives
+    have to be searched in this process, so that their scans are recorded."""
+    csa = router_csa.csa
+    extract_journeys = router_csa.extract_journeys
+    run_csa = RouterCSA.run_csa
+    do_routing = RouterCSA.do_routing
+    find_alternative_connections = RouterCSA.find_alternative_connections
+    to_fptf = RouterCSA.to_fptf
+
+    def in_phase(name, function):
+        def recorded(*args, **kwargs):
+            with recorder.phase(name):
+                return function(*args, **kwargs)
+
+        return recorded
+
+    def recording_csa(*args, labels, stats, **kwargs):
+        n_labels = len(labels.pool)
+        n_scanned = stats.scanned_connections
+        result = csa(*args, labels=labels, stats=stats, **kwargs)
+        recorder.current.created_labels += len(labels.pool) - n_labels
+        recorder.current.scanned_connections += stats.scanned_connections - n_scanned
+        return result
+
+    def recording_run_csa(self, context, *args, **kwargs):
+        stops = run_csa(self, context, *args, **kwargs)
+        recorder.current.pareto_sizes.append(
+            len(stops[context.params.destination_stop_id])
+        )
+        return stops
+
+    router_csa.csa = recording_csa
+    router_csa.extract_journeys = in_phase('reconstruction', extract_journeys)
+    RouterCSA.run_csa = recording_run_csa
+    RouterCSA.do_routing = in_phase('search', do_routing)
+    RouterCSA.find_alternative_connections = in_phase(
+        'alternatives', find_alternative_connections
+    )
+    RouterCSA.to_fptf = in_phase('fptf', to_fptf)
+    try:
+        yield
+    finally:
+        router_csa.csa = csa
+        router_csa.extract_journeys = extract_journeys
+        RouterCSA.run_csa = run_csa
+        RouterCSA.do_routing = do_routing
+        RouterCSA.find_alternative_connections = find_alternative_connections
+        RouterCSA.to_fptf = to_fptf
+
+
+def replay(
+    router: RouterCSA, session: SessionType, service_date: date, queries: list[dict]
+) -> tuple[list[dict[str, PhaseStats]], int]:
+    """Route the queries on service_date. Returns the phase statistics of each
+    answered query and the number of queries that failed."""
+    runs = []
+    n_failed = 0
+    for query in queries:
+        # Answers from the results cache would not measure anything
+        router.results.clear()
+        recorder = PhaseRecorder()
+        with recording_phases(recorder):
+            try:
+                router.do_routing(
+                    query_place(query['origin']),
+                    query_place(query['destination']),
+                    query_dp_ts(service_date, query),
+                    session,
+                    search_for_arrival=query['search_for_arrival'],
+                    connection_filter=ConnectionFilter(
+                        only_regional=query['only_regional']
+                    ),
+                )
+            except Exception as e:
+                logging.info(f'{query} failed: {e!r}')
+                n_failed += 1
+                continue
+        runs.append(recorder.phases)
+    return runs, n_failed
+
+
+def report(runs: list[dict[str, PhaseStats]], n_failed: int):
+    print(f'{len(runs)} queries answered, {n_failed} failed')
+    print(
+        f'{"phase":>14}',
+        *(f'{f"p{percentile} ms":>8}' for percentile in PERCENTILES),
+        f'{"scanned":>10}',
+        f'{"labels":>10}',
+        f'{"pareto":>8}',
+        f'{"max":>5}',
+    )
+    for phase in (*PHASES, 'total'):
+        if phase == 'total':
+            stats = [
+                PhaseStats(
+                    seconds=sum(s.seconds for s in phases.values()),
+                    scanned_connections=sum(
+                        s.scanned_connections for s in phases.values()
+                    ),
+                    created_labels=sum(s.created_labels for s in phases.values()),
+                    pareto_sizes=[
+                        size for s in phases.values() for size in s.pareto_sizes
+                    ],
+                )
+                for phases in runs
+            ]
+        else:
+            stats = [phases[phase] for phases in runs]
+        milliseconds = np.percentile([s.seconds * 1000 for s in stats], PERCENTILES)
+        pareto_sizes = [size for s in stats for size in s.pareto_sizes]
+        print(
+            f'{phase:>14}',
+            *(f'{ms:8.1f}' for ms in milliseconds),
+            f'{np.mean([s.scanned_connections for s in stats]):10.0f}',
+            f'{np.mean([s.created_labels for s in stats]):10.0f}',
+            f'{np.mean(pareto_sizes) if pareto_sizes else 0:8.1f}',
+            f'{max(pareto_sizes, default=0):5d}',
+        )
+
+
+def main():
+    """Replay the recorded benchmark queries and report the latency and the
+    work of each phase per query. Scanned connections and created labels are
+    the mean per query, pareto the mean and maximal number of journeys found
+    per scan. The queries and their timetables are recorded from the
+    website's searches on the first run."""
+    engine, Session = sessionfactory()
+    router = RouterCSA()
+    with Session() as session:
+        if not os.path.exists(QUERIES_PATH):
+            os.makedirs(BENCHMARK_DIR, exist_ok=True)
+            record_queries(router, session, date.today())
+        with open(QUERIES_PATH) as f:
+            recording = json.load(f)
+        service_date = date.fromisoformat(recording['service_date'])
+        queries = recording['queries']
+        router.timetables = BenchmarkTimetableStore(
+            router.stop_steffen.station_ids, snapshot_dir=BENCHMARK_SNAPSHOT_DIR
+        )
+        # Load the timetables before measuring
+        for timetable_date in timetable_dates(service_date, queries):
+            router.timetables.get(session, timetable_date)
+        runs, n_failed = replay(router, session, service_date, queries)
+    report(runs, n_failed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+import json
+import time
+from datetime import datetime
+
+from database.engine import sessionfactory
+from router.benchmark_pareto import SEARCHES
+from router.router_csa import RouterCSA
+from router.router_trip_based import RouterTripBased, build_index
+
+
+def run_searches(
+    router: RouterCSA,
+    searches: list[tuple[str, str, datetime]],
+    session,
+) -> list[tuple[float, int | str]]:
+    """Route the searches and return the duration and the number of journeys
+    or the error of each search"""
+    runs = []
+    for origin, destination, dp_ts in searches:
+        start = time.perf_counter()
+        try:
+            result = len(
+                json.loads(router.do_routing(origin, destination, dp_ts, session))
+            )
+        except Exception as e:
+            result = repr(e)
+        runs.append((time.perf_counter() - start, result))
+    return runs
+
+
+def benchmark(searches: list[tuple[str, str, datetime]], session):
+    """Compare the durations of the searches routed by the connection scan and
+    by trip-based routing. Missing trip-based indices are built and loaded
+    beforehand, so that only the queries are measured."""
+    trip_based = RouterTripBased(min_distance=0)
+    for _, _, dp_ts in searches:
+        timetable = trip_based.timetables.get(session, dp_ts.date())
+        if trip_based.trip_based_index(timetable) is None:
+            build_index(timetable, trip_based.transfers)
+            trip_based.trip_based_index(timetable)
+
+    runs = {
+        'csa': run_searches(RouterCSA(), searches, session),
+        'trip-based': run_searches(trip_based, searches, session),
+    }
+    for i, (origin, destination, dp_ts) in enumerate(searches):
+        print(f'{origin} -> {destination} at {dp_ts}:')
+        for engine, engine_runs in runs.items():
+            duration, result = engine_runs[i]
+            print(
+                f'{engine:>12}:',
+                f'{duration * 1000:8.0f} ms',
+                f'{result}',
+            )
+
+    print('Total:')
+    for engine, engine_runs in runs.items():
+        duration = sum(duration for duration, _ in engine_runs)
+        print(f'{engine:>12}: {duration * 1000:8.0f} ms')
+
+
+def main():
+    engine, Session = sessionfactory()
+    with Session() as session:
+        benchmark(SEARCHES, session)
+
+
+if __name__ == '__main__':
+    main()
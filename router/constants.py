@@ -13,14 +13,27 @@ NO_TRIP_ID = 0
 NO_DELAYED_TRIP_ID = 1
 WALKING_TRIP_ID = 2
 WALK_FROM_ORIGIN_TRIP_ID = 3
+# Trip ids below this are reserved for the special trips above. Dense trip
+# indices of the timetable start here.
+FIRST_TRIP_INDEX = 4
 
-NO_STOP_ID = 0
+NO_STOP_ID = -1
+# Stop ids of an origin and a destination given as locations
+ORIGIN_LOCATION_STOP_ID = -2
+DESTINATION_LOCATION_STOP_ID = -3
 MAX_EXPECTED_DELAY_SECONDS = 60 * 30
 MINIMAL_DISTANCE_DIFFERENCE = 1000  # 1 km
 EXTRA_TIME_BEFORE_EARLY_STOP = 60 * 60 * 2  # 2 hour
 MINIMUM_TRANSFER_TIME = 60 * 3  # 3 minutes
 N_ROUTES_TO_FIND = 14
+N_ARRIVAL_SEARCHES = 4  # Backward searches per arrival time routing request
+N_CACHED_HEURISTICS = 256  # Heuristics of the most popular destinations
+N_CACHED_PROFILES = 64
+N_CACHED_RESULTS = 1024  # Results of routing requests
 
 STANDART_SEARCH_WINDOW_HOURS = 12
 MAX_SEARCH_WINDOW_HOURS = 24
 ADDITIONAL_SEARCH_WINDOW_HOURS = 3
+PROFILE_WINDOW_HOURS = 6  # Departure window of a profile search
+# Departure window after the requested time a cached profile has to cover
+PROFILE_PAGE_HOURS = 2
@@ -1,4 +1,7 @@
 from collections import namedtuple
+from dataclasses import dataclass, field
+
+from gtfs.routes import RouteType, is_regional
 
 # Connection from one stop to the next,
 # no stopovers in between
@@ -17,9 +20,17 @@ Connection = namedtuple(
     ],
 )
 
-Reachability = namedtuple(
-    'Reachability',
-    [
+
+class Reachability:
+    """Label of the connection scan.
+
+    Labels are mutable and are recycled by router.labels.LabelPool between
+    searches, so that long searches do not allocate millions of tuples. Updates
+    only write the fields that change. The r_ident_id of a label is its position
+    in the pool.
+    """
+
+    __slots__ = (
         'dp_ts',  # departure time at the origin stop
         'ar_ts',  # arrival time at this stop
         'changeovers',  # number of changeovers on the way to this stop
@@ -35,8 +46,14 @@ Reachability = namedtuple(
         'last_dp_ts',
         'walk_from_delayed_trip',  # walk from the delayed trip to this stop
         'last_changeover_duration',  # Changeover duration at last changeover
-    ],
-)
+    )
+
+    def __repr__(self) -> str:
+        fields = ', '.join(
+            f'{field}={getattr(self, field, None)!r}' for field in self.__slots__
+        )
+        return f'Reachability({fields})'
+
 
 Changeover = namedtuple(
     'Changeover',
@@ -51,3 +68,72 @@ Changeover = namedtuple(
         'dist_traveled',
     ],
 )
+
+
+# Real-time arrival and departure of a trip at a stop, as unix timestamps.
+# Events the change does not cover are None.
+StopEventChange = namedtuple(
+    'StopEventChange',
+    [
+        'trip_id',
+        'stop_id',
+        'planned_ar_ts',
+        'planned_dp_ts',
+        'ar_ts',
+        'dp_ts',
+    ],
+)
+
+
+@dataclass(frozen=True)
+class Route:
+    """Route of trips in a timetable. The timetable holds one Route per route,
+    shared by all of its trips."""
+
+    route_id: int
+    agency_id: str
+    route_short_name: str
+    route_type: RouteType
+    product_name: str
+    is_regional: bool
+
+    @staticmethod
+    def create(
+        route_id: int, agency_id: str, route_short_name: str, route_type: RouteType
+    ) -> 'Route':
+        return Route(
+            route_id=route_id,
+            agency_id=agency_id,
+            route_short_name=route_short_name,
+            route_type=route_type,
+            product_name=route_short_name.split(' ')[0],
+            is_regional=is_regional(route_short_name),
+        )
+
+
+@dataclass(frozen=True)
+class ConnectionFilter:
+    """Connections the router may use. The default filter allows all connections."""
+
+    only_regional: bool = False
+    excluded_route_types: frozenset[RouteType] = field(default_factory=frozenset)
+    excluded_agencies: frozenset[str] = field(default_factory=frozenset)
+
+    def __bool__(self) -> bool:
+        return (
+            self.only_regional
+            or bool(self.excluded_route_types)
+            or bool(self.excluded_agencies)
+        )
+
+
+@dataclass(frozen=True)
+class Location:
+    """Origin or destination given by coordinates instead of a station name"""
+
+    lat: float
+    lon: float
+
+    @property
+    def name(self) -> str:
+        return f'{self.lat:.5f}, {self.lon:.5f}'
@@ -0,0 +1,225 @@
+import json
+from datetime import UTC, datetime
+from functools import lru_cache, partial
+from itertools import pairwise
+
+from gtfs.routes import RouteType
+from gtfs.stops import Stops, StopSteffen
+from router.constants import WALKING_TRIP_ID
+from router.datatypes import Connection, Route
+
+# Same JSON as flask.jsonify: sorted keys, no whitespace, ASCII only. All
+# objects written by FPTFEncoder list their keys in sorted order, too.
+dumps = partial(json.dumps, sort_keys=True, separators=(',', ':'))
+
+N_CACHED_MINUTES = 8 * 24 * 60
+
+WALKING_LINE = dumps(
+    {
+        'id': 0,
+        'name': 'walking',
+        'operator': 'walking',
+        'isRegio': True,
+        'productName': 'walking',
+        'mode': 'walking',
+        'type': 'line',
+    }
+)
+
+
+@lru_cache(maxsize=N_CACHED_MINUTES)
+def minute_to_iso(minute: int) -> str:
+    """Opening quote and ISO format of the minute since the epoch, up to the
+    colon before the seconds"""
+    return '"' + datetime.fromtimestamp(minute * 60, UTC).isoformat()[:17]
+
+
+def utc_ts_to_iso(ts: int) -> str:
+    """JSON string of the ISO format of a UTC timestamp"""
+    minute, second = divmod(ts, 60)
+    return f'{minute_to_iso(minute)}{second:02d}+00:00"'
+
+
+def stop_fragments(stop: Stops) -> tuple[str, str]:
+    """JSON of the FPTF stop and of the platform of a stop"""
+    name = dumps(stop.stop_name)
+    return (
+        f'{{"id":{name},"name":{name},"type":"stop"}}',
+        dumps(stop.platform_code),
+    )
+
+
+def line_fragment(route: Route) -> str:
+    """JSON of the FPTF line of a route"""
+    return dumps(
+        {
+            'id': route.route_id,
+            'name': route.route_short_name,
+            'operator': route.agency_id,
+            'isRegio': route.is_regional,
+            'productName': route.product_name,
+            'mode': 'bus' if route.route_type == RouteType.BUS else 'train',
+            'type': 'line',
+        }
+    )
+
+
+class FPTFEncoder:
+    """Writes journeys as FPTF
+    (https://github.com/public-transport/friendly-public-transport-format) JSON.
+
+    The JSON of stops, platforms and lines is built once and reused for every
+    response, so writing a journey only formats its times and distances.
+    """
+
+    def __init__(self, stop_steffen: StopSteffen):
+        self.stop_steffen = stop_steffen
+        self.stops: dict[int, tuple[str, str]] = {}
+        self.lines: dict[Route, str] = {}
+
+    def stop(self, stop_id: int, locations: dict[int, Stops] | None) -> tuple[str, str]:
+        """JSON of a stop and its platform. Locations walked from or to are
+        looked up in locations, by location stop id."""
+        if locations and stop_id in locations:
+            return stop_fragments(locations[stop_id])
+        fragments = self.stops.get(stop_id)
+        if fragments is None:
+            fragments = stop_fragments(self.stop_steffen.get_stop(stop_id=stop_id))
+            self.stops[stop_id] = fragments
+        return fragments
+
+    def line(self, route: Route) -> str:
+        fragment = self.lines.get(route)
+        if fragment is None:
+            fragment = self.lines[route] = line_fragment(route)
+        return fragment
+
+    def walk(
+        self,
+        connection: Connection,
+        locations: dict[int, Stops] | None,
+        with_platforms: bool,
+    ) -> str:
+        origin, origin_platform = self.stop(connection.dp_stop_id, locations)
+        destination, destination_platform = self.stop(connection.ar_stop_id, locations)
+        return (
+            f'{{"arrival":{utc_ts_to_iso(connection.ar_ts)},'
+            f'"arrivalPlatform":{destination_platform if with_platforms else "null"},'
+            f'"departure":{utc_ts_to_iso(connection.dp_ts)},'
+            f'"departurePlatform":{origin_platform if with_platforms else "null"},'
+            f'"destination":{destination},"distance":{connection.dist_traveled},'
+            f'"line":{WALKING_LINE},"mode":"walking","origin":{origin},'
+            f'"public":true,"stopovers":[],"walking":true}}'
+        )
+
+    def ride(
+        self,
+        dp_ts: int,
+        dp_stop_id: int,
+        last_connection: Connection,
+        stopovers: list[str],
+        distance: int,
+        route: Route,
+        locations: dict[int, Stops] | None,
+    ) -> str:
+        origin, origin_platform = self.stop(dp_stop_id, locations)
+        destination, destination_platform = self.stop(
+            last_connection.ar_platform_id, locations
+        )
+        return (
+            f'{{"arrival":{utc_ts_to_iso(last_connection.ar_ts)},'
+            f'"arrivalPlatform":{destination_platform},'
+            f'"departure":{utc_ts_to_iso(dp_ts)},'
+            f'"departurePlatform":{origin_platform},'
+            f'"destination":{destination},"distance":{distance},'
+            f'"line":{self.line(route)},"mode":"train","origin":{origin},'
+            f'"public":true,"stopovers":[{",".join(stopovers)}],"walking":false}}'
+        )
+
+    def journey(
+        self,
+        journey: list[Connection],
+        routes: dict[int, Route],
+        locations: dict[int, Stops] | None = None,
+    ) -> str:
+        """FPTF JSON of a journey with stop and trip ids. Consecutive
+        connections of a trip are one leg."""
+        legs: list[str] = []
+        stopovers: list[str] = []
+
+        dp_ts = journey[0].dp_ts
+        dp_stop_id = journey[0].dp_platform_id
+        dist_traveled = 0
+
+        for c1, c2 in pairwise(journey):
+            dist_traveled += c1.dist_traveled
+            if c1.trip_id == c2.trip_id:
+                stop, platform = self.stop(c1.ar_platform_id, locations)
+                stopovers.append(
+                    f'{{"arrival":{utc_ts_to_iso(c1.ar_ts)},'
+                    f'"arrivalPlatform":{platform},'
+                    f'"departure":{utc_ts_to_iso(c2.dp_ts)},'
+                    f'"departurePlatform":{platform},'
+                    f'"distance":{dist_traveled},"stop":{stop},"type":"stopover"}}'
+                )
+                continue
+
+            if c1.trip_id == WALKING_TRIP_ID:
+                legs.append(self.walk(c1, locations, with_platforms=False))
+            else:
+                legs.append(
+                    self.ride(
+                        dp_ts,
+                        dp_stop_id,
+                        c1,
+                        stopovers,
+                        dist_traveled,
+                        routes[c1.trip_id],
+                        locations,
+                    )
+                )
+            dp_ts = c2.dp_ts
+            dp_stop_id = c2.dp_platform_id
+            dist_traveled = 0
+            stopovers = []
+
+        if journey[-1].trip_id == WALKING_TRIP_ID:
+            legs.append(self.walk(journey[-1], locations, with_platforms=True))
+        else:
+            legs.append(
+                self.ride(
+                    dp_ts,
+                    dp_stop_id,
+                    journey[-1],
+                    stopovers,
+                    dist_traveled + journey[-1].dist_traveled,
+                    routes[journey[-1].trip_id],
+                    locations,
+                )
+            )
+
+        return f'{{"legs":[{",".join(legs)}],"type":"journey"}}'
+
+    def journeys_and_alternatives(
+        self,
+        journeys: list[list[Connection]],
+        alternatives: list[list[list[Connection]]],
+        routes: dict[int, Route],
+        locations: dict[int, Stops] | None = None,
+    ) -> str:
+        """FPTF JSON of a list of {"journey": ..., "alternatives": [...]}"""
+        return (
+            '['
+            + ','.join(
+                '{"alternatives":['
+                + ','.join(
+                    self.journey(alternative, routes, locations)
+                    for alternative in alternatives_for_journey
+                )
+                + '],"journey":'
+                + self.journey(journey, routes, locations)
+                + '}'
+                for journey, alternatives_for_journey in zip(journeys, alternatives)
+            )
+            + ']'
+        )
@@ -1,10 +1,5 @@
-from bisect import bisect_left
-from dataclasses import dataclass
-from datetime import UTC, datetime
 from itertools import pairwise
 
-from gtfs.routes import Routes, RouteType
-from gtfs.stops import StopSteffen
 from gtfs.transfers import Transfer
 from router.constants import (
     MINIMUM_TRANSFER_TIME,
@@ -13,23 +8,18 @@ from router.constants import (
     WALKING_TRIP_ID,
 )
 from router.datatypes import Connection, Reachability
-
-
-def utc_ts_to_iso(ts: int) -> str:
-    return datetime.fromtimestamp(ts, UTC).isoformat()
+from router.labels import LabelPool
+from router.timetable import Timetable
 
 
 def extract_reachability_chain(
-    stops: dict[int, list[Reachability]],
+    pool: LabelPool,
     destination: Reachability,
 ) -> list[Reachability]:
     journey = [destination]
     previous = destination
     while True:
-        for current in stops[previous.last_stop_id]:
-            if current.r_ident_id == previous.last_r_ident_id:
-                previous = current
-                break
+        previous = pool[previous.last_r_ident_id]
         if previous.last_stop_id != NO_STOP_ID:
             journey.append(previous)
         else:
@@ -39,34 +29,36 @@ def extract_reachability_chain(
 
 def extract_reachability_chains(
     stops: dict[int, list[Reachability]],
+    pool: LabelPool,
     destination_stop_id: int,
 ) -> list[list[Reachability]]:
     reachability_chains = []
     for reachability in stops[destination_stop_id]:
-        reachability_chains.append(extract_reachability_chain(stops, reachability))
+        reachability_chains.append(extract_reachability_chain(pool, reachability))
     return reachability_chains
 
 
+def find_trip_connection(timetable: Timetable, trip_id: int, from_ts: int):
+    """First connection of the trip departing at or after from_ts"""
+    index = timetable.trip_connection_index(trip_id, from_ts)
+    if index is not None:
+        return timetable[index]
+
+
 def match_connection_to_reachability(
-    connections: list[Connection],
+    timetable: Timetable,
     reachability: Reachability,
 ):
-    start_index = bisect_left(
-        connections, reachability.last_dp_ts, key=lambda c: c.dp_ts
+    return find_trip_connection(
+        timetable, reachability.current_trip_id, reachability.last_dp_ts
     )
-    for connection in connections[start_index:]:
-        if connection.trip_id == reachability.current_trip_id:
-            return connection
 
 
 def get_next_connection(
-    connections: list[Connection],
+    timetable: Timetable,
     connection: Connection,
 ):
-    start_index = bisect_left(connections, connection.ar_ts, key=lambda c: c.dp_ts)
-    for c in connections[start_index:]:
-        if c.trip_id == connection.trip_id:
-            return c
+    return find_trip_connection(timetable, connection.trip_id, connection.ar_ts)
 
 
 def match_transfer_to_reachability(
@@ -106,11 +98,12 @@ def match_transfer_to_reachability(
 
 def extract_journeys(
     stops: dict[int, list[Reachability]],
+    pool: LabelPool,
     destination_stop_id: int,
-    connections: list[Connection],
+    timetable: Timetable,
     transfers: dict[int, list[Transfer]],
 ) -> list[list[Connection]]:
-    reachability_chains = extract_reachability_chains(stops, destination_stop_id)
+    reachability_chains = extract_reachability_chains(stops, pool, destination_stop_id)
 
     journeys = []
     for reachability_chain in reachability_chains:
@@ -148,7 +141,7 @@ def extract_journeys(
                 )
             else:
                 sparse_journey.append(
-                    match_connection_to_reachability(connections, reachability)
+                    match_connection_to_reachability(timetable, reachability)
                 )
 
         journey: list[Connection] = []
@@ -158,11 +151,11 @@ def extract_journeys(
             for c1, c2 in pairwise(sparse_journey):
                 journey.append(c1)
                 while journey[-1].ar_stop_id != c2.dp_stop_id:
-                    journey.append(get_next_connection(connections, journey[-1]))
+                    journey.append(get_next_connection(timetable, journey[-1]))
 
             journey.append(c2)
         while journey[-1].ar_stop_id != destination_stop_id:
-            journey.append(get_next_connection(connections, journey[-1]))
+            journey.append(get_next_connection(timetable, journey[-1]))
 
         journeys.append(journey)
 
@@ -255,199 +248,3 @@ def remove_duplicate_journeys(journeys: list[list[Connection]]):
             unique_journeys.append(journey)
 
     return unique_journeys
-
-
-@dataclass
-class FPTFStop:
-    id: int
-    name: str
-    type: str = 'stop'
-
-
-@dataclass
-class FPTFLine:
-    id: int
-    name: str
-    operator: str
-    isRegio: bool
-    productName: str
-    mode: str
-    type: str = 'line'
-
-    @staticmethod
-    def from_route(route: Routes) -> 'FPTFLine':
-        return FPTFLine(
-            id=route.route_id,
-            name=route.route_short_name,
-            operator=route.agency_id,
-            isRegio=route.is_regional(),
-            productName=route.route_short_name.split(' ')[0],
-            mode='bus' if route.route_type == RouteType.BUS else 'train',
-        )
-
-    @staticmethod
-    def walking() -> 'FPTFLine':
-        return FPTFLine(
-            id=0,
-            name='walking',
-            operator='walking',
-            isRegio=True,
-            productName='walking',
-            mode='walking',
-        )
-
-
-@dataclass
-class FPTFStopover:
-    stop: FPTFStop
-    arrival: str
-    arrivalPlatform: str
-    departure: str
-    departurePlatform: str
-    distance: int
-    type: str = 'stopover'
-
-
-@dataclass
-class FPTFLeg:
-    origin: FPTFStop
-    destination: FPTFStop
-    departure: str
-    departurePlatform: str
-    arrival: str
-    arrivalPlatform: str
-    stopovers: list[FPTFStopover]
-    distance: int
-    line: FPTFLine | None
-    walking: bool = False
-    mode: str = 'train'
-    public: bool = True
-
-
-@dataclass
-class FPTFJourney:
-    legs: list[FPTFLeg]
-    type: str = 'journey'
-
-    @staticmethod
-    def from_journey(
-        journey: list[Connection], routes: dict[int, Routes], stop_steffen: StopSteffen
-    ) -> 'FPTFJourney':
-        legs: list[FPTFLeg] = []
-        stopovers: list[FPTFStopover] = []
-
-        dp_ts = journey[0].dp_ts
-        dp_stop_id = journey[0].dp_platform_id
-        dist_traveled = 0
-
-        for c1, c2 in pairwise(journey):
-            dist_traveled += c1.dist_traveled
-            if c1.trip_id == c2.trip_id:
-                current_stop = stop_steffen.get_stop(stop_id=c1.ar_platform_id)
-                stopovers.append(
-                    FPTFStopover(
-                        stop=FPTFStop(
-                            id=current_stop.stop_name, name=current_stop.stop_name
-                        ),
-                        arrival=utc_ts_to_iso(c1.ar_ts),
-                        arrivalPlatform=current_stop.platform_code,
-                        departure=utc_ts_to_iso(c2.dp_ts),
-                        departurePlatform=current_stop.platform_code,
-                        distance=dist_traveled,
-                    )
-                )
-            elif c1.trip_id == WALKING_TRIP_ID:
-                ar_stop = stop_steffen.get_stop(stop_id=c1.ar_stop_id)
-                dp_stop = stop_steffen.get_stop(stop_id=c1.dp_stop_id)
-                legs.append(
-                    FPTFLeg(
-                        origin=FPTFStop(id=dp_stop.stop_name, name=dp_stop.stop_name),
-                        destination=FPTFStop(
-                            id=ar_stop.stop_name, name=ar_stop.stop_name
-                        ),
-                        departure=utc_ts_to_iso(c1.dp_ts),
-                        departurePlatform=None,
-                        arrival=utc_ts_to_iso(c1.ar_ts),
-                        arrivalPlatform=None,
-                        stopovers=[],
-                        distance=c1.dist_traveled,
-                        walking=True,
-                        mode='walking',
-                        line=FPTFLine.walking(),
-                    )
-                )
-
-                dp_ts = c2.dp_ts
-                dp_stop_id = c2.dp_platform_id
-                dist_traveled = 0
-                stopovers: list[FPTFStopover] = []
-            else:
-                line = FPTFLine.from_route(routes[c1.trip_id])
-                dp_stop = stop_steffen.get_stop(stop_id=dp_stop_id)
-                ar_stop = stop_steffen.get_stop(stop_id=c1.ar_platform_id)
-                legs.append(
-                    FPTFLeg(
-                        origin=FPTFStop(id=dp_stop.stop_name, name=dp_stop.stop_name),
-                        destination=FPTFStop(
-                            id=ar_stop.stop_name, name=ar_stop.stop_name
-                        ),
-                        departure=utc_ts_to_iso(dp_ts),
-                        departurePlatform=dp_stop.platform_code,
-                        arrival=utc_ts_to_iso(c1.ar_ts),
-                        arrivalPlatform=ar_stop.platform_code,
-                        stopovers=stopovers,
-                        distance=dist_traveled,
-                        line=line,
-                    )
-                )
-
-                dp_ts = c2.dp_ts
-                dp_stop_id = c2.dp_platform_id
-                dist_traveled = 0
-                stopovers: list[FPTFStopover] = []
-
-        if journey[-1].trip_id == WALKING_TRIP_ID:
-            ar_stop = stop_steffen.get_stop(stop_id=journey[-1].ar_stop_id)
-            dp_stop = stop_steffen.get_stop(stop_id=journey[-1].dp_stop_id)
-            legs.append(
-                FPTFLeg(
-                    origin=FPTFStop(id=dp_stop.stop_name, name=dp_stop.stop_name),
-                    destination=FPTFStop(id=ar_stop.stop_name, name=ar_stop.stop_name),
-                    departure=utc_ts_to_iso(journey[-1].dp_ts),
-                    departurePlatform=dp_stop.platform_code,
-                    arrival=utc_ts_to_iso(journey[-1].ar_ts),
-                    arrivalPlatform=ar_stop.platform_code,
-                    stopovers=[],
-                    distance=journey[-1].dist_traveled,
-                    walking=True,
-                    mode='walking',
-                    line=FPTFLine.walking(),
-                )
-            )
-        else:
-            line = FPTFLine.from_route(routes[journey[-1].trip_id])
-            dp_stop = stop_steffen.get_stop(stop_id=dp_stop_id)
-            ar_stop = stop_steffen.get_stop(
-                stop_id=journey[-1].ar_platform_id,
-            )
-            legs.append(
-                FPTFLeg(
-                    origin=FPTFStop(id=dp_stop.stop_name, name=dp_stop.stop_name),
-                    destination=FPTFStop(id=ar_stop.stop_name, name=ar_stop.stop_name),
-                    departure=utc_ts_to_iso(dp_ts),
-                    departurePlatform=dp_stop.platform_code,
-                    arrival=utc_ts_to_iso(journey[-1].ar_ts),
-                    arrivalPlatform=ar_stop.platform_code,
-                    stopovers=stopovers,
-                    distance=dist_traveled + journey[-1].dist_traveled,
-                    line=line,
-                )
-            )
-
-        return FPTFJourney(legs=legs)
-
-
-@dataclass
-class FPTFJourneyAndAlternatives:
-    journey: FPTFJourney
-    alternatives: list[FPTFJourney]
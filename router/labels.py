@@ -0,0 +1,100 @@
+from router.datatypes import Reachability
+from router.pareto import ParetoBag
+
+
+class LabelPool:
+    """Growable pool of reachabilities, referenced by their r_ident_id.
+
+    The labels are reused between searches: reset() only rewinds the pool, the
+    next search overwrites the fields of the labels it takes from the pool. A
+    label taken from the pool has its r_ident_id set to its position, all other
+    fields have to be written by the caller.
+    """
+
+    def __init__(self):
+        self.labels: list[Reachability] = []
+        self.size = 0
+
+    def reset(self):
+        self.size = 0
+
+    def new(self) -> Reachability:
+        r_ident_id = self.size
+        if r_ident_id == len(self.labels):
+            label = Reachability()
+            self.labels.append(label)
+        else:
+            label = self.labels[r_ident_id]
+        label.r_ident_id = r_ident_id
+        self.size = r_ident_id + 1
+        return label
+
+    def create(self, **fields) -> Reachability:
+        """New label with the given fields. Meant for seeding a search, use new()
+        in hot loops."""
+        label = self.new()
+        for field, value in fields.items():
+            setattr(label, field, value)
+        return label
+
+    def copy(self, other: Reachability) -> Reachability:
+        label = self.new()
+        label.dp_ts = other.dp_ts
+        label.ar_ts = other.ar_ts
+        label.changeovers = other.changeovers
+        label.dist_traveled = other.dist_traveled
+        label.is_regio = other.is_regio
+        label.transfer_time_from_delayed_trip = other.transfer_time_from_delayed_trip
+        label.from_failed_transfer_stop_id = other.from_failed_transfer_stop_id
+        label.current_trip_id = other.current_trip_id
+        label.min_heuristic = other.min_heuristic
+        label.last_r_ident_id = other.last_r_ident_id
+        label.last_stop_id = other.last_stop_id
+        label.last_dp_ts = other.last_dp_ts
+        label.walk_from_delayed_trip = other.walk_from_delayed_trip
+        label.last_changeover_duration = other.last_changeover_duration
+        return label
+
+    def __getitem__(self, r_ident_id: int) -> Reachability:
+        return self.labels[r_ident_id]
+
+    def __len__(self) -> int:
+        return self.size
+
+
+class LabelContainers:
+    """Pareto sets of reachabilities per dense stop index and per dense trip index.
+
+    The containers are allocated once and reused between searches. Only the
+    entries that were touched during a search are reset afterwards.
+    """
+
+    def __init__(self, n_stops: int, n_trips: int):
+        self.n_stops = n_stops
+        self.n_trips = n_trips
+        self.stops: list[ParetoBag] = [ParetoBag() for _ in range(n_stops)]
+        self.trips: list[ParetoBag | None] = [None] * n_trips
+        self.touched_stops: list[int] = []
+        self.touched_trips: list[int] = []
+        self.pool = LabelPool()
+
+    def fits(self, n_stops: int, n_trips: int) -> bool:
+        return self.n_stops == n_stops and self.n_trips == n_trips
+
+    def reset(self):
+        stops = self.stops
+        for stop in self.touched_stops:
+            stops[stop].clear()
+        self.touched_stops.clear()
+
+        trips = self.trips
+        for trip in self.touched_trips:
+            trips[trip] = None
+        self.touched_trips.clear()
+
+        self.pool.reset()
+
+    def add_to_stop(self, stop: int, reachability: Reachability):
+        if not self.stops[stop]:
+            self.touched_stops.append(stop)
+        self.stops[stop].append(reachability)
@@ -0,0 +1,234 @@
+import os
+from datetime import date, timedelta
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from sqlalchemy.orm import Session as SessionType
+
+from config import CACHE_PATH
+from database.engine import sessionfactory
+from gtfs.stops import StopSteffen
+from gtfs.transfers import Transfer, get_transfers
+from helpers.logger import logging
+from router.timetable import Timetable, TimetableStore
+
+LANDMARKS_PATH = CACHE_PATH + '/landmarks.npz'
+N_LANDMARKS = 16
+# Service dates the travel times are taken from. Bounds are only admissible
+# for timetables without faster connections than on these dates.
+N_LANDMARK_DAYS = 7
+# Lower bound of stations that cannot reach the destination
+UNREACHABLE = 2**40
+
+
+def min_duration_graph(
+    timetables: list[Timetable],
+    transfers: list[list[Transfer]],
+    n_stations: int,
+) -> csr_matrix:
+    """Graph of the stations with the minimal duration of any connection or
+    transfer between two stations as edge weights. Changeover times are not
+    included, so that shortest paths are lower bounds of travel times."""
+    from_stops = [timetable.dp_stop for timetable in timetables]
+    to_stops = [timetable.ar_stop for timetable in timetables]
+    durations = [timetable.ar_ts - timetable.dp_ts for timetable in timetables]
+    walks = [
+        transfer
+        for transfers_from_stop in transfers
+        for transfer in transfers_from_stop
+    ]
+    from_stops.append(np.array([walk.from_stop for walk in walks], dtype=np.int32))
+    to_stops.append(np.array([walk.to_stop for walk in walks], dtype=np.int32))
+    durations.append(np.array([walk.duration for walk in walks], dtype=np.int64))
+
+    from_stops = np.concatenate(from_stops).astype(np.int64)
+    to_stops = np.concatenate(to_stops).astype(np.int64)
+    durations = np.concatenate(durations)
+
+    # Keep the shortest duration of every edge. Zero weights would be treated
+    # as missing edges, so durations are at least one second.
+    edges = from_stops * n_stations + to_stops
+    order = np.lexsort((durations, edges))
+    edges, first = np.unique(edges[order], return_index=True)
+    durations = np.maximum(durations[order][first], 1)
+    return csr_matrix(
+        (durations.astype(np.float64), (edges // n_stations, edges % n_stations)),
+        shape=(n_stations, n_stations),
+    )
+
+
+def select_landmarks(graph: csr_matrix, n_landmarks: int) -> np.ndarray:
+    """Landmarks far from each other (farthest point selection), starting with
+    the station with the most connections"""
+    degrees = np.diff(graph.indptr) + np.bincount(
+        graph.indices, minlength=graph.shape[0]
+    )
+    landmarks = [int(np.argmax(degrees))]
+    min_distances = dijkstra(graph, indices=landmarks[0])
+    while len(landmarks) < n_landmarks:
+        # Only consider stations that are reachable at all
+        candidates = np.where(np.isfinite(min_distances), min_distances, -1)
+        candidate = int(np.argmax(candidates))
+        if candidates[candidate] <= 0:
+            break
+        landmarks.append(candidate)
+        min_distances = np.minimum(min_distances, dijkstra(graph, indices=candidate))
+    return np.array(landmarks, dtype=np.int64)
+
+
+class Landmarks:
+    """Minimal travel times from and to landmark stations (ALT). By the triangle
+    inequality, they give lower bounds of the travel time between any two
+    stations:
+
+    d(v, t) >= d(l, t) - d(l, v)
+    d(v, t) >= d(v, l) - d(t, l)
+
+    The bounds only hold for the service dates whose timetables the travel
+    times were taken from, see covers().
+    """
+
+    def __init__(
+        self,
+        station_ids: np.ndarray,
+        landmarks: np.ndarray,
+        from_landmarks: np.ndarray,
+        to_landmarks: np.ndarray,
+        first_date: date | None,
+        n_days: int,
+    ):
+        self.station_ids = station_ids
+        self.landmarks = landmarks
+        # n_landmarks x n_stations travel times in seconds, inf if unreachable
+        self.from_landmarks = from_landmarks
+        self.to_landmarks = to_landmarks
+        # Service dates of the timetables the travel times were taken from,
+        # None if unknown
+        self.first_date = first_date
+        self.n_days = n_days
+
+    def covers(self, service_date: date) -> bool:
+        """Whether the bounds hold for the timetable of service_date"""
+        return (
+            self.first_date is not None
+            and self.first_date
+            <= service_date
+            < self.first_date + timedelta(days=self.n_days)
+        )
+
+    @staticmethod
+    def compute(
+        timetables: list[Timetable],
+        transfers: list[list[Transfer]],
+        station_ids: np.ndarray,
+        n_landmarks: int = N_LANDMARKS,
+    ) -> 'Landmarks':
+        """Landmarks of the timetables, which are of consecutive service dates"""
+        graph = min_duration_graph(timetables, transfers, len(station_ids))
+        landmarks = select_landmarks(graph, n_landmarks)
+        return Landmarks(
+            station_ids=station_ids,
+            landmarks=landmarks,
+            from_landmarks=dijkstra(graph, indices=landmarks).astype(np.float32),
+            to_landmarks=dijkstra(graph.T.tocsr(), indices=landmarks).astype(
+                np.float32
+            ),
+            first_date=min(timetable.service_date for timetable in timetables),
+            n_days=len(timetables),
+        )
+
+    def save(self, path: str = LANDMARKS_PATH):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp.npz'
+        np.savez(
+            tmp_path,
+            station_ids=self.station_ids,
+            landmarks=self.landmarks,
+            from_landmarks=self.from_landmarks,
+            to_landmarks=self.to_landmarks,
+            first_date=self.first_date.toordinal(),
+            n_days=self.n_days,
+        )
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(station_ids: np.ndarray, path: str = LANDMARKS_PATH) -> 'Landmarks':
+        """Load the landmarks, mapped to the dense indices of station_ids.
+        Stations unknown to the landmarks get no bounds. Landmarks saved
+        without their service dates cover no date."""
+        with np.load(path) as data:
+            saved_station_ids = data['station_ids']
+            from_landmarks = data['from_landmarks']
+            to_landmarks = data['to_landmarks']
+            landmarks = data['landmarks']
+            first_date = None
+            n_days = 0
+            if 'first_date' in data:
+                first_date = date.fromordinal(int(data['first_date']))
+                n_days = int(data['n_days'])
+
+        positions = np.searchsorted(saved_station_ids, station_ids)
+        positions = np.minimum(positions, len(saved_station_ids) - 1)
+        known = saved_station_ids[positions] == station_ids
+        n_landmarks = len(landmarks)
+        mapped_from = np.full((n_landmarks, len(station_ids)), np.nan, np.float32)
+        mapped_to = np.full((n_landmarks, len(station_ids)), np.nan, np.float32)
+        mapped_from[:, known] = from_landmarks[:, positions[known]]
+        mapped_to[:, known] = to_landmarks[:, positions[known]]
+        return Landmarks(
+            station_ids=station_ids,
+            landmarks=landmarks,
+            from_landmarks=mapped_from,
+            to_landmarks=mapped_to,
+            first_date=first_date,
+            n_days=n_days,
+        )
+
+    def lower_bounds(self, destination_stop_id: int) -> list[int]:
+        """Lower bound of the travel time in seconds from every station to the
+        destination, indexed by dense station index"""
+        with np.errstate(invalid='ignore'):
+            bounds = np.concatenate(
+                (
+                    self.from_landmarks[:, [destination_stop_id]] - self.from_landmarks,
+                    self.to_landmarks - self.to_landmarks[:, [destination_stop_id]],
+                )
+            )
+        # inf - inf is nan, which gives no bound
+        bounds = np.where(np.isnan(bounds), 0, bounds).max(axis=0, initial=0)
+        bounds = np.minimum(bounds, UNREACHABLE)
+        bounds[destination_stop_id] = 0
+        return bounds.astype(np.int64).tolist()
+
+
+def compute_landmarks(
+    session: SessionType, first_date: date, n_days: int = N_LANDMARK_DAYS
+) -> Landmarks:
+    stop_steffen = StopSteffen()
+    # Imported here, as router_csa imports this module
+    from router.router_csa import index_transfers
+
+    transfers = index_transfers(get_transfers(), stop_steffen.station_index)
+    store = TimetableStore(stop_steffen.station_ids, max_size=n_days)
+    timetables = [
+        store.get(session, first_date + timedelta(days=days)) for days in range(n_days)
+    ]
+    return Landmarks.compute(timetables, transfers, stop_steffen.station_ids)
+
+
+def main():
+    """Recompute the landmarks from the timetables of the coming days. Meant to
+    run nightly, after the timetable snapshots were rewritten."""
+    engine, Session = sessionfactory()
+    with Session() as session:
+        landmarks = compute_landmarks(session, date.today())
+    landmarks.save()
+    logging.info(
+        f'Saved {len(landmarks.landmarks)} landmarks for'
+        f' {len(landmarks.station_ids)} stations to {LANDMARKS_PATH}'
+    )
+
+
+if __name__ == '__main__':
+    main()
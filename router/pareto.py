@@ -1,3 +1,7 @@
+from bisect import bisect_right
+from itertools import islice
+from operator import attrgetter
+
 from router.constants import (
     EXTRA_DURATION_FOR_SHORTER_ROUTE,
     MINIMAL_DISTANCE_DIFFERENCE,
@@ -154,3 +158,209 @@ def relaxed_alternative_pareto_dominated(
             worse = True
 
     return worse
+
+
+def add_reachability_to_pareto(
+    reachability: Reachability,
+    pareto_set: list[Reachability],
+    is_alternative: bool,
+):
+    """Reference implementation of ParetoBag.add and ParetoBag.add_alternative,
+    based on the domination functions above. Kept for benchmarks and to check
+    the bags against."""
+    was_appended = False
+    if is_alternative:
+        # Using reversed speeds up the algo by a lot, as reachabilities are kind of
+        # sorted by departure time. It is more likely for a reachability to be dominated
+        # by a reachability that departs later.
+        for other in reversed(pareto_set):
+            if relaxed_alternative_pareto_dominated(reachability, other):
+                break
+        else:
+            pareto_set = [
+                p
+                for p in pareto_set
+                if not relaxed_alternative_pareto_dominated(p, reachability)
+            ]
+            pareto_set.append(reachability)
+            was_appended = True
+    else:
+        was_dominated = False
+        for other in reversed(pareto_set):
+            if relaxed_pareto_dominated(reachability, other):
+                was_dominated = True
+                break
+            if other.dp_ts < reachability.dp_ts:
+                break
+        if not was_dominated:
+            pareto_set = [
+                p
+                for p in pareto_set
+                if p.ar_ts < reachability.ar_ts
+                or not relaxed_pareto_dominated(p, reachability)
+            ]
+            pareto_set.append(reachability)
+            pareto_set = sorted(pareto_set, key=lambda r: r.dp_ts)
+            was_appended = True
+    return pareto_set, was_appended
+
+
+_get_dp_ts = attrgetter('dp_ts')
+
+
+class ParetoBag(list):
+    """Pareto set of reachabilities that is modified in place.
+
+    add() keeps the bag ordered by dp_ts: a reachability can only be dominated
+    by reachabilities departing at the same time or later, and it can only
+    dominate reachabilities departing at the same time or earlier, so both
+    checks are limited to one end of the bag.
+    add_alternative() keeps the insertion order, as the alternative criteria
+    do not include dp_ts.
+
+    The criteria are the same as relaxed_pareto_dominated and
+    relaxed_alternative_pareto_dominated, but inlined. Starting points are not
+    added to bags, they are placed with LabelContainers.add_to_stop.
+    """
+
+    __slots__ = ()
+
+    def add(self, reachability: Reachability) -> bool:
+        dp_ts = reachability.dp_ts
+        ar_ts = reachability.ar_ts
+        changeovers = reachability.changeovers
+        is_regio = reachability.is_regio
+        last_changeover_duration = reachability.last_changeover_duration
+
+        # Is the reachability dominated? Only reachabilities that depart at the
+        # same time or later can dominate it, apart from starting points, which
+        # dominate everything. The first reachability that departs earlier is
+        # checked for being a starting point as well.
+        for other in reversed(self):
+            if other.current_trip_id == NO_TRIP_ID:
+                return False
+            if other.dp_ts < dp_ts:
+                break
+            if (
+                ar_ts < other.ar_ts
+                or changeovers < other.changeovers
+                or is_regio > other.is_regio
+            ):
+                continue
+            if (
+                dp_ts < other.dp_ts
+                or ar_ts > other.ar_ts
+                or changeovers > other.changeovers
+                or is_regio < other.is_regio
+                or last_changeover_duration < other.last_changeover_duration
+            ):
+                return False
+
+        # Remove reachabilities dominated by the new one. These depart at the
+        # same time or earlier and arrive at the same time or later.
+        end = bisect_right(self, dp_ts, key=_get_dp_ts)
+        dominated = [
+            i
+            for i, other in enumerate(islice(self, end))
+            if other.ar_ts >= ar_ts
+            and other.changeovers >= changeovers
+            and other.is_regio <= is_regio
+            and (
+                other.dp_ts < dp_ts
+                or other.ar_ts > ar_ts
+                or other.changeovers > changeovers
+                or other.is_regio < is_regio
+                or other.last_changeover_duration < last_changeover_duration
+            )
+        ]
+        for i in reversed(dominated):
+            del self[i]
+        self.insert(end - len(dominated), reachability)
+        return True
+
+    def add_alternative(self, reachability: Reachability) -> bool:
+        ar_ts = reachability.ar_ts
+        dp_ts = reachability.dp_ts
+        duration = ar_ts - dp_ts
+        changeovers = reachability.changeovers
+        is_regio = reachability.is_regio
+        dist_traveled = reachability.dist_traveled
+        transfer_time = reachability.transfer_time_from_delayed_trip
+        from_failed = reachability.from_failed_transfer_stop_id
+        last_changeover_duration = reachability.last_changeover_duration
+
+        # Using reversed speeds up the algo by a lot, as reachabilities are kind of
+        # sorted by departure time. It is more likely for a reachability to be dominated
+        # by a reachability that departs later.
+        for other in reversed(self):
+            if other.current_trip_id == NO_TRIP_ID:
+                return False
+            if (
+                ar_ts < other.ar_ts
+                or changeovers < other.changeovers
+                or is_regio > other.is_regio
+                or transfer_time > other.transfer_time_from_delayed_trip
+                or from_failed > other.from_failed_transfer_stop_id
+            ):
+                continue
+            distance_difference = dist_traveled - other.dist_traveled
+            if distance_difference <= -MINIMAL_DISTANCE_DIFFERENCE:
+                if duration <= (
+                    (other.ar_ts - other.dp_ts) * EXTRA_DURATION_FOR_SHORTER_ROUTE
+                ):
+                    continue
+            elif distance_difference >= MINIMAL_DISTANCE_DIFFERENCE:
+                return False
+            if (
+                ar_ts > other.ar_ts
+                or changeovers > other.changeovers
+                or is_regio < other.is_regio
+                or transfer_time < other.transfer_time_from_delayed_trip
+                or from_failed < other.from_failed_transfer_stop_id
+                or (
+                    dp_ts == other.dp_ts
+                    and last_changeover_duration < other.last_changeover_duration
+                )
+            ):
+                return False
+
+        # Remove reachabilities dominated by the new one
+        i = 0
+        while i < len(self):
+            other = self[i]
+            if (
+                other.ar_ts < ar_ts
+                or other.changeovers < changeovers
+                or other.is_regio > is_regio
+                or other.transfer_time_from_delayed_trip > transfer_time
+                or other.from_failed_transfer_stop_id > from_failed
+            ):
+                i += 1
+                continue
+            distance_difference = other.dist_traveled - dist_traveled
+            if distance_difference <= -MINIMAL_DISTANCE_DIFFERENCE:
+                if (other.ar_ts - other.dp_ts) <= (
+                    duration * EXTRA_DURATION_FOR_SHORTER_ROUTE
+                ):
+                    i += 1
+                    continue
+                distance_worse = False
+            else:
+                distance_worse = distance_difference >= MINIMAL_DISTANCE_DIFFERENCE
+            if (
+                distance_worse
+                or other.ar_ts > ar_ts
+                or other.changeovers > changeovers
+                or other.is_regio < is_regio
+                or other.transfer_time_from_delayed_trip < transfer_time
+                or other.from_failed_transfer_stop_id < from_failed
+                or (
+                    other.dp_ts == dp_ts
+                    and other.last_changeover_duration < last_changeover_duration
+                )
+            ):
+                del self[i]
+            else:
+                i += 1
+        self.append(reachability)
+        return True
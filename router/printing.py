@@ -1,10 +1,9 @@
 from datetime import datetime
 from itertools import pairwise
 
-from gtfs.routes import Routes
 from gtfs.stops import StopSteffen
 from router.constants import WALKING_TRIP_ID
-from router.datatypes import Connection, Reachability
+from router.datatypes import Connection, Reachability, Route
 
 
 def human_readable_reachability(reachability: Reachability, stop_steffen: StopSteffen):
@@ -25,7 +24,7 @@ def human_readable_reachability(reachability: Reachability, stop_steffen: StopSt
 
 
 def journey_to_str(
-    journey: list[Connection], stop_steffen: StopSteffen, routes: dict[int, Routes]
+    journey: list[Connection], stop_steffen: StopSteffen, routes: dict[int, Route]
 ):
     dp_ts = datetime.fromtimestamp(
         journey[0].dp_ts
@@ -37,7 +36,9 @@ def journey_to_str(
 
     journey_str = f'{dp_ts.strftime("%H:%M")} - '
     journey_str += f'{ar_ts.strftime("%H:%M")} '
-    journey_str += f'({duration//60:n}min, {dist_traveled//1000:n}km, r:{is_regio}): '
+    journey_str += (
+        f'({duration // 60:n}min, {dist_traveled // 1000:n}km, r:{is_regio}): '
+    )
     journey_str += f'{stop_steffen.get_name(journey[0].dp_stop_id)} '
 
     last_dp_ts = journey[0].dp_ts
@@ -82,7 +83,7 @@ def journey_to_str(
 def print_journeys(
     journeys: list[list[Connection]],
     stop_steffen: StopSteffen,
-    routes: dict[int, Routes],
+    routes: dict[int, Route],
 ):
     for journey in journeys:
         print(journey_to_str(journey, stop_steffen, routes=routes))
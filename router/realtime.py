@@ -0,0 +1,99 @@
+import json
+import time
+
+from redis import Redis
+from sqlalchemy.orm import Session as SessionType
+from sqlalchemy.orm import sessionmaker
+
+import database.unparsed as unparsed
+from api.iris import EventStatus, TimetableStop, db_to_utc
+from database.plan_by_id_v2 import PlanByIdV2
+from database.unique_change import UniqueChange
+from helpers.batcher import batcher
+from helpers.hash64 import xxhash64
+from helpers.logger import logging
+from router.datatypes import StopEventChange
+from router.timetable import CANCELLED_TS, TimetableStore
+
+# Changes of the last hours are applied when following the stream starts
+REALTIME_LOOKBACK_HOURS = 6
+REALTIME_POLL_SECONDS = 30
+CHANGES_CHUNK_SIZE = 10_000
+
+
+def event_ts(event: dict | None, planned_ts: int | None) -> int | None:
+    """Real-time time of an event of a change. CANCELLED_TS if the event is
+    cancelled and the planned time if the change does not change the time."""
+    if event is None or planned_ts is None:
+        return None
+    if event.get('cs') == EventStatus.CANCELLED.value:
+        return CANCELLED_TS
+    if 'ct' in event:
+        return int(db_to_utc(event['ct']).timestamp())
+    return planned_ts
+
+
+def stop_event_change(plan: PlanByIdV2, change: dict) -> StopEventChange:
+    stop = TimetableStop(json.loads(plan.plan))
+    planned_ar_ts = (
+        int(stop.arrival.planned_time.timestamp()) if stop.arrival is not None else None
+    )
+    planned_dp_ts = (
+        int(stop.departure.planned_time.timestamp())
+        if stop.departure is not None
+        else None
+    )
+    return StopEventChange(
+        # Same trip id as in parser.to_gtfs_static
+        trip_id=xxhash64(str(stop.trip_id) + '_' + stop.date_id.isoformat()),
+        stop_id=plan.stop_id,
+        planned_ar_ts=planned_ar_ts,
+        planned_dp_ts=planned_dp_ts,
+        ar_ts=event_ts(change['ar'][0] if 'ar' in change else None, planned_ar_ts),
+        dp_ts=event_ts(change['dp'][0] if 'dp' in change else None, planned_dp_ts),
+    )
+
+
+def get_changes(session: SessionType, hash_ids: list[int]) -> list[StopEventChange]:
+    """Latest changes of the stops with the hash_ids, combined with their plans"""
+    stop_event_changes = []
+    for hash_ids_chunk in batcher(hash_ids, CHANGES_CHUNK_SIZE):
+        changes = UniqueChange.get_latest(session, hash_ids_chunk)
+        for plan in PlanByIdV2.get_stops_from_hash_ids(session, list(changes)):
+            try:
+                stop_event_changes.append(
+                    stop_event_change(plan, changes[plan.hash_id])
+                )
+            except NotImplementedError:
+                # Stops the parser can not handle are not in the timetable either
+                continue
+    return stop_event_changes
+
+
+def stream_id(ts: float) -> bytes:
+    """Id of a redis stream entry added at ts"""
+    return f'{int(ts * 1000)}-0'.encode()
+
+
+def follow_changes(store: TimetableStore, redis_client: Redis, Session: sessionmaker):
+    """Apply the changes of the unparsed_change stream to the timetables of the
+    store as the crawler adds them. Starts with the changes of the last
+    REALTIME_LOOKBACK_HOURS and runs forever."""
+    last_stream_id = stream_id(time.time() - REALTIME_LOOKBACK_HOURS * 3600)
+    while True:
+        try:
+            last_stream_id, hash_ids = unparsed.get_change(redis_client, last_stream_id)
+            if not hash_ids:
+                time.sleep(REALTIME_POLL_SECONDS)
+                continue
+            with Session() as session:
+                changes = get_changes(session, hash_ids)
+            start = time.perf_counter()
+            store.apply_changes(changes)
+            logging.info(
+                f'Applied {len(changes)} real-time changes in'
+                f' {(time.perf_counter() - start) * 1000:.0f} ms'
+            )
+        except Exception:
+            logging.exception('Applying real-time changes failed')
+            time.sleep(REALTIME_POLL_SECONDS)
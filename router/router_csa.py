@@ -1,284 +1,301 @@
-from dataclasses import dataclass
-from datetime import datetime, timedelta
-from itertools import pairwise
-
-import sqlalchemy
+import concurrent.futures
+import enum
+import multiprocessing as mp
+import os
+import threading
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+from itertools import pairwise, repeat
+
+import numpy as np
+from redis import Redis
 from sqlalchemy.orm import Session as SessionType
 
+from config import redis_url
 from database.engine import sessionfactory
-from gtfs.connections import Connections as DBConnections
-from gtfs.routes import Routes
-from gtfs.stops import StopSteffen
-from gtfs.transfers import Transfer, get_transfers
-from gtfs.trips import Trips
+from gtfs.stops import LocationType, Stops, StopSteffen, haversine_distances
+from gtfs.transfers import (
+    MAX_WALKING_DISTANCE_M,
+    WALKING_SPEED_M_S,
+    Transfer,
+    get_transfers,
+)
+from helpers.logger import logging
 from router.constants import (
     ADDITIONAL_SEARCH_WINDOW_HOURS,
+    DESTINATION_LOCATION_STOP_ID,
     MAX_EXPECTED_DELAY_SECONDS,
     MAX_METERS_DRIVING_AWAY,
     MAX_SEARCH_WINDOW_HOURS,
+    MAX_TRANSFERS,
     MINIMUM_TRANSFER_TIME,
+    N_ARRIVAL_SEARCHES,
+    N_CACHED_HEURISTICS,
+    N_CACHED_PROFILES,
+    N_CACHED_RESULTS,
     N_ROUTES_TO_FIND,
     NO_DELAYED_TRIP_ID,
     NO_STOP_ID,
     NO_TRIP_ID,
+    ORIGIN_LOCATION_STOP_ID,
+    PROFILE_PAGE_HOURS,
+    PROFILE_WINDOW_HOURS,
     STANDART_SEARCH_WINDOW_HOURS,
     WALK_FROM_ORIGIN_TRIP_ID,
     WALKING_TRIP_ID,
 )
-from router.datatypes import Changeover, Connection, Reachability
+from router.datatypes import (
+    Changeover,
+    Connection,
+    ConnectionFilter,
+    Location,
+    Reachability,
+)
 from router.exceptions import NoRouteFound, NoTimetableFound
+from router.fptf import FPTFEncoder
 from router.journey_reconstruction import (
-    FPTFJourney,
-    FPTFJourneyAndAlternatives,
     clean_alternatives,
     extract_journeys,
     remove_duplicate_journeys,
 )
-from router.pareto import relaxed_alternative_pareto_dominated, relaxed_pareto_dominated
+from router.labels import LabelContainers, LabelPool
+from router.landmarks import LANDMARKS_PATH, Landmarks
+from router.pareto import ParetoBag
+from router.realtime import follow_changes
+from router.timetable import Timetable, TimetableStore
 
 # TODO:
 # - sort out splitting and merging trains
 
-
-def _get_routes_from_db(
-    trip_ids: list[int], session: SessionType
-) -> list[tuple[Routes, int]]:
-    stmt = (
-        sqlalchemy.select(Routes, Trips.trip_id)
-        .join(Trips, Routes.route_id == Trips.route_id)
-        .where(Trips.trip_id.in_(trip_ids))
-    )
-
-    return session.execute(stmt).all()
-
-
-def get_routes(trip_ids: list[int], session: SessionType) -> dict[int, Routes]:
-    routes = _get_routes_from_db(trip_ids, session)
-
-    routes = {trip_id: route for route, trip_id in routes}
-
-    return routes
+# Arrival time of unreachable destinations in the profile search
+INFINITE_TS = 2**62
 
 
 def create_reachability(
-    connection: Connection,
+    pool: LabelPool,
+    dp_ts: int,
+    ar_ts: int,
+    dp_stop_id: int,
+    trip_id: int,
+    is_regio: int,
+    dist_traveled: int,
     previous: Reachability,
     transfer_time_from_delayed_trip: int,
     min_heuristic: int,
-    r_ident_id: int,
-):
+) -> Reachability:
     if previous.current_trip_id == NO_TRIP_ID:
-        dp_ts = connection.dp_ts
+        origin_dp_ts = dp_ts
     elif previous.current_trip_id == WALK_FROM_ORIGIN_TRIP_ID:
         # If the previous trip was a walk from the origin, it is possible to depart
         # later at the origin, so that the connection is just reachable.
         walk_duration = previous.ar_ts - previous.dp_ts
-        dp_ts = connection.dp_ts - walk_duration - MINIMUM_TRANSFER_TIME
+        origin_dp_ts = dp_ts - walk_duration - MINIMUM_TRANSFER_TIME
     else:
-        dp_ts = previous.dp_ts
-    return Reachability(
-        ar_ts=connection.ar_ts,
-        dp_ts=dp_ts,
-        current_trip_id=connection.trip_id,
-        changeovers=(
-            previous.changeovers
-            if previous.current_trip_id == NO_TRIP_ID
-            or previous.current_trip_id == WALK_FROM_ORIGIN_TRIP_ID
-            else previous.changeovers + 1
-        ),
-        dist_traveled=previous.dist_traveled + connection.dist_traveled,
-        is_regio=min(previous.is_regio, connection.is_regio),
-        transfer_time_from_delayed_trip=transfer_time_from_delayed_trip,
-        from_failed_transfer_stop_id=previous.from_failed_transfer_stop_id,
-        min_heuristic=min_heuristic,
-        r_ident_id=r_ident_id,
-        last_r_ident_id=previous.r_ident_id,
-        last_stop_id=connection.dp_stop_id,
-        last_dp_ts=connection.dp_ts,
-        walk_from_delayed_trip=False,
-        last_changeover_duration=connection.dp_ts - previous.ar_ts,
+        origin_dp_ts = previous.dp_ts
+    reachability = pool.new()
+    reachability.ar_ts = ar_ts
+    reachability.dp_ts = origin_dp_ts
+    reachability.current_trip_id = trip_id
+    reachability.changeovers = (
+        previous.changeovers
+        if previous.current_trip_id == NO_TRIP_ID
+        or previous.current_trip_id == WALK_FROM_ORIGIN_TRIP_ID
+        else previous.changeovers + 1
     )
+    reachability.dist_traveled = previous.dist_traveled + dist_traveled
+    reachability.is_regio = min(previous.is_regio, is_regio)
+    reachability.transfer_time_from_delayed_trip = transfer_time_from_delayed_trip
+    reachability.from_failed_transfer_stop_id = previous.from_failed_transfer_stop_id
+    reachability.min_heuristic = min_heuristic
+    reachability.last_r_ident_id = previous.r_ident_id
+    reachability.last_stop_id = dp_stop_id
+    reachability.last_dp_ts = dp_ts
+    reachability.walk_from_delayed_trip = False
+    reachability.last_changeover_duration = dp_ts - previous.ar_ts
+    return reachability
 
 
 def add_transfer_to_reachability(
+    pool: LabelPool,
     reachability: Reachability,
     transfer: Transfer,
     from_delayed,
     heuristic: int,
-    r_ident_id: int,
-):
-    return Reachability(
-        ar_ts=reachability.ar_ts + transfer.duration,
-        dp_ts=reachability.dp_ts,
-        current_trip_id=(
-            WALK_FROM_ORIGIN_TRIP_ID
-            if reachability.current_trip_id == NO_TRIP_ID
-            else WALKING_TRIP_ID
-        ),
-        changeovers=reachability.changeovers,
-        dist_traveled=reachability.dist_traveled + transfer.distance,
-        is_regio=reachability.is_regio,
-        transfer_time_from_delayed_trip=reachability.transfer_time_from_delayed_trip,  # TODO
-        from_failed_transfer_stop_id=reachability.from_failed_transfer_stop_id,
-        min_heuristic=min(heuristic, reachability.min_heuristic),
-        r_ident_id=r_ident_id,
-        last_r_ident_id=reachability.r_ident_id,
-        last_stop_id=transfer.from_stop,
-        last_dp_ts=reachability.ar_ts,
-        walk_from_delayed_trip=from_delayed,
-        last_changeover_duration=reachability.last_changeover_duration,
+) -> Reachability:
+    walk = pool.copy(reachability)
+    walk.ar_ts = reachability.ar_ts + transfer.duration
+    walk.current_trip_id = (
+        WALK_FROM_ORIGIN_TRIP_ID
+        if reachability.current_trip_id == NO_TRIP_ID
+        else WALKING_TRIP_ID
     )
+    walk.dist_traveled = reachability.dist_traveled + transfer.distance
+    # TODO: transfer_time_from_delayed_trip
+    walk.min_heuristic = min(heuristic, reachability.min_heuristic)
+    walk.last_r_ident_id = reachability.r_ident_id
+    walk.last_stop_id = transfer.from_stop
+    walk.last_dp_ts = reachability.ar_ts
+    walk.walk_from_delayed_trip = from_delayed
+    return walk
 
 
 def add_connection_to_trip_reachability(
-    reachability: Reachability, connection: Connection, heuristic: int
+    reachability: Reachability, ar_ts: int, dist_traveled: int, heuristic: int
 ):
-    return Reachability(
-        ar_ts=connection.ar_ts,
-        dp_ts=reachability.dp_ts,
-        current_trip_id=reachability.current_trip_id,
-        changeovers=reachability.changeovers,
-        dist_traveled=reachability.dist_traveled + connection.dist_traveled,
-        is_regio=reachability.is_regio,
-        transfer_time_from_delayed_trip=reachability.transfer_time_from_delayed_trip,
-        from_failed_transfer_stop_id=reachability.from_failed_transfer_stop_id,
-        min_heuristic=min(heuristic, reachability.min_heuristic),
-        r_ident_id=reachability.r_ident_id,
-        last_r_ident_id=reachability.last_r_ident_id,
-        last_stop_id=reachability.last_stop_id,
-        last_dp_ts=reachability.last_dp_ts,
-        walk_from_delayed_trip=False,
-        last_changeover_duration=reachability.last_changeover_duration,
-    )
+    # Trip reachabilities are owned by the trip container, so they are updated
+    # in place
+    reachability.ar_ts = ar_ts
+    reachability.dist_traveled += dist_traveled
+    if heuristic < reachability.min_heuristic:
+        reachability.min_heuristic = heuristic
+    reachability.walk_from_delayed_trip = False
 
 
 def reachability_from_trip_reachability(
+    pool: LabelPool,
     reachability: Reachability,
-    r_ident_id: int,
-):
-    return Reachability(
-        ar_ts=reachability.ar_ts,
-        dp_ts=reachability.dp_ts,
-        current_trip_id=reachability.current_trip_id,
-        changeovers=reachability.changeovers,
-        dist_traveled=reachability.dist_traveled,
-        is_regio=reachability.is_regio,
-        transfer_time_from_delayed_trip=reachability.transfer_time_from_delayed_trip,
-        from_failed_transfer_stop_id=reachability.from_failed_transfer_stop_id,
-        min_heuristic=reachability.min_heuristic,
-        r_ident_id=r_ident_id,
-        last_r_ident_id=reachability.last_r_ident_id,
-        last_stop_id=reachability.last_stop_id,
-        last_dp_ts=reachability.last_dp_ts,
-        walk_from_delayed_trip=False,
-        last_changeover_duration=reachability.last_changeover_duration,
-    )
+) -> Reachability:
+    new_reachability = pool.copy(reachability)
+    new_reachability.walk_from_delayed_trip = False
+    return new_reachability
 
 
-def add_reachability_to_pareto(
-    reachability: Reachability,
-    pareto_set: list[Reachability],
-    is_alternative: bool,
-):
-    was_appended = False
-    if is_alternative:
-        # Using reversed speeds up the algo by a lot, as reachabilities are kind of
-        # sorted by departure time. It is more likely for a reachability to be dominated
-        # by a reachability that departs later.
-        for other in reversed(pareto_set):
-            if relaxed_alternative_pareto_dominated(reachability, other):
-                break
-        else:
-            pareto_set = [
-                p
-                for p in pareto_set
-                if not relaxed_alternative_pareto_dominated(p, reachability)
-            ]
-            pareto_set.append(reachability)
-            was_appended = True
-    else:
-        was_dominated = False
-        for other in reversed(pareto_set):
-            if relaxed_pareto_dominated(reachability, other):
-                was_dominated = True
-                break
-            if other.dp_ts < reachability.dp_ts:
-                break
-        if not was_dominated:
-            pareto_set = [
-                p
-                for p in pareto_set
-                if p.ar_ts < reachability.ar_ts
-                or not relaxed_pareto_dominated(p, reachability)
-            ]
-            pareto_set.append(reachability)
-            pareto_set = sorted(pareto_set, key=lambda r: r.dp_ts)
-            was_appended = True
-    return pareto_set, was_appended
+class Pruning(enum.Enum):
+    # Prune labels that got further away from the destination than
+    # MAX_METERS_DRIVING_AWAY on the way
+    DISTANCE = 'distance'
+    # Skip connections that cannot reach the destination before the journeys
+    # found so far, by the landmark lower bounds of the travel time
+    LANDMARKS = 'landmarks'
+    DISTANCE_AND_LANDMARKS = 'distance_and_landmarks'
+
+
+@dataclass
+class ScanStats:
+    scanned_connections: int = 0
+    pruned_connections: int = 0
 
 
 def csa(
-    connections: list[Connection],
-    stops: dict[int, list[Reachability]],
-    trips: dict[int, list[Reachability]],
-    transfers: dict[int, list[Transfer]],
-    heuristics: dict[int, int],
+    timetable: Timetable,
+    start_index: int,
+    end_index: int,
+    labels: LabelContainers,
+    transfers: list[list[Transfer]],
+    heuristics: list[int],
+    lower_bounds: list[int],
     delayed_trip_id: int,
     min_delay: int,
     destination_stop_id: int,
     search_alternatives: bool,
-    r_ident_id: int,
     early_stopping_ts: int,
+    stats: ScanStats,
 ):
-    for connection in connections:
+    # All stop and trip ids in here are dense indices, see Timetable.build_index
+    stops = labels.stops
+    pool = labels.pool
+    trips = labels.trips
+    touched_stops = labels.touched_stops
+    touched_trips = labels.touched_trips
+    add_to_pareto = ParetoBag.add_alternative if search_alternatives else ParetoBag.add
+    # Arrival at the destination after which connections are skipped. Only set
+    # once the arrivals found fix the result, see below.
+    pruning_ts = INFINITE_TS
+    n_pruned = 0
+    last_dp_ts = timetable[end_index - 1].dp_ts if end_index > start_index else 0
+
+    # Convert the scanned window to python lists once, as element-wise access to
+    # numpy arrays is slow in python loops.
+    window = zip(
+        *(
+            column.tolist()
+            for column in timetable.columns(
+                start_index,
+                end_index,
+                'dp_ts',
+                'ar_ts',
+                'dp_stop',
+                'ar_stop',
+                'trip',
+                'is_regio',
+                'dist_traveled',
+            )
+        )
+    )
+    for n_scanned, (
+        dp_ts,
+        ar_ts,
+        dp_stop_id,
+        ar_stop_id,
+        trip_id,
+        is_regio,
+        dist_traveled,
+    ) in enumerate(window):
         # Early stopping criteria
-        if connection.dp_ts > early_stopping_ts:
-            return stops, True, early_stopping_ts, r_ident_id
+        if dp_ts > early_stopping_ts:
+            stats.scanned_connections += n_scanned
+            stats.pruned_connections += n_pruned
+            return stops, True, early_stopping_ts
+
+        # Journeys using the connection cannot arrive before pruning_ts. The
+        # lower bounds never decrease along a trip faster than it travels, so
+        # the rest of the trip is skipped as well.
+        if ar_ts + lower_bounds[ar_stop_id] > pruning_ts:
+            n_pruned += 1
+            if trips[trip_id] is not None:
+                trips[trip_id].clear()
+            continue
 
         new_reachabilities: list[Reachability] = []
+        heuristic = heuristics[ar_stop_id]
 
         # Was the trip reached already?
-        if connection.trip_id in trips:
+        trip_reachabilities = trips[trip_id]
+        if trip_reachabilities is not None:
             # Update trip reachabilities with additional arrival time and distance traveled
-            trips[connection.trip_id] = [
+            if any(
+                (heuristic - MAX_METERS_DRIVING_AWAY) > trip_reachability.min_heuristic
+                for trip_reachability in trip_reachabilities
+            ):
+                trip_reachabilities[:] = [
+                    trip_reachability
+                    for trip_reachability in trip_reachabilities
+                    if not (heuristic - MAX_METERS_DRIVING_AWAY)
+                    > trip_reachability.min_heuristic
+                ]
+
+            for trip_reachability in trip_reachabilities:
                 add_connection_to_trip_reachability(
-                    trip, connection, heuristics[connection.ar_stop_id]
+                    trip_reachability, ar_ts, dist_traveled, heuristic
                 )
-                for trip in trips[connection.trip_id]
-                if not (heuristics[connection.ar_stop_id] - MAX_METERS_DRIVING_AWAY)
-                > trip.min_heuristic
-            ]
-
-            for trip_reachability in trips[connection.trip_id]:
                 new_reachabilities.append(
-                    reachability_from_trip_reachability(
-                        trip_reachability,
-                        r_ident_id,
-                    )
+                    reachability_from_trip_reachability(pool, trip_reachability)
                 )
-                r_ident_id += 1
 
-        for previous in stops[connection.dp_stop_id]:
-            is_same_trip = connection.trip_id == previous.current_trip_id
+        for previous in stops[dp_stop_id]:
+            is_same_trip = trip_id == previous.current_trip_id
             # The previous trip is delayed, so we can only take the connection if there is
             # enough transfer time (at least min_delay)
             is_delayed = previous.current_trip_id == delayed_trip_id
             enough_transfer_time = (
-                connection.dp_ts >= (previous.ar_ts + min_delay + MINIMUM_TRANSFER_TIME)
+                dp_ts >= (previous.ar_ts + min_delay + MINIMUM_TRANSFER_TIME)
                 if is_delayed
-                else connection.dp_ts >= previous.ar_ts + MINIMUM_TRANSFER_TIME
+                else dp_ts >= previous.ar_ts + MINIMUM_TRANSFER_TIME
             )
             # Connection is reachable if there is enough transfer time. If it is the same trip,
             # it was already handled in the trip reachability update.
             if enough_transfer_time and not is_same_trip:
-                if (
-                    heuristics[connection.ar_stop_id] - MAX_METERS_DRIVING_AWAY
-                ) > previous.min_heuristic:
+                if (heuristic - MAX_METERS_DRIVING_AWAY) > previous.min_heuristic:
                     continue
 
                 transfer_time_from_delayed_trip = (
                     min(
-                        connection.dp_ts - previous.ar_ts,
+                        dp_ts - previous.ar_ts,
                         MAX_EXPECTED_DELAY_SECONDS,
                     )
                     if (is_delayed and previous.from_failed_transfer_stop_id)
@@ -287,34 +304,37 @@ def csa(
                 )
 
                 reachability = create_reachability(
-                    connection=connection,
+                    pool=pool,
+                    dp_ts=dp_ts,
+                    ar_ts=ar_ts,
+                    dp_stop_id=dp_stop_id,
+                    trip_id=trip_id,
+                    is_regio=is_regio,
+                    dist_traveled=dist_traveled,
                     previous=previous,
                     transfer_time_from_delayed_trip=transfer_time_from_delayed_trip,
-                    min_heuristic=min(
-                        previous.min_heuristic, heuristics[connection.ar_stop_id]
-                    ),
-                    r_ident_id=r_ident_id,
+                    min_heuristic=min(previous.min_heuristic, heuristic),
                 )
                 new_reachabilities.append(reachability)
 
-                r_ident_id += 1
-
-                trips[connection.trip_id], _ = add_reachability_to_pareto(
-                    reachability,
-                    trips.get(connection.trip_id, []),
-                    is_alternative=search_alternatives,
-                )
+                if trips[trip_id] is None:
+                    touched_trips.append(trip_id)
+                    trips[trip_id] = ParetoBag()
+                # The trip gets its own copy, as it is updated in place
+                add_to_pareto(trips[trip_id], pool.copy(reachability))
 
+        # Destinations given as locations are only reached by walking
+        reached_destination = ar_stop_id == destination_stop_id and bool(
+            new_reachabilities
+        )
         for reachability in new_reachabilities:
-            stops[connection.ar_stop_id], was_added = add_reachability_to_pareto(
-                reachability,
-                stops[connection.ar_stop_id],
-                is_alternative=search_alternatives,
-            )
+            if not stops[ar_stop_id]:
+                touched_stops.append(ar_stop_id)
             # Relax walking segments here if reachability was added
-            if was_added and connection.ar_stop_id in transfers:
-                for transfer in transfers[connection.ar_stop_id]:
+            if add_to_pareto(stops[ar_stop_id], reachability):
+                for transfer in transfers[ar_stop_id]:
                     walk = add_transfer_to_reachability(
+                        pool=pool,
                         reachability=reachability,
                         transfer=transfer,
                         from_delayed=int(
@@ -322,16 +342,16 @@ def csa(
                             and reachability.from_failed_transfer_stop_id
                         ),
                         heuristic=heuristics[transfer.to_stop],
-                        r_ident_id=r_ident_id,
-                    )
-                    r_ident_id += 1
-                    stops[transfer.to_stop], _ = add_reachability_to_pareto(
-                        walk,
-                        stops[transfer.to_stop],
-                        is_alternative=search_alternatives,
                     )
-
-        if connection.ar_stop_id == destination_stop_id and len(new_reachabilities):
+                    if not stops[transfer.to_stop]:
+                        touched_stops.append(transfer.to_stop)
+                    if (
+                        add_to_pareto(stops[transfer.to_stop], walk)
+                        and transfer.to_stop == destination_stop_id
+                    ):
+                        reached_destination = True
+
+        if reached_destination:
             # Generate stopping condition for early stopping
             if search_alternatives:
                 # If a route to the destination was found that has as much transfer time
@@ -351,184 +371,1330 @@ def csa(
                     early_stopping_ts = list(
                         sorted(r.ar_ts for r in stops[destination_stop_id])
                     )[N_ROUTES_TO_FIND - 1]
+                    # Arrivals after early_stopping_ts are filtered out of the
+                    # result. It never increases again, unless the search window
+                    # is extended, which it is not once the search stops within it.
+                    if early_stopping_ts < last_dp_ts:
+                        pruning_ts = early_stopping_ts
+
+    stats.scanned_connections += end_index - start_index
+    stats.pruned_connections += n_pruned
+    return stops, False, early_stopping_ts
+
+
+def index_transfers(
+    transfers: dict[int, list[Transfer]], station_index: dict[int, int]
+) -> list[list[Transfer]]:
+    """Transfers from each station by dense station index, with from_stop and
+    to_stop being dense station indices as well"""
+    indexed_transfers: list[list[Transfer]] = [[] for _ in range(len(station_index))]
+    for from_stop_id, transfers_from_stop in transfers.items():
+        if from_stop_id not in station_index:
+            continue
+        for transfer in transfers_from_stop:
+            if transfer.to_stop not in station_index:
+                continue
+            indexed_transfers[station_index[from_stop_id]].append(
+                transfer._replace(
+                    from_stop=station_index[from_stop_id],
+                    to_stop=station_index[transfer.to_stop],
+                )
+            )
+    return indexed_transfers
+
+
+class StopProfile:
+    """Profile of a stop in the profile search.
 
-    return stops, False, early_stopping_ts, r_ident_id
+    For decreasing keys, the latest time to be at the stop, the earliest arrival
+    at the destination for each number of changeovers after boarding the first
+    trip. Entries are added in order of decreasing keys and the arrivals are
+    prefix minima, so the entry with the smallest key at or after a time is the
+    best one that can be used at that time.
+    """
+
+    __slots__ = ('neg_keys', 'arrivals', 'pointers')
+
+    def __init__(self):
+        # Negated keys, so that they are ascending for bisect
+        self.neg_keys: list[int] = []
+        self.arrivals: list[tuple[int, ...]] = []
+        # (boarding connection index, exit connection index) per number of changeovers
+        self.pointers: list[tuple[tuple[int, int], ...]] = []
+
+    def at(self, ts: int) -> int:
+        """Index of the best entry that can be used at ts, -1 if there is none"""
+        return bisect_right(self.neg_keys, -ts) - 1
+
+    def add(
+        self,
+        key: int,
+        arrivals: list[int],
+        pointers: list[tuple[int, int]],
+    ):
+        if not self.arrivals:
+            self.neg_keys.append(-key)
+            self.arrivals.append(tuple(arrivals))
+            self.pointers.append(tuple(pointers))
+            return
+
+        last_arrivals = self.arrivals[-1]
+        last_pointers = self.pointers[-1]
+        improved = False
+        for k in range(len(arrivals)):
+            if arrivals[k] < last_arrivals[k]:
+                improved = True
+            else:
+                arrivals[k] = last_arrivals[k]
+                pointers[k] = last_pointers[k]
+        if not improved:
+            return
+        if self.neg_keys[-1] == -key:
+            self.arrivals[-1] = tuple(arrivals)
+            self.pointers[-1] = tuple(pointers)
+        else:
+            self.neg_keys.append(-key)
+            self.arrivals.append(tuple(arrivals))
+            self.pointers.append(tuple(pointers))
+
+
+def profile_csa(
+    timetable: Timetable,
+    start_index: int,
+    end_index: int,
+    destination_stop_id: int,
+    transfers: list[list[Transfer]],
+    walks_to_destination: dict[int, Transfer],
+    max_changeovers: int,
+) -> list[StopProfile | None]:
+    """Reverse connection scan computing the profile of every stop to the
+    destination, for up to max_changeovers changeovers."""
+    n = max_changeovers + 1
+    stop_profiles: list[StopProfile | None] = [None] * len(transfers)
+    trip_arrivals: list[tuple[int, ...] | None] = [None] * timetable.n_trips
+    trip_exits: list[tuple[int, ...] | None] = [None] * timetable.n_trips
+
+    window = zip(
+        range(end_index - 1, start_index - 1, -1),
+        *(
+            column[::-1].tolist()
+            for column in timetable.columns(
+                start_index, end_index, 'dp_ts', 'ar_ts', 'dp_stop', 'ar_stop', 'trip'
+            )
+        ),
+    )
+    for i, dp_ts, ar_ts, dp_stop_id, ar_stop_id, trip_id in window:
+        # Arrival at the destination when exiting the trip here
+        if ar_stop_id == destination_stop_id:
+            exit_arrival = ar_ts
+        elif ar_stop_id in walks_to_destination:
+            exit_arrival = ar_ts + walks_to_destination[ar_stop_id].duration
+        else:
+            exit_arrival = INFINITE_TS
+
+        # Arrival at the destination when changing trips at ar_stop_id, possibly
+        # after walking to another stop
+        changing = None
+        profile = stop_profiles[ar_stop_id]
+        if profile is not None:
+            j = profile.at(ar_ts)
+            if j >= 0:
+                changing = profile.arrivals[j]
+        for transfer in transfers[ar_stop_id]:
+            profile = stop_profiles[transfer.to_stop]
+            if profile is not None:
+                j = profile.at(ar_ts + transfer.duration)
+                if j >= 0:
+                    if changing is None:
+                        changing = profile.arrivals[j]
+                    else:
+                        changing = tuple(map(min, changing, profile.arrivals[j]))
+
+        in_trip = trip_arrivals[trip_id]
+        if exit_arrival == INFINITE_TS and in_trip is None and changing is None:
+            continue
+
+        arrivals = [exit_arrival] * n
+        exits = [i] * n
+        if in_trip is not None:
+            in_trip_exits = trip_exits[trip_id]
+            for k in range(n):
+                if in_trip[k] < arrivals[k]:
+                    arrivals[k] = in_trip[k]
+                    exits[k] = in_trip_exits[k]
+        if changing is not None:
+            for k in range(1, n):
+                if changing[k - 1] < arrivals[k]:
+                    arrivals[k] = changing[k - 1]
+                    exits[k] = i
+        # Arrivals do not increase with the number of changeovers
+        if arrivals[-1] == INFINITE_TS:
+            continue
+
+        trip_arrivals[trip_id] = tuple(arrivals)
+        trip_exits[trip_id] = tuple(exits)
+
+        if stop_profiles[dp_stop_id] is None:
+            stop_profiles[dp_stop_id] = StopProfile()
+        stop_profiles[dp_stop_id].add(
+            dp_ts - MINIMUM_TRANSFER_TIME,
+            arrivals,
+            [(i, exit_index) for exit_index in exits],
+        )
+
+    return stop_profiles
+
+
+def walking_connection(dp_ts: int, ar_ts: int, transfer: Transfer) -> Connection:
+    return Connection(
+        dp_ts=dp_ts,
+        ar_ts=ar_ts,
+        dp_stop_id=transfer.from_stop,
+        ar_stop_id=transfer.to_stop,
+        trip_id=WALKING_TRIP_ID,
+        is_regio=True,
+        dist_traveled=transfer.distance,
+        dp_platform_id=transfer.from_stop,
+        ar_platform_id=transfer.to_stop,
+    )
+
+
+def extract_profile_journey(
+    timetable: Timetable,
+    stop_profiles: list[StopProfile | None],
+    transfers: list[list[Transfer]],
+    destination_stop_id: int,
+    walks_to_destination: dict[int, Transfer],
+    pointer: tuple[int, int],
+    changeovers: int,
+    arrival: int,
+) -> list[Connection]:
+    """Follow the pointers of the profile from boarding a trip with changeovers
+    changeovers left to the arrival at the destination"""
+    journey: list[Connection] = []
+    while True:
+        board_index, exit_index = pointer
+        positions = timetable.trip_rows(timetable[board_index].trip_id)
+        first = np.searchsorted(positions, board_index)
+        last = np.searchsorted(positions, exit_index)
+        journey.extend(timetable[int(p)] for p in positions[first : last + 1])
+
+        exit_connection = journey[-1]
+        stop = exit_connection.ar_stop_id
+        ar_ts = exit_connection.ar_ts
+        if stop == destination_stop_id and ar_ts == arrival:
+            return journey
+        walk = walks_to_destination.get(stop)
+        if walk is not None and ar_ts + walk.duration == arrival:
+            journey.append(walking_connection(ar_ts, ar_ts + walk.duration, walk))
+            return journey
+
+        changeovers -= 1
+        options = [(stop, ar_ts, None)] + [
+            (transfer.to_stop, ar_ts + transfer.duration, transfer)
+            for transfer in transfers[stop]
+        ]
+        for next_stop, ts, transfer in options:
+            profile = stop_profiles[next_stop]
+            if profile is None:
+                continue
+            j = profile.at(ts)
+            if j >= 0 and profile.arrivals[j][changeovers] == arrival:
+                if transfer is not None:
+                    journey.append(walking_connection(ar_ts, ts, transfer))
+                pointer = profile.pointers[j][changeovers]
+                break
+        else:
+            raise ValueError('Profile does not contain a continuation of the journey')
+
+
+def backward_csa(
+    timetable: Timetable,
+    positions: np.ndarray,
+    destination_stop_id: int,
+    arrival_deadline: int,
+    transfers: list[list[Transfer]],
+    walks_to_destination: dict[int, Transfer],
+    max_changeovers: int,
+) -> tuple[list[list[int] | None], list[list[tuple[int, int]] | None]]:
+    """Connection scan in decreasing ar_ts over the connections at the
+    positions, which are ordered by ar_ts.
+
+    For each stop and number of changeovers after boarding the first trip, the
+    latest time to be at the stop to reach the destination by arrival_deadline,
+    and the (boarding connection index, exit connection index) pointer of the
+    first trip of that journey.
+    """
+    n = max_changeovers + 1
+    latest: list[list[int] | None] = [None] * len(transfers)
+    pointers: list[list[tuple[int, int]] | None] = [None] * len(transfers)
+    trip_exits: list[tuple[int, ...] | None] = [None] * timetable.n_trips
+
+    positions = positions[::-1]
+    window = zip(
+        positions.tolist(),
+        *(
+            column.tolist()
+            for column in timetable.take(
+                positions, 'dp_ts', 'ar_ts', 'dp_stop', 'ar_stop', 'trip'
+            )
+        ),
+    )
+    for i, dp_ts, ar_ts, dp_stop_id, ar_stop_id, trip_id in window:
+        exit_to_destination = ar_stop_id == destination_stop_id or (
+            ar_stop_id in walks_to_destination
+            and ar_ts + walks_to_destination[ar_stop_id].duration <= arrival_deadline
+        )
+        in_trip = trip_exits[trip_id]
+        if exit_to_destination:
+            exits = [i] * n
+        else:
+            exits = list(in_trip) if in_trip is not None else [-1] * n
+            # Changing trips at ar_stop_id, possibly after walking to another stop
+            for k in range(1, n):
+                if exits[k] >= 0:
+                    continue
+                stop_latest = latest[ar_stop_id]
+                if stop_latest is not None and stop_latest[k - 1] >= ar_ts:
+                    exits[k] = i
+                    continue
+                for transfer in transfers[ar_stop_id]:
+                    stop_latest = latest[transfer.to_stop]
+                    if (
+                        stop_latest is not None
+                        and stop_latest[k - 1] >= ar_ts + transfer.duration
+                    ):
+                        exits[k] = i
+                        break
+        # Exits do not get worse with the number of changeovers
+        if exits[-1] < 0:
+            continue
+        trip_exits[trip_id] = tuple(exits)
+
+        key = dp_ts - MINIMUM_TRANSFER_TIME
+        if latest[dp_stop_id] is None:
+            latest[dp_stop_id] = [-INFINITE_TS] * n
+            pointers[dp_stop_id] = [(-1, -1)] * n
+        stop_latest = latest[dp_stop_id]
+        stop_pointers = pointers[dp_stop_id]
+        for k in range(n):
+            if exits[k] >= 0 and key > stop_latest[k]:
+                stop_latest[k] = key
+                stop_pointers[k] = (i, exits[k])
+
+    return latest, pointers
+
+
+def extract_backward_journey(
+    timetable: Timetable,
+    latest: list[list[int] | None],
+    pointers: list[list[tuple[int, int]] | None],
+    transfers: list[list[Transfer]],
+    destination_stop_id: int,
+    arrival_deadline: int,
+    walks_to_destination: dict[int, Transfer],
+    pointer: tuple[int, int],
+    changeovers: int,
+) -> list[Connection]:
+    """Follow the pointers of the backward search from boarding a trip with
+    changeovers changeovers left to the arrival at the destination"""
+    journey: list[Connection] = []
+    while True:
+        board_index, exit_index = pointer
+        positions = timetable.trip_rows(timetable[board_index].trip_id)
+        first = np.searchsorted(positions, board_index)
+        last = np.searchsorted(positions, exit_index)
+        journey.extend(timetable[int(p)] for p in positions[first : last + 1])
+
+        exit_connection = journey[-1]
+        stop = exit_connection.ar_stop_id
+        ar_ts = exit_connection.ar_ts
+        if stop == destination_stop_id:
+            return journey
+        walk = walks_to_destination.get(stop)
+        if walk is not None and ar_ts + walk.duration <= arrival_deadline:
+            journey.append(walking_connection(ar_ts, ar_ts + walk.duration, walk))
+            return journey
+
+        changeovers -= 1
+        options = [(stop, ar_ts, None)] + [
+            (transfer.to_stop, ar_ts + transfer.duration, transfer)
+            for transfer in transfers[stop]
+        ]
+        for next_stop, ts, transfer in options:
+            stop_latest = latest[next_stop]
+            if stop_latest is not None and stop_latest[changeovers] >= ts:
+                if transfer is not None:
+                    journey.append(walking_connection(ar_ts, ts, transfer))
+                pointer = pointers[next_stop][changeovers]
+                break
+        else:
+            raise ValueError('Backward search does not contain a continuation')
+
+
+def backward_journeys(
+    timetable: Timetable,
+    latest: list[list[int] | None],
+    pointers: list[list[tuple[int, int]] | None],
+    transfers: list[list[Transfer]],
+    origin_stop_id: int,
+    destination_stop_id: int,
+    arrival_deadline: int,
+    walks_to_destination: dict[int, Transfer],
+    max_changeovers: int,
+) -> list[list[Connection]]:
+    """The latest departing journey from the origin for each number of
+    changeovers, if it departs later than the ones with fewer changeovers"""
+    starts = [(origin_stop_id, 0, None)] + [
+        (transfer.to_stop, transfer.duration, transfer)
+        for transfer in transfers[origin_stop_id]
+    ]
+    journeys = []
+    best_departure = -INFINITE_TS
+    for k in range(max_changeovers + 1):
+        departure, start = best_departure, None
+        for stop, walk_duration, transfer in starts:
+            if latest[stop] is not None and latest[stop][k] - walk_duration > departure:
+                departure, start = latest[stop][k] - walk_duration, (stop, transfer)
+        if start is None:
+            continue
+        best_departure = departure
+        stop, transfer = start
+        journey = extract_backward_journey(
+            timetable,
+            latest,
+            pointers,
+            transfers,
+            destination_stop_id,
+            arrival_deadline,
+            walks_to_destination,
+            pointer=pointers[stop][k],
+            changeovers=k,
+        )
+        if transfer is not None:
+            walk_ar_ts = journey[0].dp_ts - MINIMUM_TRANSFER_TIME
+            journey.insert(
+                0,
+                walking_connection(
+                    walk_ar_ts - transfer.duration, walk_ar_ts, transfer
+                ),
+            )
+        journeys.append(journey)
+    return journeys
+
+
+def earliest_arrival_csa(
+    timetable: Timetable,
+    start_index: int,
+    end_index: int,
+    origin_stop_id: int,
+    dp_ts: int,
+    transfers: list[list[Transfer]],
+    destination_stop_ids: list[int],
+    max_changeovers: int,
+) -> tuple[list[int], list[int]]:
+    """One-to-all connection scan from the origin at dp_ts. Returns the earliest
+    arrival at each destination and the fewest changeovers to arrive then, or
+    INFINITE_TS and -1 for destinations that are unreachable.
+
+    For each stop and number of trips taken, the earliest arrival at the stop.
+    The scan stops as soon as no later connection can improve any of the
+    destinations.
+    """
+    # Number of trips from 0 (walking only) to max_changeovers + 1
+    n = max_changeovers + 2
+    arrivals: list[list[int] | None] = [None] * len(transfers)
+    # Fewest trips taken when boarding each trip, n if it was not boarded
+    trip_trips = [n] * timetable.n_trips
+    destinations = set(destination_stop_ids)
+    n_unreached = len(destinations)
+    # Latest earliest arrival at any destination
+    stop_scan_ts = INFINITE_TS
+
+    def reach(stop_id: int, k: int, ar_ts: int):
+        nonlocal n_unreached, stop_scan_ts
+        stop_arrivals = arrivals[stop_id]
+        if stop_arrivals is None:
+            stop_arrivals = arrivals[stop_id] = [INFINITE_TS] * n
+        previous_arrival = stop_arrivals[-1]
+        # Arrivals do not increase with the number of trips
+        for j in range(k, n):
+            if ar_ts >= stop_arrivals[j]:
+                break
+            stop_arrivals[j] = ar_ts
+        if stop_id in destinations and stop_arrivals[-1] < previous_arrival:
+            if previous_arrival == INFINITE_TS:
+                n_unreached -= 1
+            if n_unreached == 0 and previous_arrival == stop_scan_ts:
+                stop_scan_ts = max(
+                    arrivals[destination][-1] for destination in destinations
+                )
+
+    reach(origin_stop_id, 0, dp_ts)
+    for transfer in transfers[origin_stop_id]:
+        reach(transfer.to_stop, 0, dp_ts + transfer.duration)
+
+    window = zip(
+        *(
+            column.tolist()
+            for column in timetable.columns(
+                start_index, end_index, 'dp_ts', 'ar_ts', 'dp_stop', 'ar_stop', 'trip'
+            )
+        )
+    )
+    for c_dp_ts, c_ar_ts, dp_stop_id, ar_stop_id, trip_id in window:
+        if c_dp_ts > stop_scan_ts:
+            break
+        k = trip_trips[trip_id]
+        stop_arrivals = arrivals[dp_stop_id]
+        if stop_arrivals is not None:
+            for j in range(k - 1):
+                if stop_arrivals[j] + MINIMUM_TRANSFER_TIME <= c_dp_ts:
+                    k = trip_trips[trip_id] = j + 1
+                    break
+        if k == n:
+            continue
+
+        reach(ar_stop_id, k, c_ar_ts)
+        for transfer in transfers[ar_stop_id]:
+            reach(transfer.to_stop, k, c_ar_ts + transfer.duration)
+
+    earliest_arrivals = []
+    changeovers = []
+    for destination in destination_stop_ids:
+        stop_arrivals = arrivals[destination]
+        if stop_arrivals is None or stop_arrivals[-1] == INFINITE_TS:
+            earliest_arrivals.append(INFINITE_TS)
+            changeovers.append(-1)
+            continue
+        n_trips = stop_arrivals.index(stop_arrivals[-1])
+        earliest_arrivals.append(stop_arrivals[-1])
+        changeovers.append(max(n_trips - 1, 0))
+    return earliest_arrivals, changeovers
+
+
+@dataclass
+class Profile:
+    """Pareto optimal journeys (departure, arrival, changeovers) from origin to
+    destination departing in [from_ts, to_ts)"""
+
+    origin_stop_id: int
+    destination_stop_id: int
+    from_ts: int
+    to_ts: int
+    timetable: Timetable
+    # Latest time to be at the origin for each journey, ascending
+    departures: list[int]
+    # Journeys with dense indices
+    journeys: list[list[Connection]]
+
+    def page(self, from_ts: int, n_journeys: int) -> list[list[Connection]]:
+        """The first n_journeys journeys that can be taken when being at the
+        origin at from_ts"""
+        start = bisect_left(self.departures, from_ts)
+        return self.journeys[start : start + n_journeys]
+
+    def can_answer(self, from_ts: int, to_ts: int, n_journeys: int) -> bool:
+        """Whether the profile covers the departures in [from_ts, to_ts) and
+        has n_journeys journeys from from_ts on"""
+        return (
+            self.from_ts <= from_ts
+            and to_ts <= self.to_ts
+            and len(self.page(from_ts, n_journeys)) == n_journeys
+        )
+
+
+def profile_journeys(
+    timetable: Timetable,
+    stop_profiles: list[StopProfile | None],
+    transfers: list[list[Transfer]],
+    origin_stop_id: int,
+    destination_stop_id: int,
+    walks_to_destination: dict[int, Transfer],
+    from_ts: int,
+    to_ts: int,
+) -> tuple[list[int], list[list[Connection]]]:
+    """Pareto optimal journeys from the origin departing in [from_ts, to_ts),
+    sorted by departure"""
+    # Candidates are (departure, arrival, changeovers, stop, entry, walk from origin)
+    candidates = []
+    starts = [(origin_stop_id, 0, None)] + [
+        (transfer.to_stop, transfer.duration, transfer)
+        for transfer in transfers[origin_stop_id]
+    ]
+    for stop, walk_duration, transfer in starts:
+        profile = stop_profiles[stop]
+        if profile is None:
+            continue
+        for j, (neg_key, arrivals) in enumerate(
+            zip(profile.neg_keys, profile.arrivals)
+        ):
+            departure = -neg_key - walk_duration
+            if not from_ts <= departure < to_ts:
+                continue
+            for k, arrival in enumerate(arrivals):
+                if arrival == INFINITE_TS or (k and arrival == arrivals[k - 1]):
+                    continue
+                # Arrivals kept from the previous, later entry are journeys
+                # departing at its key, which may be after to_ts
+                if j and arrival == profile.arrivals[j - 1][k]:
+                    continue
+                candidates.append((departure, arrival, k, stop, j, transfer))
+
+    # Keep candidates that are not dominated by a later or equal departure
+    # with an earlier or equal arrival and fewer or equal changeovers
+    candidates.sort(key=lambda c: (-c[0], c[1], c[2]))
+    best_arrivals = [INFINITE_TS] * (MAX_TRANSFERS + 1)
+    pareto = []
+    for candidate in candidates:
+        departure, arrival, k, stop, j, transfer = candidate
+        if best_arrivals[k] <= arrival:
+            continue
+        pareto.append(candidate)
+        for kk in range(k, len(best_arrivals)):
+            best_arrivals[kk] = min(best_arrivals[kk], arrival)
+    pareto.reverse()
+
+    journeys = []
+    for departure, arrival, k, stop, j, transfer in pareto:
+        journey = extract_profile_journey(
+            timetable,
+            stop_profiles,
+            transfers,
+            destination_stop_id,
+            walks_to_destination,
+            pointer=stop_profiles[stop].pointers[j][k],
+            changeovers=k,
+            arrival=arrival,
+        )
+        if transfer is not None:
+            walk_ar_ts = journey[0].dp_ts - MINIMUM_TRANSFER_TIME
+            journey.insert(
+                0,
+                walking_connection(
+                    walk_ar_ts - transfer.duration, walk_ar_ts, transfer
+                ),
+            )
+        journeys.append(journey)
+    return [candidate[0] for candidate in pareto], journeys
+
+
+def arrival_service_date(ar_ts: datetime) -> date:
+    """Service date of the timetable of an arrival time search"""
+    return (ar_ts - timedelta(hours=STANDART_SEARCH_WINDOW_HOURS)).date()
+
+
+@dataclass
+class Endpoints:
+    """Origin and destination of a routing request by dense station index.
+    Locations get the indices after the stations and the transfers include the
+    walks from and to them."""
+
+    origin_stop_id: int
+    destination_stop_id: int
+    transfers: list[list[Transfer]]
+    heuristics: list[int]
+    lower_bounds: list[int]
 
 
 @dataclass
 class RoutingParams:
-    origin: str
-    destination: str
+    origin: str | Location
+    destination: str | Location
+    # Dense station indices of origin and destination
     origin_stop_id: int
     destination_stop_id: int
     dp_ts: datetime
     session: SessionType
     n_hours_to_future: int
-    heuristics: dict[int, int]
-    connections: list[Connection]
+    heuristics: list[int]
+    lower_bounds: list[int]
+    transfers: list[list[Transfer]]
+    timetable: Timetable
+    start_index: int
+    end_index: int
+    connection_filter: ConnectionFilter
+
+
+@dataclass
+class SearchContext:
+    """State of a single search. The router only holds data shared by all
+    searches, so that concurrent requests from several threads each search
+    with their own context."""
+
+    params: RoutingParams
+    # Borrowed from the router while the search runs, see RouterCSA.reset_labels
+    labels: LabelContainers | None = None
+    stats: ScanStats = field(default_factory=ScanStats)
+
+
+@dataclass(frozen=True)
+class AlternativeSearch:
+    """Search for alternatives to a changeover of a journey. Contains the state
+    of the routing request, so that the search can run in another process.
+
+    Positions and dense trip indices are only valid in the timetable they were
+    found in, so the search window is given by time and the trips of the
+    changeovers by their trip ids. The search runs only on the timetable with
+    the version of the routing request.
+    """
+
+    origin: str | Location
+    destination: str | Location
+    origin_stop_id: int
+    destination_stop_id: int
+    dp_ts: datetime
+    service_date: date
+    # Version of the timetable of the routing request
+    version: int
+    connection_filter: ConnectionFilter
+    n_hours_to_future: int
+    changeover: Changeover
+    # Changeover before the one to find alternatives for, None if it is the first
+    previous_changeover: Changeover | None
+    journey_dp_ts: int
+
+    @property
+    def memo_key(self) -> tuple:
+        """Searches with the same key find the same alternatives within a
+        routing request"""
+        changeover = self.changeover
+        previous = self.previous_changeover
+        return (
+            changeover.previous_transfer_stop_id,
+            changeover.stop_id,
+            changeover.ar_trip_id,
+            changeover.dp_ts - changeover.ar_ts,  # min_delay
+            # Start state of the search, see RouterCSA.search_alternatives
+            changeover.ar_ts,
+            changeover.dp_ts,
+            changeover.is_regio,
+            changeover.changeovers,
+            changeover.dist_traveled,
+            (
+                (
+                    previous.ar_ts,
+                    previous.ar_trip_id,
+                    previous.changeovers,
+                    previous.dist_traveled,
+                )
+                if previous
+                else self.journey_dp_ts
+            ),
+        )
+
+
+@dataclass
+class RoutingMatrix:
+    """Earliest arrivals from each origin (rows) to each destination (columns)
+    when departing at dp_ts"""
+
+    origins: list[str]
+    destinations: list[str]
+    dp_ts: datetime
+    # Unix timestamps of the earliest arrivals, -1 if unreachable
+    arrival_ts: np.ndarray
+    # Fewest changeovers to arrive at the earliest arrival, -1 if unreachable
+    changeovers: np.ndarray
+
+    @property
+    def durations(self) -> np.ndarray:
+        """Travel times in seconds, -1 if unreachable"""
+        return np.where(
+            self.arrival_ts >= 0, self.arrival_ts - int(self.dp_ts.timestamp()), -1
+        )
 
 
 class RouterCSA:
-    def __init__(self):
-        self.stop_steffen = StopSteffen()
-        self.transfers = get_transfers()
-        self.params: RoutingParams = None
+    def __init__(
+        self,
+        n_alternative_workers: int = 0,
+        pruning: Pruning = Pruning.DISTANCE_AND_LANDMARKS,
+        realtime: bool = False,
+        stop_steffen: StopSteffen | None = None,
+        transfers: list[list[Transfer]] | None = None,
+        landmarks: Landmarks | None = None,
+    ):
+        # Stations, transfers and landmarks are loaded unless they are given,
+        # like to the alternative workers by the router that starts them
+        if stop_steffen is None:
+            stop_steffen = StopSteffen()
+        self.stop_steffen = stop_steffen
+        self.fptf_encoder = FPTFEncoder(self.stop_steffen)
+        if transfers is None:
+            transfers = index_transfers(
+                get_transfers(), self.stop_steffen.station_index
+            )
+        self.transfers = transfers
+        self.timetables = TimetableStore(self.stop_steffen.station_ids)
+        # Label containers of finished searches, to be reused by the next ones
+        self.free_labels: list[LabelContainers] = []
+        self.landmarks = landmarks
+        if pruning != Pruning.DISTANCE and landmarks is None:
+            if os.path.isfile(LANDMARKS_PATH):
+                self.landmarks = Landmarks.load(self.stop_steffen.station_ids)
+            else:
+                logging.warning(
+                    f'No landmarks at {LANDMARKS_PATH}, pruning by distance only'
+                )
+                pruning = Pruning.DISTANCE
+        self.pruning = pruning
+        self.get_heuristics = lru_cache(maxsize=N_CACHED_HEURISTICS)(
+            self._get_heuristics
+        )
+        self.get_lower_bounds = lru_cache(maxsize=N_CACHED_HEURISTICS)(
+            self._get_lower_bounds
+        )
+        # Dense indices of an origin and a destination given as locations
+        self.origin_location_stop_id = len(self.stop_steffen.station_ids)
+        self.destination_location_stop_id = self.origin_location_stop_id + 1
+        self.get_endpoints = lru_cache(maxsize=N_CACHED_HEURISTICS)(self._get_endpoints)
+        self.stats = ScanStats()
+        # Guards the state shared by concurrent requests below, the free label
+        # containers and the statistics
+        self.lock = threading.Lock()
+        self.profiles: OrderedDict[tuple[int, int, ConnectionFilter], Profile] = (
+            OrderedDict()
+        )
+        # Number of processes searching for alternatives in parallel. With 0,
+        # and on timetables with real-time changes, alternatives are searched
+        # in the calling thread. The workers only have the planned timetables,
+        # so with real-time changes they would never be used.
+        if n_alternative_workers and realtime:
+            raise ValueError('Alternative workers only search planned timetables')
+        self.n_alternative_workers = n_alternative_workers
+        self._alternatives_executor: concurrent.futures.ProcessPoolExecutor | None = (
+            None
+        )
+        # Statistics of the per request memo of alternative searches
+        self.alternatives_memo_lookups = 0
+        self.alternatives_memo_hits = 0
+        # Final results of do_routing, see there for the key
+        self.results: OrderedDict[tuple, str] = OrderedDict()
+        # Version of the timetable of each service date of the results
+        self.result_versions: dict[date, int] = {}
+        # Apply real-time changes to the timetables
+        self.realtime = realtime
+        if realtime:
+            self.follow_realtime()
+
+    def follow_realtime(self):
+        """Apply the changes the crawler finds to the timetables in a background
+        thread, see router.realtime"""
+        _, Session = sessionfactory()
+        threading.Thread(
+            target=follow_changes,
+            args=(self.timetables, Redis.from_url(redis_url), Session),
+            name='realtime',
+            daemon=True,
+        ).start()
+
+    def _get_heuristics(
+        self, destination_stop_id: int, with_landmarks: bool
+    ) -> list[int]:
+        # Distance of every station to the destination in meters,
+        # indexed by dense station index
+        if self.pruning == Pruning.LANDMARKS and with_landmarks:
+            # Nothing is further away than the destination itself
+            return [0] * len(self.stop_steffen.station_ids)
+        return (
+            self.stop_steffen.get_distances_to(
+                int(self.stop_steffen.station_ids[destination_stop_id])
+            )
+            .astype(np.int64)
+            .tolist()
+        )
+
+    def _get_lower_bounds(
+        self, destination_stop_id: int, with_landmarks: bool
+    ) -> list[int]:
+        # Lower bound of the travel time of every station to the destination
+        # in seconds, indexed by dense station index
+        if not with_landmarks:
+            return [0] * len(self.stop_steffen.station_ids)
+        return self.landmarks.lower_bounds(destination_stop_id)
+
+    def landmarks_cover(self, timetable: Timetable) -> bool:
+        """Whether searches on the timetable can be pruned by the landmarks.
+        Otherwise they are pruned by distance only. The landmarks only know the
+        planned durations, and delayed trips catching up ride faster than
+        planned, so timetables with real-time changes are not covered."""
+        return (
+            self.landmarks is not None
+            and timetable.planned is None
+            and self.landmarks.covers(timetable.service_date)
+        )
+
+    def stop_index(self, name: str) -> int:
+        return self.stop_steffen.station_index[self.stop_steffen.names_to_ids[name][0]]
+
+    def walks_from_location(
+        self, location: Location, location_stop_id: int
+    ) -> list[Transfer]:
+        """Walks from the location to the stations within walking distance"""
+        stop_ids, distances = self.stop_steffen.stations_near(
+            location.lat, location.lon, MAX_WALKING_DISTANCE_M
+        )
+        return [
+            Transfer(
+                from_stop=location_stop_id,
+                to_stop=stop_id,
+                duration=int(distance / WALKING_SPEED_M_S),
+                distance=int(distance),
+            )
+            for stop_id, distance in zip(stop_ids.tolist(), distances.tolist())
+        ]
+
+    def _get_endpoints(
+        self,
+        origin: str | Location,
+        destination: str | Location,
+        with_landmarks: bool,
+    ) -> Endpoints:
+        if isinstance(origin, Location):
+            origin_stop_id = self.origin_location_stop_id
+        else:
+            origin_stop_id = self.stop_index(origin)
+        if not isinstance(destination, Location):
+            destination_stop_id = self.stop_index(destination)
+            if not isinstance(origin, Location):
+                return Endpoints(
+                    origin_stop_id=origin_stop_id,
+                    destination_stop_id=destination_stop_id,
+                    transfers=self.transfers,
+                    heuristics=self.get_heuristics(destination_stop_id, with_landmarks),
+                    lower_bounds=self.get_lower_bounds(
+                        destination_stop_id, with_landmarks
+                    ),
+                )
+
+        # Only the transfers of stations near the locations are copied
+        transfers = self.transfers + [[], []]
+        if isinstance(destination, Location):
+            destination_stop_id = self.destination_location_stop_id
+            destination_lat, destination_lon = destination.lat, destination.lon
+            walks = self.walks_from_location(destination, destination_stop_id)
+            for walk in walks:
+                transfers[walk.to_stop] = transfers[walk.to_stop] + [
+                    walk._replace(from_stop=walk.to_stop, to_stop=destination_stop_id)
+                ]
+            if self.pruning == Pruning.LANDMARKS and with_landmarks:
+                heuristics = [0] * len(self.stop_steffen.station_ids)
+            else:
+                heuristics = (
+                    haversine_distances(
+                        destination.lat,
+                        destination.lon,
+                        self.stop_steffen.station_lats,
+                        self.stop_steffen.station_lons,
+                    )
+                    .astype(np.int64)
+                    .tolist()
+                )
+            # Bounds to the nearest station are bounds to the location as well
+            lower_bounds = [0] * len(self.stop_steffen.station_ids)
+            if walks:
+                lower_bounds = np.min(
+                    [
+                        self.get_lower_bounds(walk.to_stop, with_landmarks)
+                        for walk in walks
+                    ],
+                    axis=0,
+                ).tolist()
+        else:
+            destination_lat = self.stop_steffen.station_lats[destination_stop_id]
+            destination_lon = self.stop_steffen.station_lons[destination_stop_id]
+            heuristics = self.get_heuristics(destination_stop_id, with_landmarks)
+            lower_bounds = self.get_lower_bounds(destination_stop_id, with_landmarks)
+
+        # Only used if the origin is a location
+        origin_heuristic = 0
+        if isinstance(origin, Location):
+            transfers[origin_stop_id] = self.walks_from_location(origin, origin_stop_id)
+            distance = haversine_distances(
+                origin.lat,
+                origin.lon,
+                np.array([destination_lat]),
+                np.array([destination_lon]),
+            )[0]
+            if isinstance(destination, Location) and distance < MAX_WALKING_DISTANCE_M:
+                transfers[origin_stop_id].append(
+                    Transfer(
+                        from_stop=origin_stop_id,
+                        to_stop=destination_stop_id,
+                        duration=int(distance / WALKING_SPEED_M_S),
+                        distance=int(distance),
+                    )
+                )
+            if self.pruning != Pruning.LANDMARKS or not with_landmarks:
+                origin_heuristic = int(distance)
+        return Endpoints(
+            origin_stop_id=origin_stop_id,
+            destination_stop_id=destination_stop_id,
+            transfers=transfers,
+            heuristics=heuristics + [origin_heuristic, 0],
+            lower_bounds=lower_bounds + [0, 0],
+        )
+
+    @contextmanager
+    def search_context(self, params: RoutingParams) -> Iterator[SearchContext]:
+        """Context of a search. Its label containers are returned to the router
+        and its statistics are added to the router's when the search is done."""
+        context = SearchContext(params=params)
+        try:
+            yield context
+        finally:
+            self.release_labels(context)
+            with self.lock:
+                self.stats.scanned_connections += context.stats.scanned_connections
+                self.stats.pruned_connections += context.stats.pruned_connections
+
+    def reset_labels(self, context: SearchContext) -> LabelContainers:
+        """Empty label containers fitting the timetable of the search"""
+        # Stations and the locations of origin and destination
+        n_stops = len(self.stop_steffen.station_ids) + 2
+        n_trips = context.params.timetable.n_trips
+        if context.labels is None:
+            with self.lock:
+                if self.free_labels:
+                    context.labels = self.free_labels.pop()
+        if context.labels is None or not context.labels.fits(n_stops, n_trips):
+            context.labels = LabelContainers(n_stops=n_stops, n_trips=n_trips)
+        else:
+            context.labels.reset()
+        return context.labels
+
+    def release_labels(self, context: SearchContext):
+        """Return the label containers of the search, once its labels are no
+        longer needed"""
+        if context.labels is not None:
+            with self.lock:
+                self.free_labels.append(context.labels)
+            context.labels = None
 
     def run_csa(
         self,
-        stops: dict[int, list[Reachability]],
+        context: SearchContext,
         search_alternatives: bool,
-        r_ident_id: int = 10,  # 0-9 are reserved for special cases
         delayed_trip_id: int = NO_DELAYED_TRIP_ID,
         min_delay: int = 0,
-    ) -> dict[int, list[Reachability]]:
-        trips: dict[int, list[Reachability]] = dict()
-        new_connections = self.params.connections
+    ) -> list[list[Reachability]]:
+        params = context.params
+        timetable = params.timetable
+        start_index = params.start_index
+        end_index = params.end_index
 
         while True:
-            early_stopping_ts = new_connections[-1].ar_ts + MINIMUM_TRANSFER_TIME
-            stops, routing_finished, early_stopping_ts, r_ident_id = csa(
-                connections=new_connections,
-                stops=stops,
-                trips=trips,
-                transfers=self.transfers,
-                heuristics=self.params.heuristics,
+            early_stopping_ts = timetable[end_index - 1].ar_ts + MINIMUM_TRANSFER_TIME
+            stops, routing_finished, early_stopping_ts = csa(
+                timetable=timetable,
+                start_index=start_index,
+                end_index=end_index,
+                labels=context.labels,
+                transfers=params.transfers,
+                heuristics=params.heuristics,
+                lower_bounds=params.lower_bounds,
                 delayed_trip_id=delayed_trip_id,
                 min_delay=min_delay,
-                destination_stop_id=self.params.destination_stop_id,
+                destination_stop_id=params.destination_stop_id,
                 search_alternatives=search_alternatives,
                 early_stopping_ts=early_stopping_ts,
-                r_ident_id=r_ident_id,
+                stats=context.stats,
             )
-            if (
-                routing_finished
-                or self.params.n_hours_to_future >= MAX_SEARCH_WINDOW_HOURS
-            ):
+            if routing_finished or params.n_hours_to_future >= MAX_SEARCH_WINDOW_HOURS:
                 break
             else:
-                new_connections = DBConnections.get_for_routing(
-                    session=self.params.session,
-                    from_ts=self.params.dp_ts
-                    + timedelta(hours=self.params.n_hours_to_future),
-                    to_ts=self.params.dp_ts
-                    + timedelta(
-                        hours=self.params.n_hours_to_future
-                        + ADDITIONAL_SEARCH_WINDOW_HOURS
-                    ),
+                # Extend the search window. The timetable already contains the
+                # connections, so this is only a slice of the timetable.
+                new_end_index = timetable.index_of(
+                    int(
+                        (
+                            params.dp_ts
+                            + timedelta(
+                                hours=params.n_hours_to_future
+                                + ADDITIONAL_SEARCH_WINDOW_HOURS
+                            )
+                        ).timestamp()
+                    )
                 )
-                if len(new_connections) == 0:
+                if new_end_index == end_index:
                     break
-                self.params.n_hours_to_future += ADDITIONAL_SEARCH_WINDOW_HOURS
-                self.params.connections.extend(new_connections)
+                params.n_hours_to_future += ADDITIONAL_SEARCH_WINDOW_HOURS
+                start_index, end_index = end_index, new_end_index
+                params.end_index = end_index
 
         # Filter out reachabilities at the destination, that arrive after early_stopping_ts,
         # as these might not represent an optimal journey
-        stops[self.params.destination_stop_id] = [
-            r
-            for r in stops[self.params.destination_stop_id]
-            if r.ar_ts <= early_stopping_ts
+        stops[params.destination_stop_id][:] = [
+            r for r in stops[params.destination_stop_id] if r.ar_ts <= early_stopping_ts
         ]
         return stops
 
-    def do_routing(
+    def routing_params(
         self,
-        origin: str,
-        destination: str,
+        origin: str | Location,
+        destination: str | Location,
         dp_ts: datetime,
         session: SessionType,
-    ) -> list[FPTFJourneyAndAlternatives]:
-        destination_stop_id = self.stop_steffen.names_to_ids[destination][0]
-        self.params = RoutingParams(
+        connection_filter: ConnectionFilter = ConnectionFilter(),
+        timetable: Timetable | None = None,
+    ) -> RoutingParams:
+        if timetable is None:
+            timetable = self.timetables.get(session, dp_ts.date()).filtered(
+                connection_filter
+            )
+            # Searches whose window reaches past midnight are followed by
+            # searches on the next service date
+            next_date = dp_ts.date() + timedelta(days=1)
+            if dp_ts + timedelta(
+                hours=STANDART_SEARCH_WINDOW_HOURS
+            ) >= datetime.combine(next_date, datetime.min.time(), dp_ts.tzinfo):
+                self.timetables.prefetch(next_date)
+        endpoints = self.get_endpoints(
+            origin, destination, self.landmarks_cover(timetable)
+        )
+        start_index, end_index = timetable.window(
+            int(dp_ts.timestamp()),
+            int((dp_ts + timedelta(hours=STANDART_SEARCH_WINDOW_HOURS)).timestamp()),
+        )
+        params = RoutingParams(
             origin=origin,
             destination=destination,
-            origin_stop_id=self.stop_steffen.names_to_ids[origin][0],
-            destination_stop_id=destination_stop_id,
+            origin_stop_id=endpoints.origin_stop_id,
+            destination_stop_id=endpoints.destination_stop_id,
             dp_ts=dp_ts,
             session=session,
             n_hours_to_future=STANDART_SEARCH_WINDOW_HOURS,
-            heuristics={
-                stop.stop_id: int(
-                    self.stop_steffen.get_distance(stop.stop_id, destination_stop_id)
-                )
-                for stop in self.stop_steffen.stations()
-            },
-            connections=DBConnections.get_for_routing(
-                session=session,
-                from_ts=dp_ts,
-                to_ts=dp_ts + timedelta(hours=STANDART_SEARCH_WINDOW_HOURS),
-            ),
+            heuristics=endpoints.heuristics,
+            lower_bounds=endpoints.lower_bounds,
+            transfers=endpoints.transfers,
+            timetable=timetable,
+            start_index=start_index,
+            end_index=end_index,
+            connection_filter=connection_filter,
         )
-
-        if len(self.params.connections) == 0:
+        if start_index == end_index:
             raise NoTimetableFound('No timetable found for given date and time')
+        return params
 
-        stops = {stop.stop_id: [] for stop in self.stop_steffen.stations()}
-        origin_reachability = Reachability(
-            dp_ts=int(dp_ts.timestamp()),
-            ar_ts=int(dp_ts.timestamp()),
-            changeovers=0,
-            dist_traveled=0,
-            is_regio=1,
-            transfer_time_from_delayed_trip=0,
-            from_failed_transfer_stop_id=0,
-            current_trip_id=NO_TRIP_ID,
-            min_heuristic=self.params.heuristics[self.params.origin_stop_id],
-            r_ident_id=0,
-            last_r_ident_id=0,
-            last_stop_id=NO_STOP_ID,
-            last_dp_ts=int(dp_ts.timestamp()),
-            walk_from_delayed_trip=False,
-            last_changeover_duration=0,
-        )
-        stops[self.params.origin_stop_id].append(origin_reachability)
-        # Relax walking segments here from origin
-        r_ident_id = 10
-        if self.params.origin_stop_id in self.transfers:
-            for transfer in self.transfers[self.params.origin_stop_id]:
+    def do_routing(
+        self,
+        origin: str | Location,
+        destination: str | Location,
+        dp_ts: datetime,
+        session: SessionType,
+        search_for_arrival: bool = False,
+        connection_filter: ConnectionFilter = ConnectionFilter(),
+    ) -> str:
+        """FPTF JSON of the journeys departing at or after dp_ts, or arriving at
+        or before dp_ts if search_for_arrival, and their alternatives, using only
+        connections the filter allows. Origin and destination are station names
+        or locations to walk from or to.
+
+        Results are cached for the minute of dp_ts until the timetable of their
+        service date changes. Any real-time change may make new or faster
+        journeys possible, so the cached results of a service date are dropped
+        with every new version of its timetable."""
+        dp_ts = dp_ts.replace(second=0, microsecond=0)
+        if search_for_arrival:
+            if isinstance(origin, Location) or isinstance(destination, Location):
+                raise ValueError('Searches for arrival only support station names')
+            service_date = arrival_service_date(dp_ts)
+        else:
+            service_date = dp_ts.date()
+        version = self.timetables.get(session, service_date).version
+        key = (
+            service_date,
+            origin,
+            destination,
+            dp_ts,
+            search_for_arrival,
+            connection_filter,
+        )
+        with self.lock:
+            if self.result_versions.get(service_date) != version:
+                self.results = OrderedDict(
+                    (cached_key, result)
+                    for cached_key, result in self.results.items()
+                    if cached_key[0] != service_date
+                )
+                self.result_versions[service_date] = version
+            if key in self.results:
+                self.results.move_to_end(key)
+                return self.results[key]
+
+        if search_for_arrival:
+            journeys_and_alternatives = self.do_arrival_routing(
+                origin, destination, dp_ts, session, connection_filter
+            )
+        else:
+            journeys_and_alternatives = self.do_departure_routing(
+                origin, destination, dp_ts, session, connection_filter
+            )
+
+        with self.lock:
+            # Results found while the timetable changed are not cached
+            if self.result_versions.get(service_date) == version:
+                self.results[key] = journeys_and_alternatives
+                while len(self.results) > N_CACHED_RESULTS:
+                    self.results.popitem(last=False)
+        return journeys_and_alternatives
+
+    def do_departure_routing(
+        self,
+        origin: str | Location,
+        destination: str | Location,
+        dp_ts: datetime,
+        session: SessionType,
+        connection_filter: ConnectionFilter = ConnectionFilter(),
+    ) -> str:
+        params = self.routing_params(
+            origin, destination, dp_ts, session, connection_filter
+        )
+        with self.search_context(params) as context:
+            labels = self.reset_labels(context)
+            origin_reachability = labels.pool.create(
+                dp_ts=int(dp_ts.timestamp()),
+                ar_ts=int(dp_ts.timestamp()),
+                changeovers=0,
+                dist_traveled=0,
+                is_regio=1,
+                transfer_time_from_delayed_trip=0,
+                from_failed_transfer_stop_id=0,
+                current_trip_id=NO_TRIP_ID,
+                min_heuristic=params.heuristics[params.origin_stop_id],
+                last_r_ident_id=0,
+                last_stop_id=NO_STOP_ID,
+                last_dp_ts=int(dp_ts.timestamp()),
+                walk_from_delayed_trip=False,
+                last_changeover_duration=0,
+            )
+            labels.add_to_stop(params.origin_stop_id, origin_reachability)
+            # Relax walking segments here from origin
+            for transfer in params.transfers[params.origin_stop_id]:
                 walk = add_transfer_to_reachability(
+                    pool=labels.pool,
                     reachability=origin_reachability,
                     transfer=transfer,
                     from_delayed=0,
-                    heuristic=self.params.heuristics[transfer.to_stop],
-                    r_ident_id=r_ident_id,
-                )
-                r_ident_id += 1
-                stops[transfer.to_stop], _ = add_reachability_to_pareto(
-                    walk,
-                    stops[transfer.to_stop],
-                    is_alternative=False,
+                    heuristic=params.heuristics[transfer.to_stop],
                 )
+                if not labels.stops[transfer.to_stop]:
+                    labels.touched_stops.append(transfer.to_stop)
+                labels.stops[transfer.to_stop].add(walk)
 
-        stops = self.run_csa(stops, search_alternatives=False, r_ident_id=r_ident_id)
+            stops = self.run_csa(context, search_alternatives=False)
 
-        journeys = extract_journeys(
-            stops,
-            self.params.destination_stop_id,
-            self.params.connections,
-            transfers=self.transfers,
+            journeys = extract_journeys(
+                stops,
+                labels.pool,
+                params.destination_stop_id,
+                params.timetable,
+                transfers=params.transfers,
+            )
+            # The searches for alternatives can reuse the label containers
+            self.release_labels(context)
+
+            if len(journeys) == 0:
+                raise NoRouteFound('No route found')
+
+            journeys = remove_duplicate_journeys(journeys)
+
+            # # Print for debugging
+            # trip_ids = set()
+            # for journey in journeys:
+            #     for connection in journey:
+            #         trip_ids.add(connection.trip_id)
+            # routes = params.timetable.get_routes(trip_ids)
+            # print('Journeys:')
+            # print_journeys(journeys, self.stop_steffen, routes=routes)
+            # return
+
+            return self.add_alternatives(context, journeys)
+
+    def arrival_journeys(
+        self,
+        origin_stop_id: int,
+        destination_stop_id: int,
+        timetable: Timetable,
+        ar_ts: datetime,
+    ) -> list[list[Connection]]:
+        """Journeys arriving at or before ar_ts. Each backward search finds the latest departure for each number of
+        changeovers, the next one searches for arrivals before the latest
+        arrival found."""
+        walks_to_destination = self.walks_to(destination_stop_id)
+        earliest_arrival = int(
+            (ar_ts - timedelta(hours=STANDART_SEARCH_WINDOW_HOURS)).timestamp()
         )
+        arrival_deadline = int(ar_ts.timestamp())
+        journeys = []
+        for _ in range(N_ARRIVAL_SEARCHES):
+            latest, pointers = backward_csa(
+                timetable=timetable,
+                positions=timetable.arrival_positions(
+                    earliest_arrival, arrival_deadline + 1
+                ),
+                destination_stop_id=destination_stop_id,
+                arrival_deadline=arrival_deadline,
+                transfers=self.transfers,
+                walks_to_destination=walks_to_destination,
+                max_changeovers=MAX_TRANSFERS,
+            )
+            found = backward_journeys(
+                timetable=timetable,
+                latest=latest,
+                pointers=pointers,
+                transfers=self.transfers,
+                origin_stop_id=origin_stop_id,
+                destination_stop_id=destination_stop_id,
+                arrival_deadline=arrival_deadline,
+                walks_to_destination=walks_to_destination,
+                max_changeovers=MAX_TRANSFERS,
+            )
+            journeys.extend(found)
+            if not found or len(journeys) >= N_ROUTES_TO_FIND:
+                break
+            arrival_deadline = max(journey[-1].ar_ts for journey in found) - 1
+        return journeys
 
+    def do_arrival_routing(
+        self,
+        origin: str,
+        destination: str,
+        ar_ts: datetime,
+        session: SessionType,
+        connection_filter: ConnectionFilter = ConnectionFilter(),
+    ) -> str:
+        """Like do_routing, but for journeys arriving at or before ar_ts"""
+        timetable = self.timetables.get(session, arrival_service_date(ar_ts)).filtered(
+            connection_filter
+        )
+        journeys = self.arrival_journeys(
+            self.stop_index(origin),
+            self.stop_index(destination),
+            timetable,
+            ar_ts,
+        )
         if len(journeys) == 0:
             raise NoRouteFound('No route found')
-
         journeys = remove_duplicate_journeys(journeys)
 
-        # # Print for debugging
-        # trip_ids = set()
-        # for journey in journeys:
-        #     for connection in journey:
-        #         trip_ids.add(connection.trip_id)
-        # routes = get_routes(trip_ids, session)
-        # print('Journeys:')
-        # print_journeys(journeys, self.stop_steffen, routes=routes)
-        # return
+        # Alternatives are searched forward from the earliest departure found
+        params = self.routing_params(
+            origin,
+            destination,
+            datetime.fromtimestamp(journeys[0][0].dp_ts),
+            session,
+            connection_filter,
+            timetable=timetable,
+        )
+        with self.search_context(params) as context:
+            return self.add_alternatives(context, journeys)
 
-        alternatives = [
-            self.find_alternative_connections(
-                journey=journey,
-            )
-            for journey in journeys
-        ]
+    def add_alternatives(
+        self, context: SearchContext, journeys: list[list[Connection]]
+    ) -> str:
+        alternatives = self.find_alternative_connections(context, journeys)
 
         alternatives = [
             clean_alternatives(journey=journey, alternatives=alternatives_for_journey)
@@ -540,15 +1706,213 @@ class RouterCSA:
             for alternatives_for_journey in alternatives
         ]
 
-        journeys_and_alternatives = self.to_fptf(journeys, alternatives)
+        return self.to_fptf(context.params, journeys, alternatives)
 
-        self.params = None
-        return journeys_and_alternatives
+    def walks_to(self, destination_stop_id: int) -> dict[int, Transfer]:
+        """Shortest walk to the destination by dense station index"""
+        walks: dict[int, Transfer] = {}
+        for transfers_from_stop in self.transfers:
+            for transfer in transfers_from_stop:
+                if (
+                    transfer.to_stop == destination_stop_id
+                    and transfer.from_stop != destination_stop_id
+                    and (
+                        transfer.from_stop not in walks
+                        or transfer.duration < walks[transfer.from_stop].duration
+                    )
+                ):
+                    walks[transfer.from_stop] = transfer
+        return walks
 
-    def find_alternative_connections(
+    def profile_routing(
         self,
-        journey: list[Connection],
-    ):
+        origin_stop_id: int,
+        destination_stop_id: int,
+        timetable: Timetable,
+        from_ts: datetime,
+        window_hours: int = PROFILE_WINDOW_HOURS,
+    ) -> Profile:
+        """Profile of all Pareto optimal journeys departing within window_hours
+        after from_ts. Journeys may take up to STANDART_SEARCH_WINDOW_HOURS."""
+        to_ts = from_ts + timedelta(hours=window_hours)
+        start_index, end_index = timetable.window(
+            int(from_ts.timestamp()),
+            int((to_ts + timedelta(hours=STANDART_SEARCH_WINDOW_HOURS)).timestamp()),
+        )
+        walks_to_destination = self.walks_to(destination_stop_id)
+        stop_profiles = profile_csa(
+            timetable=timetable,
+            start_index=start_index,
+            end_index=end_index,
+            destination_stop_id=destination_stop_id,
+            transfers=self.transfers,
+            walks_to_destination=walks_to_destination,
+            max_changeovers=MAX_TRANSFERS,
+        )
+        departures, journeys = profile_journeys(
+            timetable=timetable,
+            stop_profiles=stop_profiles,
+            transfers=self.transfers,
+            origin_stop_id=origin_stop_id,
+            destination_stop_id=destination_stop_id,
+            walks_to_destination=walks_to_destination,
+            from_ts=int(from_ts.timestamp()),
+            to_ts=int(to_ts.timestamp()),
+        )
+        return Profile(
+            origin_stop_id=origin_stop_id,
+            destination_stop_id=destination_stop_id,
+            from_ts=int(from_ts.timestamp()),
+            to_ts=int(to_ts.timestamp()),
+            timetable=timetable,
+            departures=departures,
+            journeys=journeys,
+        )
+
+    def get_profile(self, params: RoutingParams, n_journeys: int) -> Profile:
+        key = (
+            params.origin_stop_id,
+            params.destination_stop_id,
+            params.connection_filter,
+        )
+        from_ts = int(params.dp_ts.timestamp())
+        to_ts = int((params.dp_ts + timedelta(hours=PROFILE_PAGE_HOURS)).timestamp())
+        with self.lock:
+            profile = self.profiles.get(key)
+        if (
+            profile is None
+            or profile.timetable is not params.timetable
+            or not profile.can_answer(from_ts, to_ts, n_journeys)
+        ):
+            profile = self.profile_routing(
+                params.origin_stop_id,
+                params.destination_stop_id,
+                params.timetable,
+                params.dp_ts,
+            )
+        with self.lock:
+            self.profiles[key] = profile
+            self.profiles.move_to_end(key)
+            while len(self.profiles) > N_CACHED_PROFILES:
+                self.profiles.popitem(last=False)
+        return profile
+
+    def do_profile_routing(
+        self,
+        origin: str,
+        destination: str,
+        dp_ts: datetime,
+        session: SessionType,
+        n_journeys: int = N_ROUTES_TO_FIND,
+        connection_filter: ConnectionFilter = ConnectionFilter(),
+    ) -> str:
+        """Like do_routing, but answered from a profile of the Pareto optimal
+        journeys (departure, arrival, changeovers) over a departure window.
+        Paging earlier or later within the window reuses the cached profile."""
+        params = self.routing_params(
+            origin, destination, dp_ts, session, connection_filter
+        )
+
+        profile = self.get_profile(params, n_journeys)
+        journeys = profile.page(int(dp_ts.timestamp()), n_journeys)
+        if len(journeys) == 0:
+            raise NoRouteFound('No route found')
+
+        with self.search_context(params) as context:
+            return self.add_alternatives(context, journeys)
+
+    def search_matrix_row(
+        self,
+        origin_stop_id: int,
+        destination_stop_ids: list[int],
+        dp_ts: datetime,
+        window_hours: int,
+        connection_filter: ConnectionFilter,
+        session: SessionType,
+    ) -> tuple[list[int], list[int]]:
+        timetable = self.timetables.get(session, dp_ts.date()).filtered(
+            connection_filter
+        )
+        start_index, end_index = timetable.window(
+            int(dp_ts.timestamp()),
+            int((dp_ts + timedelta(hours=window_hours)).timestamp()),
+        )
+        return earliest_arrival_csa(
+            timetable=timetable,
+            start_index=start_index,
+            end_index=end_index,
+            origin_stop_id=origin_stop_id,
+            dp_ts=int(dp_ts.timestamp()),
+            transfers=self.transfers,
+            destination_stop_ids=destination_stop_ids,
+            max_changeovers=MAX_TRANSFERS,
+        )
+
+    def do_matrix_routing(
+        self,
+        origins: list[str],
+        destinations: list[str],
+        dp_ts: datetime,
+        session: SessionType,
+        window_hours: int = STANDART_SEARCH_WINDOW_HOURS,
+        connection_filter: ConnectionFilter = ConnectionFilter(),
+    ) -> RoutingMatrix:
+        """Earliest arrivals and changeovers from every origin to every
+        destination by connections departing within window_hours after dp_ts.
+        Runs one one-to-all scan per origin on the shared timetable, in the
+        process pool of the router if it has alternative workers."""
+        origin_stop_ids = [self.stop_index(origin) for origin in origins]
+        destination_stop_ids = [
+            self.stop_index(destination) for destination in destinations
+        ]
+        # Loading the timetable here does not write a snapshot, each worker
+        # loads the timetable on its own, from the snapshot if there is one.
+        # The workers only have the planned timetables.
+        timetable = self.timetables.get(session, dp_ts.date())
+        if self.n_alternative_workers and timetable.planned is None:
+            n_origins = len(origin_stop_ids)
+            rows = list(
+                self.alternatives_executor().map(
+                    _search_matrix_row_in_worker,
+                    origin_stop_ids,
+                    repeat(destination_stop_ids, n_origins),
+                    repeat(dp_ts, n_origins),
+                    repeat(window_hours, n_origins),
+                    repeat(connection_filter, n_origins),
+                    chunksize=max(1, n_origins // (4 * self.n_alternative_workers)),
+                )
+            )
+        else:
+            rows = [
+                self.search_matrix_row(
+                    origin_stop_id,
+                    destination_stop_ids,
+                    dp_ts,
+                    window_hours,
+                    connection_filter,
+                    session,
+                )
+                for origin_stop_id in origin_stop_ids
+            ]
+
+        arrival_ts = np.array(
+            [row_arrivals for row_arrivals, _ in rows], dtype=np.int64
+        ).reshape(len(origins), len(destinations))
+        changeovers = np.array(
+            [row_changeovers for _, row_changeovers in rows], dtype=np.int64
+        ).reshape(len(origins), len(destinations))
+        arrival_ts[arrival_ts == INFINITE_TS] = -1
+        return RoutingMatrix(
+            origins=list(origins),
+            destinations=list(destinations),
+            dp_ts=dp_ts,
+            arrival_ts=arrival_ts,
+            changeovers=changeovers,
+        )
+
+    def alternative_searches(
+        self, params: RoutingParams, journey: list[Connection]
+    ) -> list[AlternativeSearch]:
         changeovers: list[Changeover] = []
 
         is_regio = 1
@@ -570,7 +1934,7 @@ class RouterCSA:
                         dp_ts=c2.dp_ts,
                         stop_id=c2.dp_stop_id,
                         is_regio=is_regio,
-                        ar_trip_id=c1.trip_id,
+                        ar_trip_id=params.timetable.external_trip_id(c1.trip_id),
                         previous_transfer_stop_id=last_transfer_station,
                         changeovers=n_changeovers,
                         dist_traveled=dist_traveled,
@@ -579,82 +1943,279 @@ class RouterCSA:
                 last_transfer_station = c2.dp_stop_id
                 n_changeovers += 1
 
-        alternatives = []
-
+        searches = []
         for i, transfer in enumerate(changeovers):
-            transfer_time_missed = transfer.dp_ts - transfer.ar_ts
-            if transfer_time_missed > MAX_EXPECTED_DELAY_SECONDS:
+            if transfer.dp_ts - transfer.ar_ts > MAX_EXPECTED_DELAY_SECONDS:
                 continue
+            searches.append(
+                AlternativeSearch(
+                    origin=params.origin,
+                    destination=params.destination,
+                    origin_stop_id=params.origin_stop_id,
+                    destination_stop_id=params.destination_stop_id,
+                    dp_ts=params.dp_ts,
+                    service_date=params.timetable.service_date,
+                    version=params.timetable.version,
+                    connection_filter=params.connection_filter,
+                    n_hours_to_future=params.n_hours_to_future,
+                    changeover=transfer,
+                    previous_changeover=changeovers[i - 1] if i > 0 else None,
+                    journey_dp_ts=journey[0].dp_ts,
+                )
+            )
+        return searches
 
-            ar_ts = changeovers[i - 1].ar_ts if i > 0 else journey[0].dp_ts - 1
-
-            stops = {stop.stop_id: [] for stop in self.stop_steffen.stations()}
-            stops[transfer.previous_transfer_stop_id].append(
-                Reachability(
-                    ar_ts=ar_ts,
-                    dp_ts=changeovers[i - 1].ar_ts if i > 0 else journey[0].dp_ts,
+    def search_alternatives(
+        self,
+        search: AlternativeSearch,
+        session: SessionType,
+        timetable: Timetable | None = None,
+    ) -> list[list[Connection]] | None:
+        """Alternatives for missing the changeover of the search. Only depends
+        on the search, so it can run in another process. None if the timetable,
+        by default the one of this process, is not the one the search was made
+        for."""
+        if timetable is None:
+            timetable = self.timetables.get(session, search.service_date).filtered(
+                search.connection_filter
+            )
+        if timetable.version != search.version:
+            return None
+        start_index, end_index = timetable.window(
+            int(search.dp_ts.timestamp()),
+            int((search.dp_ts + timedelta(hours=search.n_hours_to_future)).timestamp()),
+        )
+        endpoints = self.get_endpoints(
+            search.origin,
+            search.destination,
+            self.landmarks_cover(timetable),
+        )
+        params = RoutingParams(
+            origin=search.origin,
+            destination=search.destination,
+            origin_stop_id=search.origin_stop_id,
+            destination_stop_id=search.destination_stop_id,
+            dp_ts=search.dp_ts,
+            session=session,
+            n_hours_to_future=search.n_hours_to_future,
+            heuristics=endpoints.heuristics,
+            lower_bounds=endpoints.lower_bounds,
+            transfers=endpoints.transfers,
+            timetable=timetable,
+            start_index=start_index,
+            end_index=end_index,
+            connection_filter=search.connection_filter,
+        )
+        transfer = search.changeover
+        previous = search.previous_changeover
+        transfer_time_missed = transfer.dp_ts - transfer.ar_ts
+        delayed_trip = timetable.trip_index(transfer.ar_trip_id)
+
+        with self.search_context(params) as context:
+            labels = self.reset_labels(context)
+            labels.add_to_stop(
+                transfer.previous_transfer_stop_id,
+                labels.pool.create(
+                    ar_ts=previous.ar_ts if previous else search.journey_dp_ts - 1,
+                    dp_ts=previous.ar_ts if previous else search.journey_dp_ts,
                     current_trip_id=(
-                        changeovers[i - 1].ar_trip_id if i > 0 else NO_TRIP_ID
+                        timetable.trip_index(previous.ar_trip_id)
+                        if previous
+                        else NO_TRIP_ID
                     ),
-                    changeovers=changeovers[i - 1].changeovers if i > 0 else 0,
-                    dist_traveled=changeovers[i - 1].dist_traveled if i > 0 else 0,
+                    changeovers=previous.changeovers if previous else 0,
+                    dist_traveled=previous.dist_traveled if previous else 0,
                     is_regio=transfer.is_regio,
                     transfer_time_from_delayed_trip=0,
                     from_failed_transfer_stop_id=0,
-                    min_heuristic=self.params.heuristics[
-                        transfer.previous_transfer_stop_id
-                    ],
-                    r_ident_id=0,
+                    min_heuristic=params.heuristics[transfer.previous_transfer_stop_id],
                     last_r_ident_id=0,
                     last_stop_id=NO_STOP_ID,
                     last_dp_ts=0,
                     walk_from_delayed_trip=False,
                     last_changeover_duration=0,
-                )
+                ),
             )
 
-            stops[transfer.stop_id].append(
-                Reachability(
+            labels.add_to_stop(
+                transfer.stop_id,
+                labels.pool.create(
                     ar_ts=transfer.ar_ts,
                     dp_ts=transfer.dp_ts,
-                    current_trip_id=transfer.ar_trip_id,
+                    current_trip_id=delayed_trip,
                     changeovers=transfer.changeovers,
                     dist_traveled=transfer.dist_traveled,
                     is_regio=transfer.is_regio,
                     transfer_time_from_delayed_trip=0,
                     from_failed_transfer_stop_id=1,
-                    min_heuristic=self.params.heuristics[transfer.stop_id],
-                    r_ident_id=1,
+                    min_heuristic=params.heuristics[transfer.stop_id],
                     last_r_ident_id=1,
                     last_stop_id=NO_STOP_ID,
                     last_dp_ts=0,
                     walk_from_delayed_trip=False,
                     last_changeover_duration=0,
-                )
+                ),
             )
 
             stops = self.run_csa(
-                stops,
+                context,
                 search_alternatives=True,
-                delayed_trip_id=transfer.ar_trip_id,
+                delayed_trip_id=delayed_trip,
                 min_delay=transfer_time_missed,
             )
 
-            journeys = extract_journeys(
+            return extract_journeys(
                 stops=stops,
-                destination_stop_id=self.params.destination_stop_id,
-                connections=self.params.connections,
-                transfers=self.transfers,
+                pool=labels.pool,
+                destination_stop_id=params.destination_stop_id,
+                timetable=timetable,
+                transfers=params.transfers,
+            )
+
+    def alternatives_executor(self) -> concurrent.futures.ProcessPoolExecutor:
+        with self.lock:
+            if self._alternatives_executor is None:
+                self._alternatives_executor = concurrent.futures.ProcessPoolExecutor(
+                    self.n_alternative_workers,
+                    mp_context=mp.get_context('spawn'),
+                    initializer=_init_alternatives_worker,
+                    initargs=(
+                        self.pruning,
+                        self.stop_steffen,
+                        self.transfers,
+                        self.landmarks,
+                    ),
+                )
+            return self._alternatives_executor
+
+    def find_alternative_connections(
+        self,
+        context: SearchContext,
+        journeys: list[list[Connection]],
+    ) -> list[list[list[Connection]]]:
+        """Alternatives for each journey. The searches for all changeovers of all
+        journeys are independent of each other and run in a process pool if the
+        router has alternative workers and the timetable has no real-time
+        changes."""
+        searches = [
+            self.alternative_searches(context.params, journey) for journey in journeys
+        ]
+
+        # Journeys often share changeovers, search each of them only once
+        memo: dict[tuple, int] = {}
+        unique_searches: list[AlternativeSearch] = []
+        for searches_for_journey in searches:
+            for search in searches_for_journey:
+                key = search.memo_key
+                if key not in memo:
+                    memo[key] = len(unique_searches)
+                    unique_searches.append(search)
+        n_lookups = sum(len(searches_for_journey) for searches_for_journey in searches)
+        n_hits = n_lookups - len(unique_searches)
+        with self.lock:
+            self.alternatives_memo_lookups += n_lookups
+            self.alternatives_memo_hits += n_hits
+            hit_rate = self.alternatives_memo_hit_rate
+        logging.info(
+            f'Alternatives memo: {n_hits}/{n_lookups} hits in request, '
+            f'hit rate {hit_rate:.1%} overall'
+        )
+
+        # The workers only have the planned timetables
+        if self.n_alternative_workers and context.params.timetable.planned is None:
+            results = list(
+                self.alternatives_executor().map(
+                    _search_alternatives_in_worker, unique_searches
+                )
             )
-            alternatives.extend(journeys)
+        else:
+            results = [None] * len(unique_searches)
+        # Searches the workers rejected, as their timetable is another version
+        for i, search in enumerate(unique_searches):
+            if results[i] is None:
+                results[i] = self.search_alternatives(
+                    search, context.params.session, context.params.timetable
+                )
 
+        alternatives = []
+        for searches_for_journey in searches:
+            alternatives_for_journey = []
+            for search in searches_for_journey:
+                alternatives_for_journey.extend(results[memo[search.memo_key]])
+            alternatives.append(alternatives_for_journey)
         return alternatives
 
+    @property
+    def alternatives_memo_hit_rate(self) -> float:
+        if self.alternatives_memo_lookups == 0:
+            return 0.0
+        return self.alternatives_memo_hits / self.alternatives_memo_lookups
+
+    def to_external(self, params: RoutingParams, connection: Connection) -> Connection:
+        """Map the dense indices of a connection of the request back to
+        stop and trip ids. Walks from and to locations get the location stop ids."""
+        location_stop_ids = {
+            self.origin_location_stop_id: ORIGIN_LOCATION_STOP_ID,
+            self.destination_location_stop_id: DESTINATION_LOCATION_STOP_ID,
+        }
+        if (
+            connection.dp_stop_id not in location_stop_ids
+            and connection.ar_stop_id not in location_stop_ids
+        ):
+            return params.timetable.to_external(connection)
+
+        dp_stop_id, ar_stop_id = (
+            location_stop_ids[stop_id]
+            if stop_id in location_stop_ids
+            else int(self.stop_steffen.station_ids[stop_id])
+            for stop_id in (connection.dp_stop_id, connection.ar_stop_id)
+        )
+        return connection._replace(
+            dp_stop_id=dp_stop_id,
+            ar_stop_id=ar_stop_id,
+            dp_platform_id=dp_stop_id,
+            ar_platform_id=ar_stop_id,
+        )
+
+    def location_stops(self, params: RoutingParams) -> dict[int, Stops]:
+        """Stops for the origin and destination of the request that are
+        locations, by location stop id"""
+        locations = {}
+        for stop_id, place in (
+            (ORIGIN_LOCATION_STOP_ID, params.origin),
+            (DESTINATION_LOCATION_STOP_ID, params.destination),
+        ):
+            if isinstance(place, Location):
+                locations[stop_id] = Stops(
+                    stop_id=stop_id,
+                    stop_name=place.name,
+                    stop_lat=place.lat,
+                    stop_lon=place.lon,
+                    location_type=LocationType.GENERIC_NODE,
+                    parent_station=None,
+                    platform_code=None,
+                )
+        return locations
+
     def to_fptf(
         self,
+        params: RoutingParams,
         journeys: list[list[Connection]],
         alternatives: list[list[list[Connection]]],
-    ) -> list[FPTFJourneyAndAlternatives]:
+    ) -> str:
+        journeys = [
+            [self.to_external(params, connection) for connection in journey]
+            for journey in journeys
+        ]
+        alternatives = [
+            [
+                [self.to_external(params, connection) for connection in alternative]
+                for alternative in alternatives_for_journey
+            ]
+            for alternatives_for_journey in alternatives
+        ]
+        locations = self.location_stops(params)
+
         trip_ids = set()
         for journey in journeys:
             for connection in journey:
@@ -664,7 +2225,7 @@ class RouterCSA:
                 for connection in alternative:
                     trip_ids.add(connection.trip_id)
 
-        routes = get_routes(trip_ids, self.params.session)
+        routes = params.timetable.get_routes(trip_ids)
 
         # for journey, alternatives_for_journey in zip(journeys, alternatives):
         #     print('Journey:')
@@ -673,24 +2234,59 @@ class RouterCSA:
         #     print('Alternatives:')
         #     print_journeys(alternatives_for_journey, self.stop_steffen, routes=routes)
 
-        journey_and_alternatives: list[FPTFJourneyAndAlternatives] = []
+        return self.fptf_encoder.journeys_and_alternatives(
+            journeys, alternatives, routes, locations
+        )
 
-        for journey, alternatives_for_journey in zip(journeys, alternatives):
-            journey_and_alternatives.append(
-                FPTFJourneyAndAlternatives(
-                    journey=FPTFJourney.from_journey(
-                        journey, routes=routes, stop_steffen=self.stop_steffen
-                    ),
-                    alternatives=[
-                        FPTFJourney.from_journey(
-                            alternative, routes=routes, stop_steffen=self.stop_steffen
-                        )
-                        for alternative in alternatives_for_journey
-                    ],
-                )
-            )
 
-        return journey_and_alternatives
+_worker_router: RouterCSA | None = None
+_worker_session: SessionType | None = None
+
+
+def _init_alternatives_worker(
+    pruning: Pruning,
+    stop_steffen: StopSteffen,
+    transfers: list[list[Transfer]],
+    landmarks: Landmarks | None,
+):
+    """Router of a worker, with the stations, transfers and landmarks of the
+    router that started it, so that workers start without querying them
+    again. Timetables are mapped from the shared snapshots."""
+    global _worker_router, _worker_session
+    engine, Session = sessionfactory()
+    _worker_session = Session()
+    # Real-time changes are only applied in the serving process. Searches on
+    # timetables with changes are not sent to the workers, and the workers
+    # reject searches on other versions of the planned timetables.
+    _worker_router = RouterCSA(
+        pruning=pruning,
+        stop_steffen=stop_steffen,
+        transfers=transfers,
+        landmarks=landmarks,
+    )
+
+
+def _search_alternatives_in_worker(
+    search: AlternativeSearch,
+) -> list[list[Connection]] | None:
+    return _worker_router.search_alternatives(search, _worker_session)
+
+
+def _search_matrix_row_in_worker(
+    origin_stop_id: int,
+    destination_stop_ids: list[int],
+    dp_ts: datetime,
+    window_hours: int,
+    connection_filter: ConnectionFilter,
+) -> tuple[list[int], list[int]]:
+    return _worker_router.search_matrix_row(
+        origin_stop_id,
+        destination_stop_ids,
+        dp_ts,
+        window_hours,
+        connection_filter,
+        _worker_session,
+    )
 
 
 def main():
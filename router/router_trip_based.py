@@ -0,0 +1,618 @@
+import os
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+
+import numpy as np
+from sqlalchemy.orm import Session as SessionType
+
+from config import CACHE_PATH
+from database.engine import sessionfactory
+from gtfs.transfers import Transfer
+from helpers.logger import logging
+from router.constants import (
+    FIRST_TRIP_INDEX,
+    MAX_TRANSFERS,
+    MINIMUM_TRANSFER_TIME,
+    N_ROUTES_TO_FIND,
+    STANDART_SEARCH_WINDOW_HOURS,
+    WALKING_TRIP_ID,
+)
+from router.datatypes import Connection, ConnectionFilter, Location
+from router.exceptions import NoRouteFound
+from router.journey_reconstruction import remove_duplicate_journeys
+from router.router_csa import INFINITE_TS, Pruning, RouterCSA, walking_connection
+from router.timetable import N_CACHED_TIMETABLES, Timetable, snapshot_mtime
+
+TRIP_TRANSFERS_DIR = CACHE_PATH + '/trip_transfers'
+# Searches closer than this are routed with the connection scan
+TRIP_BASED_MIN_DISTANCE = 100_000  # 100 km
+
+
+def trip_transfers_path(service_date: date) -> str:
+    return f'{TRIP_TRANSFERS_DIR}/{service_date.isoformat()}.npz'
+
+
+def stop_events(
+    timetable: Timetable,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Stop events of the trips of the timetable.
+
+    A trip with n connections has n + 1 stop events. Event i of dense trip index
+    t is event_offsets[t] + i, with the stop, the departure (INFINITE_TS at the
+    last stop) and the arrival (-INFINITE_TS at the first stop) of the trip
+    there. Returns (event_offsets, event_stop, event_dp, event_ar).
+    """
+    n_trips = timetable.n_trips
+    event_offsets = timetable.trip_offsets + np.arange(n_trips + 1)
+    n_events = int(event_offsets[-1])
+    positions = timetable.trip_positions
+    # Position of every connection of the trip index in the events
+    connection_events = np.arange(len(positions)) + np.repeat(
+        np.arange(n_trips), np.diff(timetable.trip_offsets)
+    )
+
+    event_stop = np.zeros(n_events, dtype=np.int64)
+    event_dp = np.full(n_events, INFINITE_TS, dtype=np.int64)
+    event_ar = np.full(n_events, -INFINITE_TS, dtype=np.int64)
+    event_stop[connection_events + 1] = timetable.ar_stop[positions]
+    event_stop[connection_events] = timetable.dp_stop[positions]
+    event_dp[connection_events] = timetable.dp_ts[positions]
+    event_ar[connection_events + 1] = timetable.ar_ts[positions]
+    return event_offsets, event_stop, event_dp, event_ar
+
+
+def find_lines(
+    event_offsets: list[int],
+    event_stop: list[int],
+    event_dp: list[int],
+    event_ar: list[int],
+) -> tuple[np.ndarray, np.ndarray]:
+    """Group the trips into lines: trips with the same sequence of stops that
+    do not overtake each other. Returns the trips of each line in CSR layout
+    (line_offsets, line_trips), ordered by departure."""
+    trips_by_stops: dict[tuple[int, ...], list[int]] = {}
+    for trip in range(FIRST_TRIP_INDEX, len(event_offsets) - 1):
+        first, last = event_offsets[trip], event_offsets[trip + 1]
+        if last - first >= 2:
+            trips_by_stops.setdefault(tuple(event_stop[first:last]), []).append(trip)
+
+    lines: list[list[int]] = []
+    for trips in trips_by_stops.values():
+        trips.sort(key=lambda trip: event_dp[event_offsets[trip]])
+        trip_lines: list[list[int]] = []
+        for trip in trips:
+            first, last = event_offsets[trip], event_offsets[trip + 1]
+            for line in trip_lines:
+                previous = event_offsets[line[-1]]
+                if all(
+                    event_dp[previous + i] <= event_dp[e]
+                    and event_ar[previous + i] <= event_ar[e]
+                    for i, e in enumerate(range(first, last))
+                ):
+                    line.append(trip)
+                    break
+            else:
+                trip_lines.append([trip])
+        lines.extend(trip_lines)
+
+    line_offsets = np.zeros(len(lines) + 1, dtype=np.int64)
+    np.cumsum([len(line) for line in lines], out=line_offsets[1:])
+    line_trips = np.array([trip for line in lines for trip in line], dtype=np.int64)
+    return line_offsets, line_trips
+
+
+class TripBasedIndex:
+    """Trips, lines and reduced trip-to-trip transfers of a timetable, for
+    trip-based routing (Witt, Trip-Based Public Transit Routing, 2015).
+
+    The transfers from the stop event e are the boarding events
+    (transfer_trip[k], transfer_index[k]) for k in
+    range(transfer_offsets[e], transfer_offsets[e + 1]). Changing trips takes
+    MINIMUM_TRANSFER_TIME after arriving or after walking, like in the
+    connection scan.
+    """
+
+    def __init__(
+        self,
+        timetable: Timetable,
+        transfers: list[list[Transfer]],
+        line_offsets: np.ndarray,
+        line_trips: np.ndarray,
+        transfer_offsets: np.ndarray | None = None,
+        transfer_trip: np.ndarray | None = None,
+        transfer_index: np.ndarray | None = None,
+    ):
+        self.timetable = timetable
+        self.transfers = transfers
+        self.version = timetable.version
+        self.line_offsets = line_offsets
+        self.line_trips = line_trips
+
+        event_offsets, event_stop, event_dp, event_ar = stop_events(timetable)
+        # The loops of preprocessing and queries run on python lists
+        self.event_offsets: list[int] = event_offsets.tolist()
+        self.event_stop: list[int] = event_stop.tolist()
+        self.event_dp: list[int] = event_dp.tolist()
+        self.event_ar: list[int] = event_ar.tolist()
+
+        self.lines: list[list[int]] = [
+            line_trips[line_offsets[line] : line_offsets[line + 1]].tolist()
+            for line in range(len(line_offsets) - 1)
+        ]
+        self.trip_line = [-1] * timetable.n_trips
+        self.trip_line_position = [-1] * timetable.n_trips
+        # Departures of the trips of each line by stop index
+        self.line_departures: list[list[list[int]]] = []
+        # (line, stop index) of every line departing from or arriving at a stop
+        self.stop_departures: list[list[tuple[int, int]]] = [[] for _ in transfers]
+        self.stop_arrivals: list[list[tuple[int, int]]] = [[] for _ in transfers]
+        for line, trips in enumerate(self.lines):
+            for position, trip in enumerate(trips):
+                self.trip_line[trip] = line
+                self.trip_line_position[trip] = position
+            first = self.event_offsets[trips[0]]
+            n_stops = self.event_offsets[trips[0] + 1] - first
+            self.line_departures.append(
+                [
+                    [self.event_dp[self.event_offsets[trip] + i] for trip in trips]
+                    for i in range(n_stops)
+                ]
+            )
+            for i in range(n_stops - 1):
+                self.stop_departures[self.event_stop[first + i]].append((line, i))
+            for i in range(1, n_stops):
+                self.stop_arrivals[self.event_stop[first + i]].append((line, i))
+
+        if transfer_offsets is None:
+            transfer_offsets, transfer_trip, transfer_index = self.reduced_transfers()
+        self.transfer_offsets: list[int] = transfer_offsets.tolist()
+        self.transfer_trip: list[int] = transfer_trip.tolist()
+        self.transfer_index: list[int] = transfer_index.tolist()
+
+    @staticmethod
+    def build(
+        timetable: Timetable, transfers: list[list[Transfer]]
+    ) -> 'TripBasedIndex':
+        event_offsets, event_stop, event_dp, event_ar = stop_events(timetable)
+        line_offsets, line_trips = find_lines(
+            event_offsets.tolist(),
+            event_stop.tolist(),
+            event_dp.tolist(),
+            event_ar.tolist(),
+        )
+        return TripBasedIndex(timetable, transfers, line_offsets, line_trips)
+
+    def earliest_trip(self, line: int, i: int, ts: int) -> int | None:
+        """Position in the line of the first trip departing at stop index i at
+        or after ts"""
+        departures = self.line_departures[line][i]
+        position = bisect_left(departures, ts)
+        if position < len(departures):
+            return position
+
+    def reach(self, reached: dict[int, int], stop: int, ts: int) -> bool:
+        """Record arriving at stop at ts and walking on from there. True if
+        any stop is reached earlier than before."""
+        improved = False
+        if ts < reached.get(stop, INFINITE_TS):
+            reached[stop] = ts
+            improved = True
+        for transfer in self.transfers[stop]:
+            if ts + transfer.duration < reached.get(transfer.to_stop, INFINITE_TS):
+                reached[transfer.to_stop] = ts + transfer.duration
+                improved = True
+        return improved
+
+    def reduced_transfers(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Transfers from every arrival to the first trip of every line that can
+        be reached at the stop or by walking. Only transfers that lead to an
+        earlier arrival at some stop than staying in the trip or transfers
+        considered before are kept."""
+        event_offsets = self.event_offsets
+        event_stop = self.event_stop
+        event_ar = self.event_ar
+
+        from_events, to_trips, to_indices = [], [], []
+        for trip in range(FIRST_TRIP_INDEX, len(event_offsets) - 1):
+            first, last = event_offsets[trip], event_offsets[trip + 1]
+            # Earliest arrival at each stop from the stop events processed so far
+            reached: dict[int, int] = {}
+            for event in range(last - 1, first, -1):
+                stop = event_stop[event]
+                ar_ts = event_ar[event]
+                self.reach(reached, stop, ar_ts)
+
+                candidates = [(stop, ar_ts + MINIMUM_TRANSFER_TIME)] + [
+                    (
+                        transfer.to_stop,
+                        ar_ts + transfer.duration + MINIMUM_TRANSFER_TIME,
+                    )
+                    for transfer in self.transfers[stop]
+                ]
+                for to_stop, ts in candidates:
+                    for line, i in self.stop_departures[to_stop]:
+                        position = self.earliest_trip(line, i, ts)
+                        if position is None:
+                            continue
+                        to_trip = self.lines[line][position]
+                        if to_trip == trip:
+                            continue
+                        keep = False
+                        to_first = event_offsets[to_trip]
+                        for to_event in range(
+                            to_first + i + 1, event_offsets[to_trip + 1]
+                        ):
+                            if self.reach(
+                                reached, event_stop[to_event], event_ar[to_event]
+                            ):
+                                keep = True
+                        if keep:
+                            from_events.append(event)
+                            to_trips.append(to_trip)
+                            to_indices.append(i)
+
+        from_events = np.array(from_events, dtype=np.int64)
+        order = np.argsort(from_events, kind='stable')
+        transfer_offsets = np.zeros(event_offsets[-1] + 1, dtype=np.int64)
+        np.cumsum(
+            np.bincount(from_events, minlength=len(transfer_offsets) - 1),
+            out=transfer_offsets[1:],
+        )
+        return (
+            transfer_offsets,
+            np.array(to_trips, dtype=np.int64)[order],
+            np.array(to_indices, dtype=np.int32)[order],
+        )
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp.npz'
+        np.savez(
+            tmp_path,
+            version=np.array([self.version], dtype=np.int64),
+            line_offsets=self.line_offsets,
+            line_trips=self.line_trips,
+            transfer_offsets=np.array(self.transfer_offsets, dtype=np.int64),
+            transfer_trip=np.array(self.transfer_trip, dtype=np.int64),
+            transfer_index=np.array(self.transfer_index, dtype=np.int32),
+        )
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(
+        path: str, timetable: Timetable, transfers: list[list[Transfer]]
+    ) -> 'TripBasedIndex | None':
+        """Load the index if it was built for this version of the timetable"""
+        if not os.path.isfile(path):
+            return None
+        with np.load(path) as data:
+            if int(data['version'][0]) != timetable.version:
+                return None
+            return TripBasedIndex(
+                timetable,
+                transfers,
+                line_offsets=data['line_offsets'],
+                line_trips=data['line_trips'],
+                transfer_offsets=data['transfer_offsets'],
+                transfer_trip=data['transfer_trip'],
+                transfer_index=data['transfer_index'],
+            )
+
+    def query(
+        self,
+        origin_stop_id: int,
+        destination_stop_id: int,
+        walks_to_destination: dict[int, Transfer],
+        dp_ts: int,
+        max_changeovers: int,
+    ) -> list[list[Connection]]:
+        """Earliest arrival journeys for each number of changeovers up to
+        max_changeovers, when being at the origin at dp_ts"""
+        event_offsets = self.event_offsets
+        event_ar = self.event_ar
+        trip_line = self.trip_line
+
+        # Stop indices of each line where the destination can be reached
+        destination_lines: dict[int, list[tuple[int, Transfer | None]]] = {}
+        for stop, walk in [(destination_stop_id, None)] + list(
+            walks_to_destination.items()
+        ):
+            for line, i in self.stop_arrivals[stop]:
+                destination_lines.setdefault(line, []).append((i, walk))
+
+        # First stop index of each trip reached so far
+        reached_index: dict[int, int] = {}
+        # Trip segments as (trip, first index, last index, parent segment,
+        # event of the parent segment that was exited)
+        segments: list[tuple[int, int, int, int, int]] = []
+
+        def enqueue(trip: int, i: int, parent: int, exit_event: int, queue: list[int]):
+            n_stops = event_offsets[trip + 1] - event_offsets[trip]
+            last = reached_index.get(trip, n_stops - 1)
+            if i >= last:
+                return
+            segments.append((trip, i, last, parent, exit_event))
+            queue.append(len(segments) - 1)
+            # Later trips of the line are reached as well
+            line = self.lines[trip_line[trip]]
+            for later_trip in line[self.trip_line_position[trip] :]:
+                if reached_index.get(later_trip, INFINITE_TS) <= i:
+                    break
+                reached_index[later_trip] = i
+
+        queue: list[int] = []
+        for stop, walk_duration in [(origin_stop_id, 0)] + [
+            (transfer.to_stop, transfer.duration)
+            for transfer in self.transfers[origin_stop_id]
+        ]:
+            for line, i in self.stop_departures[stop]:
+                position = self.earliest_trip(
+                    line, i, dp_ts + walk_duration + MINIMUM_TRANSFER_TIME
+                )
+                if position is not None:
+                    enqueue(self.lines[line][position], i, -1, -1, queue)
+
+        best_arrival = INFINITE_TS
+        results = []
+        for _ in range(max_changeovers + 1):
+            best = None
+            for segment in queue:
+                trip, first, last, _, _ = segments[segment]
+                offset = event_offsets[trip]
+                for i, walk in destination_lines.get(trip_line[trip], ()):
+                    if first < i <= last:
+                        arrival = event_ar[offset + i] + (walk.duration if walk else 0)
+                        if arrival < best_arrival:
+                            best_arrival = arrival
+                            best = (segment, i, walk)
+            if best is not None:
+                results.append(best)
+
+            next_queue: list[int] = []
+            for segment in queue:
+                trip, first, last, _, _ = segments[segment]
+                offset = event_offsets[trip]
+                for event in range(offset + first + 1, offset + last + 1):
+                    if event_ar[event] >= best_arrival:
+                        break
+                    for k in range(
+                        self.transfer_offsets[event], self.transfer_offsets[event + 1]
+                    ):
+                        enqueue(
+                            self.transfer_trip[k],
+                            self.transfer_index[k],
+                            segment,
+                            event,
+                            next_queue,
+                        )
+            queue = next_queue
+            if not queue:
+                break
+
+        return [
+            self.journey(segments, segment, i, walk, origin_stop_id)
+            for segment, i, walk in results
+        ]
+
+    def walk(self, from_stop: int, to_stop: int) -> Transfer:
+        return min(
+            (
+                transfer
+                for transfer in self.transfers[from_stop]
+                if transfer.to_stop == to_stop
+            ),
+            key=lambda transfer: transfer.duration,
+        )
+
+    def journey(
+        self,
+        segments: list[tuple[int, int, int, int, int]],
+        segment: int,
+        i: int,
+        walk_to_destination: Transfer | None,
+        origin_stop_id: int,
+    ) -> list[Connection]:
+        """Connections of the journey that exits the trip of segment at stop
+        index i"""
+        legs = []
+        while segment != -1:
+            trip, first, _, parent, exit_event = segments[segment]
+            legs.append((trip, first, i))
+            if parent != -1:
+                i = exit_event - self.event_offsets[segments[parent][0]]
+            segment = parent
+        legs.reverse()
+
+        timetable = self.timetable
+        journey: list[Connection] = []
+        for trip, first, last in legs:
+            offset = timetable.trip_offsets[trip]
+            connections = [
+                timetable[int(position)]
+                for position in timetable.trip_positions[offset + first : offset + last]
+            ]
+            board_stop = connections[0].dp_stop_id
+            from_stop = journey[-1].ar_stop_id if journey else origin_stop_id
+            if from_stop != board_stop:
+                transfer = self.walk(from_stop, board_stop)
+                if journey:
+                    walk_dp_ts = journey[-1].ar_ts
+                else:
+                    walk_dp_ts = (
+                        connections[0].dp_ts - MINIMUM_TRANSFER_TIME - transfer.duration
+                    )
+                journey.append(
+                    walking_connection(
+                        walk_dp_ts, walk_dp_ts + transfer.duration, transfer
+                    )
+                )
+            journey.extend(connections)
+
+        if walk_to_destination is not None:
+            ar_ts = journey[-1].ar_ts
+            journey.append(
+                walking_connection(
+                    ar_ts, ar_ts + walk_to_destination.duration, walk_to_destination
+                )
+            )
+        return journey
+
+
+def departure(journey: list[Connection]) -> int:
+    """Latest time to be at the origin to catch the journey"""
+    if journey[0].trip_id == WALKING_TRIP_ID:
+        return journey[0].dp_ts
+    return journey[0].dp_ts - MINIMUM_TRANSFER_TIME
+
+
+class RouterTripBased(RouterCSA):
+    """Router that finds the journeys by trip-based routing instead of the
+    connection scan. Searches shorter than TRIP_BASED_MIN_DISTANCE, filtered
+    searches, searches from or to locations, searches on timetables without a
+    trip-based index and the searches for alternatives still use the
+    connection scan. The indices are only built offline, see main()."""
+
+    def __init__(
+        self,
+        n_alternative_workers: int = 0,
+        pruning: Pruning = Pruning.DISTANCE_AND_LANDMARKS,
+        min_distance: int = TRIP_BASED_MIN_DISTANCE,
+    ):
+        super().__init__(n_alternative_workers=n_alternative_workers, pruning=pruning)
+        self.min_distance = min_distance
+        # Timetable, modification time of the index file and index of each
+        # service date, None if there is no index for the timetable
+        self.indices: OrderedDict[
+            date, tuple[Timetable, int | None, TripBasedIndex | None]
+        ] = OrderedDict()
+        self.indices_lock = threading.Lock()
+
+    def trip_based_index(self, timetable: Timetable) -> TripBasedIndex | None:
+        """Index of the timetable, None if none was built for it. Indices are
+        loaded outside the lock, so concurrent searches do not wait for each
+        other and may load an index twice."""
+        path = trip_transfers_path(timetable.service_date)
+        mtime = snapshot_mtime(path)
+        with self.indices_lock:
+            cached = self.indices.get(timetable.service_date)
+            if cached is not None and cached[0] is timetable and cached[1] == mtime:
+                self.indices.move_to_end(timetable.service_date)
+                return cached[2]
+
+        index = None
+        if mtime is not None:
+            index = TripBasedIndex.load(path, timetable, self.transfers)
+        if index is None:
+            logging.info(
+                f'No trip-based index of {timetable.service_date}, routing with '
+                'the connection scan'
+            )
+        with self.indices_lock:
+            self.indices[timetable.service_date] = (timetable, mtime, index)
+            self.indices.move_to_end(timetable.service_date)
+            while len(self.indices) > N_CACHED_TIMETABLES:
+                self.indices.popitem(last=False)
+        return index
+
+    def trip_based_journeys(
+        self,
+        index: TripBasedIndex,
+        origin_stop_id: int,
+        destination_stop_id: int,
+        dp_ts: datetime,
+    ) -> list[list[Connection]]:
+        """Journeys departing in the search window. Each query finds the earliest
+        arrival for each number of changeovers, the next one departs after the
+        earliest of their departures."""
+        walks_to_destination = self.walks_to(destination_stop_id)
+        ts = int(dp_ts.timestamp())
+        to_ts = int((dp_ts + timedelta(hours=STANDART_SEARCH_WINDOW_HOURS)).timestamp())
+        journeys: list[list[Connection]] = []
+        for _ in range(2 * N_ROUTES_TO_FIND):
+            found = index.query(
+                origin_stop_id,
+                destination_stop_id,
+                walks_to_destination,
+                ts,
+                MAX_TRANSFERS,
+            )
+            if not found:
+                break
+            journeys = remove_duplicate_journeys(journeys + found)
+            ts = min(departure(journey) for journey in found) + 1
+            if len(journeys) >= N_ROUTES_TO_FIND or ts >= to_ts:
+                break
+        return journeys
+
+    def do_departure_routing(
+        self,
+        origin: str | Location,
+        destination: str | Location,
+        dp_ts: datetime,
+        session: SessionType,
+        connection_filter: ConnectionFilter = ConnectionFilter(),
+    ) -> str:
+        # Reduced transfers are only computed for the unfiltered planned
+        # timetables and the transfers between stations
+        if (
+            connection_filter
+            or isinstance(origin, Location)
+            or isinstance(destination, Location)
+            or self.timetables.get(session, dp_ts.date()).planned is not None
+        ):
+            return super().do_departure_routing(
+                origin, destination, dp_ts, session, connection_filter
+            )
+        origin_stop_id = self.stop_index(origin)
+        destination_stop_id = self.stop_index(destination)
+        distance = self.stop_steffen.get_distances_to(
+            int(self.stop_steffen.station_ids[destination_stop_id])
+        )[origin_stop_id]
+        if distance < self.min_distance:
+            return super().do_departure_routing(
+                origin, destination, dp_ts, session, connection_filter
+            )
+
+        params = self.routing_params(origin, destination, dp_ts, session)
+        index = self.trip_based_index(params.timetable)
+        if index is None:
+            return super().do_departure_routing(
+                origin, destination, dp_ts, session, connection_filter
+            )
+        journeys = self.trip_based_journeys(
+            index, origin_stop_id, destination_stop_id, dp_ts
+        )
+        if len(journeys) == 0:
+            raise NoRouteFound('No route found')
+
+        with self.search_context(params) as context:
+            return self.add_alternatives(context, journeys)
+
+
+def build_index(timetable: Timetable, transfers: list[list[Transfer]]):
+    """Build and save the trip-based index of the timetable"""
+    index = TripBasedIndex.build(timetable, transfers)
+    index.save(trip_transfers_path(timetable.service_date))
+    logging.info(
+        f'{timetable.service_date}: {len(index.lines)} lines,'
+        f' {len(index.transfer_trip)} transfers'
+    )
+
+
+def main():
+    """Build the trip-based indices of the timetables of today and tomorrow.
+    Meant to run after the timetable snapshots were rewritten."""
+    engine, Session = sessionfactory()
+    router = RouterTripBased()
+    with Session() as session:
+        for days in range(2):
+            build_index(
+                router.timetables.get(session, date.today() + timedelta(days=days)),
+                router.transfers,
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,999 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Iterable
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from functools import cached_property
+
+import numpy as np
+import sqlalchemy
+import xxhash
+from sqlalchemy.orm import Session as SessionType
+
+from config import CACHE_PATH
+from database.engine import sessionfactory
+from gtfs.connections import Connections as DBConnections
+from gtfs.routes import Routes
+from gtfs.trips import Trips
+from helpers.logger import logging
+from router.constants import (
+    FIRST_TRIP_INDEX,
+    MAX_SEARCH_WINDOW_HOURS,
+    WALKING_TRIP_ID,
+)
+from router.datatypes import Connection, ConnectionFilter, Route, StopEventChange
+
+N_CACHED_TIMETABLES = 2
+N_CACHED_VIEWS = 8  # Filtered views per timetable
+# Filtered views that are built when a timetable is loaded
+COMMON_FILTERS = (ConnectionFilter(only_regional=True),)
+TRIP_ROUTES_CHUNK_SIZE = 10_000
+# Departure and arrival of cancelled connections, behind all other connections
+# so that no search window reaches them
+CANCELLED_TS = 2**62
+
+SNAPSHOT_DIR = CACHE_PATH + '/timetables'
+# Days before today whose snapshots are kept. Searches arriving shortly after
+# midnight still use the timetable of the day before.
+SNAPSHOT_RETENTION_DAYS = 1
+SNAPSHOT_MAGIC = b'CSATABLE'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_ALIGNMENT = 64
+SNAPSHOT_HEADER = np.dtype(
+    [
+        ('magic', 'S8'),
+        ('version', '<u4'),
+        ('n_columns', '<u4'),
+        ('n_connections', '<u8'),
+        ('service_date', '<i8'),  # proleptic gregorian ordinal
+        ('written_at', '<i8'),  # unix time in ns
+    ]
+)
+# Fixed-width columns in the order they are stored in a snapshot
+SNAPSHOT_COLUMNS = (
+    ('dp_ts', np.dtype('<i8')),
+    ('ar_ts', np.dtype('<i8')),
+    ('dp_stop_id', np.dtype('<i8')),
+    ('ar_stop_id', np.dtype('<i8')),
+    ('trip_id', np.dtype('<i8')),
+    ('is_regio', np.dtype('<i1')),
+    ('dist_traveled', np.dtype('<i4')),
+    ('dp_platform_id', np.dtype('<i8')),
+    ('ar_platform_id', np.dtype('<i8')),
+)
+
+
+def _align(offset: int) -> int:
+    return -(-offset // SNAPSHOT_ALIGNMENT) * SNAPSHOT_ALIGNMENT
+
+
+def snapshot_path(service_date: date, snapshot_dir: str = SNAPSHOT_DIR) -> str:
+    return f'{snapshot_dir}/{service_date.isoformat()}.csatt'
+
+
+def get_trip_routes(session: SessionType, trip_ids: np.ndarray) -> list[tuple]:
+    """(trip_id, route_id, agency_id, route_short_name, route_type) of the trips"""
+    rows = []
+    for start in range(0, len(trip_ids), TRIP_ROUTES_CHUNK_SIZE):
+        chunk = trip_ids[start : start + TRIP_ROUTES_CHUNK_SIZE].tolist()
+        stmt = (
+            sqlalchemy.select(
+                Trips.trip_id,
+                Routes.route_id,
+                Routes.agency_id,
+                Routes.route_short_name,
+                Routes.route_type,
+            )
+            .join(Routes, Routes.route_id == Trips.route_id)
+            .where(Trips.trip_id.in_(chunk))
+        )
+        rows.extend(session.execute(stmt).all())
+    return rows
+
+
+class Timetable:
+    """All connections of one service day as a struct of arrays, sorted by dp_ts.
+
+    A timetable covers every connection departing between midnight of the service
+    date and MAX_SEARCH_WINDOW_HOURS after the following midnight, so that any
+    search starting on that date can be extended to its maximal window without
+    loading another timetable.
+
+    The router does not work with the 64 bit stop and trip ids. build_index()
+    maps them to dense indices (dp_stop, ar_stop and trip), which are used to
+    index the label containers. Connections returned by indexing the timetable
+    carry these dense indices, to_external() maps them back to the ids.
+
+    with_changes() returns a RealtimeTimetable with real-time departures and
+    arrivals, which shares the connections of this one. Consumers therefore
+    read connections through columns(), take() and trip_rows() instead of the
+    arrays of the columns.
+    """
+
+    dp_stop: np.ndarray
+    ar_stop: np.ndarray
+    trip: np.ndarray
+    station_ids: np.ndarray
+    trip_ids: np.ndarray
+    trip_offsets: np.ndarray
+    trip_positions: np.ndarray
+    # Index into routes, route type value and index into agencies by dense trip
+    # index, -1 if unknown
+    routes: list[Route]
+    trip_route: np.ndarray
+    trip_route_type: np.ndarray
+    trip_agency: np.ndarray
+    agencies: np.ndarray
+
+    def __init__(
+        self,
+        service_date: date,
+        version: int,
+        dp_ts: np.ndarray,
+        ar_ts: np.ndarray,
+        dp_stop_id: np.ndarray,
+        ar_stop_id: np.ndarray,
+        trip_id: np.ndarray,
+        is_regio: np.ndarray,
+        dist_traveled: np.ndarray,
+        dp_platform_id: np.ndarray,
+        ar_platform_id: np.ndarray,
+    ):
+        self.service_date = service_date
+        # Changes whenever the connections of the service date are rewritten
+        self.version = version
+        self.dp_ts = dp_ts
+        self.ar_ts = ar_ts
+        self.dp_stop_id = dp_stop_id
+        self.ar_stop_id = ar_stop_id
+        self.trip_id = trip_id
+        self.is_regio = is_regio
+        self.dist_traveled = dist_traveled
+        self.dp_platform_id = dp_platform_id
+        self.ar_platform_id = ar_platform_id
+        self.views: OrderedDict[ConnectionFilter, Timetable] = OrderedDict()
+        self.views_lock = threading.Lock()
+        # Only set on timetables with real-time changes
+        self.planned: Timetable | None = None
+
+    @staticmethod
+    def time_range(service_date: date) -> tuple[datetime, datetime]:
+        from_ts = datetime.combine(service_date, datetime.min.time())
+        to_ts = from_ts + timedelta(days=1, hours=MAX_SEARCH_WINDOW_HOURS)
+        return from_ts, to_ts
+
+    @staticmethod
+    def from_rows(
+        service_date: date, rows: list[tuple], version: int = 0
+    ) -> 'Timetable':
+        if len(rows):
+            (
+                dp_ts,
+                ar_ts,
+                dp_stop_id,
+                ar_stop_id,
+                trip_id,
+                is_regio,
+                dist_traveled,
+                dp_platform_id,
+                ar_platform_id,
+            ) = zip(*rows)
+        else:
+            dp_ts = ar_ts = dp_stop_id = ar_stop_id = trip_id = ()
+            is_regio = dist_traveled = dp_platform_id = ar_platform_id = ()
+
+        return Timetable(
+            service_date=service_date,
+            version=version,
+            dp_ts=np.array(dp_ts, dtype=np.int64),
+            ar_ts=np.array(ar_ts, dtype=np.int64),
+            dp_stop_id=np.array(dp_stop_id, dtype=np.int64),
+            ar_stop_id=np.array(ar_stop_id, dtype=np.int64),
+            trip_id=np.array(trip_id, dtype=np.int64),
+            is_regio=np.array(is_regio, dtype=np.int8),
+            dist_traveled=np.array(dist_traveled, dtype=np.int32),
+            dp_platform_id=np.array(dp_platform_id, dtype=np.int64),
+            ar_platform_id=np.array(ar_platform_id, dtype=np.int64),
+        )
+
+    @staticmethod
+    def from_db(session: SessionType, service_date: date) -> 'Timetable':
+        from_ts, to_ts = Timetable.time_range(service_date)
+        rows = DBConnections.get_columns_for_routing(
+            session=session, from_ts=from_ts, to_ts=to_ts
+        )
+        timetable = Timetable.from_rows(service_date, rows)
+        timetable.version = timetable.content_version()
+        return timetable
+
+    @staticmethod
+    def from_snapshot(path: str) -> 'Timetable':
+        """Map a snapshot read-only into memory. All processes mapping the same
+        snapshot share one physical copy of the timetable."""
+        header = np.fromfile(path, dtype=SNAPSHOT_HEADER, count=1)
+        if (
+            len(header) != 1
+            or header['magic'][0] != SNAPSHOT_MAGIC
+            or header['version'][0] != SNAPSHOT_VERSION
+            or header['n_columns'][0] != len(SNAPSHOT_COLUMNS)
+        ):
+            raise ValueError(f'{path} is not a valid timetable snapshot')
+        n_connections = int(header['n_connections'][0])
+
+        columns = {}
+        offset = _align(SNAPSHOT_HEADER.itemsize)
+        for name, dtype in SNAPSHOT_COLUMNS:
+            if n_connections:
+                columns[name] = np.memmap(
+                    path, dtype=dtype, mode='r', offset=offset, shape=(n_connections,)
+                )
+            else:
+                columns[name] = np.empty(0, dtype=dtype)
+            offset = _align(offset + n_connections * dtype.itemsize)
+
+        return Timetable(
+            service_date=date.fromordinal(int(header['service_date'][0])),
+            version=int(header['written_at'][0]),
+            **columns,
+        )
+
+    def content_version(self) -> int:
+        """Version derived from the connections, so that every process loading
+        the same connections from the database agrees on it. Like all versions,
+        it fits into an int64."""
+        digest = xxhash.xxh3_64()
+        for name, dtype in SNAPSHOT_COLUMNS:
+            digest.update(
+                np.ascontiguousarray(getattr(self, name), dtype=dtype).tobytes()
+            )
+        return digest.intdigest() >> 1
+
+    def to_snapshot(self, path: str):
+        """Write the timetable as fixed-width columns behind a small header. The
+        file is replaced atomically, so readers that still have the old snapshot
+        mapped are not affected."""
+        header = np.zeros(1, dtype=SNAPSHOT_HEADER)
+        header['magic'] = SNAPSHOT_MAGIC
+        header['version'] = SNAPSHOT_VERSION
+        header['n_columns'] = len(SNAPSHOT_COLUMNS)
+        header['n_connections'] = len(self)
+        header['service_date'] = self.service_date.toordinal()
+        header['written_at'] = time.time_ns()
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(header.tobytes())
+            for name, dtype in SNAPSHOT_COLUMNS:
+                f.write(b'\x00' * (_align(f.tell()) - f.tell()))
+                f.write(
+                    np.ascontiguousarray(getattr(self, name), dtype=dtype).tobytes()
+                )
+        os.replace(tmp_path, path)
+
+    def build_index(self, station_ids: np.ndarray):
+        """Remap stop ids to dense station indices (positions in the sorted
+        station_ids) and trip ids to dense trip indices starting at
+        FIRST_TRIP_INDEX"""
+        self.station_ids = station_ids
+        self.dp_stop = np.searchsorted(station_ids, self.dp_stop_id).astype(np.int32)
+        self.ar_stop = np.searchsorted(station_ids, self.ar_stop_id).astype(np.int32)
+        if len(self) and (
+            self.dp_stop.max() >= len(station_ids)
+            or self.ar_stop.max() >= len(station_ids)
+            or np.any(station_ids[self.dp_stop] != self.dp_stop_id)
+            or np.any(station_ids[self.ar_stop] != self.ar_stop_id)
+        ):
+            raise ValueError('Timetable contains stops that are not stations')
+
+        self.trip_ids, trip = np.unique(self.trip_id, return_inverse=True)
+        self.trip = (trip + FIRST_TRIP_INDEX).astype(np.int32)
+        self.build_trip_index()
+
+    def build_trip_index(self):
+        """Index of the connections of each trip in CSR layout: the positions of
+        the connections of dense trip index t in the timetable are
+        trip_positions[trip_offsets[t]:trip_offsets[t + 1]], in timetable order."""
+        self.trip_positions = np.argsort(self.trip, kind='stable').astype(np.int32)
+        self.trip_offsets = np.zeros(self.n_trips + 1, dtype=np.int64)
+        np.cumsum(
+            np.bincount(self.trip, minlength=self.n_trips),
+            out=self.trip_offsets[1:],
+        )
+
+    def set_trip_routes(self, rows: list[tuple]):
+        """Routes of the dense trip indices from (trip_id, route_id, agency_id,
+        route_short_name, route_type) rows"""
+        self.routes = []
+        self.trip_route = np.full(self.n_trips, -1, dtype=np.int32)
+        self.trip_route_type = np.full(self.n_trips, -1, dtype=np.int16)
+        self.trip_agency = np.full(self.n_trips, -1, dtype=np.int32)
+        if not rows:
+            self.agencies = np.empty(0, dtype=object)
+            return
+        route_indices: dict[int, int] = {}
+        trip_route = np.empty(len(rows), dtype=np.int32)
+        for i, (_, route_id, agency_id, route_short_name, route_type) in enumerate(
+            rows
+        ):
+            route = route_indices.get(route_id)
+            if route is None:
+                route = route_indices[route_id] = len(self.routes)
+                self.routes.append(
+                    Route.create(route_id, agency_id, route_short_name, route_type)
+                )
+            trip_route[i] = route
+        trip = np.searchsorted(self.trip_ids, [row[0] for row in rows])
+        self.trip_route[trip + FIRST_TRIP_INDEX] = trip_route
+
+        route_types = np.array(
+            [route.route_type.value for route in self.routes], dtype=np.int16
+        )
+        self.agencies, route_agency = np.unique(
+            np.array([route.agency_id or '' for route in self.routes], dtype=object),
+            return_inverse=True,
+        )
+        known = self.trip_route >= 0
+        self.trip_route_type[known] = route_types[self.trip_route[known]]
+        self.trip_agency[known] = route_agency[self.trip_route[known]]
+
+    def get_routes(self, trip_ids: Iterable[int]) -> dict[int, Route]:
+        """Routes of the trips with the trip_ids. Trips without a route, like
+        walking, are left out."""
+        trip_ids = np.fromiter(trip_ids, dtype=np.int64)
+        if not len(self.trip_ids):
+            return {}
+        trip = np.minimum(
+            np.searchsorted(self.trip_ids, trip_ids), len(self.trip_ids) - 1
+        )
+        found = self.trip_ids[trip] == trip_ids
+        trip_route = self.trip_route[trip[found] + FIRST_TRIP_INDEX]
+        return {
+            trip_id: self.routes[route]
+            for trip_id, route in zip(trip_ids[found].tolist(), trip_route.tolist())
+            if route >= 0
+        }
+
+    @cached_property
+    def trip_events(self) -> tuple[np.ndarray, np.ndarray]:
+        """Keys of the departures and of the arrivals of the connections in the
+        order of trip_positions. A key combines the dense trip index and the time
+        of the event, so the keys are sorted."""
+        trip = self.trip[self.trip_positions].astype(np.int64) << 32
+        first_ts = int(self.dp_ts[0]) if len(self) else 0
+        return (
+            trip + (self.dp_ts[self.trip_positions] - first_ts),
+            trip + (self.ar_ts[self.trip_positions] - first_ts),
+        )
+
+    def event_positions(
+        self, trip_ids: np.ndarray, stop_ids: np.ndarray, ts: np.ndarray, arrival: bool
+    ) -> np.ndarray:
+        """Positions of the connections of the trips departing from the stops at
+        ts, or arriving at the stops at ts if arrival. -1 where there is none."""
+        positions = np.full(len(trip_ids), -1, dtype=np.int64)
+        if len(self) == 0 or len(trip_ids) == 0:
+            return positions
+        trip = np.searchsorted(self.trip_ids, trip_ids)
+        known = trip < len(self.trip_ids)
+        known[known] = self.trip_ids[trip[known]] == trip_ids[known]
+
+        departures, arrivals = self.trip_events
+        events = arrivals if arrival else departures
+        keys = ((trip + FIRST_TRIP_INDEX) << 32) + (ts - int(self.dp_ts[0]))
+        i = np.minimum(np.searchsorted(events, keys), len(events) - 1)
+        candidates = self.trip_positions[i]
+        event_stop_id = self.ar_stop_id if arrival else self.dp_stop_id
+        found = known & (events[i] == keys) & (event_stop_id[candidates] == stop_ids)
+        positions[found] = candidates[found]
+        return positions
+
+    def with_changes(self, changes: list[StopEventChange]) -> 'Timetable':
+        """Timetable with the real-time times of the changes applied, this one
+        if none of them matches a connection"""
+        timetable = RealtimeTimetable.apply(
+            self,
+            np.empty(0, dtype=np.int64),
+            np.empty(0, dtype=np.int64),
+            np.empty(0, dtype=np.int64),
+            changes,
+        )
+        return self if timetable is None else timetable
+
+    def mask(self, connection_filter: ConnectionFilter) -> np.ndarray:
+        """Which connections the filter allows"""
+        mask = np.ones(len(self), dtype=bool)
+        if connection_filter.only_regional:
+            mask &= self.is_regio.astype(bool)
+        excluded_trips = np.zeros(self.n_trips, dtype=bool)
+        if connection_filter.excluded_route_types:
+            excluded_trips |= np.isin(
+                self.trip_route_type,
+                [
+                    route_type.value
+                    for route_type in connection_filter.excluded_route_types
+                ],
+            )
+        if connection_filter.excluded_agencies:
+            excluded_agencies = np.isin(
+                self.agencies, list(connection_filter.excluded_agencies)
+            )
+            known = self.trip_agency >= 0
+            excluded_trips[known] |= excluded_agencies[self.trip_agency[known]]
+        mask &= ~excluded_trips[self.trip]
+        return mask
+
+    def filtered(self, connection_filter: ConnectionFilter) -> 'Timetable':
+        """View of the timetable with only the connections the filter allows.
+        Views keep the dense indices of this timetable and are cached, so that
+        filtered searches scan fewer connections."""
+        if not connection_filter:
+            return self
+        with self.views_lock:
+            if connection_filter in self.views:
+                self.views.move_to_end(connection_filter)
+                return self.views[connection_filter]
+
+            mask = self.mask(connection_filter)
+            view = Timetable(
+                service_date=self.service_date,
+                version=self.version,
+                **{name: getattr(self, name)[mask] for name, _ in SNAPSHOT_COLUMNS},
+            )
+            view.station_ids = self.station_ids
+            view.dp_stop = self.dp_stop[mask]
+            view.ar_stop = self.ar_stop[mask]
+            view.trip_ids = self.trip_ids
+            view.trip = self.trip[mask]
+            view.routes = self.routes
+            view.trip_route = self.trip_route
+            view.trip_route_type = self.trip_route_type
+            view.trip_agency = self.trip_agency
+            view.agencies = self.agencies
+            view.parent_positions = np.flatnonzero(mask)
+            view.build_trip_index()
+
+            self.views[connection_filter] = view
+            while len(self.views) > N_CACHED_VIEWS:
+                self.views.popitem(last=False)
+            return view
+
+    def trip_connection_index(self, trip: int, from_ts: int) -> int | None:
+        """Index of the first connection of the trip departing at or after
+        from_ts, None if there is none"""
+        positions = self.trip_rows(trip)
+        i = int(np.searchsorted(positions, self.index_of(from_ts), side='left'))
+        if i < len(positions):
+            return int(positions[i])
+
+    def external_trip_id(self, trip: int) -> int:
+        """Trip id of a dense trip index. Pseudo trips like walking keep their id."""
+        if trip < FIRST_TRIP_INDEX:
+            return trip
+        return int(self.trip_ids[trip - FIRST_TRIP_INDEX])
+
+    def trip_index(self, trip_id: int) -> int:
+        """Dense trip index of a trip id, the inverse of external_trip_id"""
+        i = int(np.searchsorted(self.trip_ids, trip_id))
+        if i < len(self.trip_ids) and self.trip_ids[i] == trip_id:
+            return i + FIRST_TRIP_INDEX
+        if 0 <= trip_id < FIRST_TRIP_INDEX:
+            return trip_id
+        raise KeyError(f'Trip {trip_id} is not in the timetable')
+
+    @property
+    def n_trips(self) -> int:
+        """Size of containers indexed by dense trip index"""
+        return len(self.trip_ids) + FIRST_TRIP_INDEX
+
+    def to_external(self, connection: Connection) -> Connection:
+        """Map the dense indices of a connection back to stop and trip ids"""
+        dp_stop_id = int(self.station_ids[connection.dp_stop_id])
+        ar_stop_id = int(self.station_ids[connection.ar_stop_id])
+        trip_id = self.external_trip_id(connection.trip_id)
+        if connection.trip_id == WALKING_TRIP_ID:
+            dp_platform_id = dp_stop_id
+            ar_platform_id = ar_stop_id
+        else:
+            dp_platform_id = connection.dp_platform_id
+            ar_platform_id = connection.ar_platform_id
+        return connection._replace(
+            dp_stop_id=dp_stop_id,
+            ar_stop_id=ar_stop_id,
+            trip_id=trip_id,
+            dp_platform_id=dp_platform_id,
+            ar_platform_id=ar_platform_id,
+        )
+
+    def trip_rows(self, trip: int) -> np.ndarray:
+        """Positions of the connections of the trip, in timetable order"""
+        return self.trip_positions[
+            self.trip_offsets[trip] : self.trip_offsets[trip + 1]
+        ]
+
+    def columns(self, start: int, end: int, *names: str) -> list[np.ndarray]:
+        """The columns with the names of the connections at positions
+        [start, end)"""
+        return [getattr(self, name)[start:end] for name in names]
+
+    def take(self, positions: np.ndarray, *names: str) -> list[np.ndarray]:
+        """The columns with the names of the connections at the positions"""
+        return [getattr(self, name)[positions] for name in names]
+
+    def __len__(self) -> int:
+        return len(self.dp_ts)
+
+    def __getitem__(self, index: int) -> Connection:
+        return Connection(
+            dp_ts=int(self.dp_ts[index]),
+            ar_ts=int(self.ar_ts[index]),
+            dp_stop_id=int(self.dp_stop[index]),
+            ar_stop_id=int(self.ar_stop[index]),
+            trip_id=int(self.trip[index]),
+            is_regio=int(self.is_regio[index]),
+            dist_traveled=int(self.dist_traveled[index]),
+            dp_platform_id=int(self.dp_platform_id[index]),
+            ar_platform_id=int(self.ar_platform_id[index]),
+        )
+
+    @cached_property
+    def arrival_order(self) -> np.ndarray:
+        """Positions of the connections ordered by ar_ts"""
+        return np.argsort(self.ar_ts, kind='stable')
+
+    @cached_property
+    def sorted_ar_ts(self) -> np.ndarray:
+        return self.ar_ts[self.arrival_order]
+
+    def arrival_positions(self, from_ts: int, to_ts: int) -> np.ndarray:
+        """Positions of the connections arriving in [from_ts, to_ts), ordered
+        by ar_ts"""
+        start, end = np.searchsorted(self.sorted_ar_ts, [from_ts, to_ts], side='left')
+        return self.arrival_order[start:end]
+
+    def index_of(self, ts: int) -> int:
+        """Index of the first connection departing at or after ts"""
+        return int(np.searchsorted(self.dp_ts, ts, side='left'))
+
+    def window(self, from_ts: int, to_ts: int) -> tuple[int, int]:
+        """Index range of the connections departing in [from_ts, to_ts)"""
+        return self.index_of(from_ts), self.index_of(to_ts)
+
+
+class RealtimeTimetable(Timetable):
+    """Timetable with real-time changes. The connections of the trips with
+    changes are taken out of the planned timetable and kept in an overlay with
+    their real-time times, sorted by dp_ts as well. The planned timetable is
+    not copied, so it stays shared with the other versions and processes, and
+    applying changes only touches the connections of the changed trips.
+
+    Positions are positions in the merge of the remaining planned connections
+    and the overlay by dp_ts. Overlay connections come after planned ones
+    departing at the same time. Cancelled connections depart and arrive at
+    CANCELLED_TS, behind all others.
+    """
+
+    def __init__(
+        self,
+        planned: Timetable,
+        removed: np.ndarray,
+        overlay: Timetable,
+        version: int,
+    ):
+        self.service_date = planned.service_date
+        self.version = version
+        self.views: OrderedDict[ConnectionFilter, Timetable] = OrderedDict()
+        self.views_lock = threading.Lock()
+        self.planned = planned
+        # Positions of the connections of the changed trips in planned, sorted
+        self.removed = removed
+        self.overlay = overlay
+        # Real-time times of the events of the removed connections, only kept
+        # on unfiltered timetables to apply further changes to
+        self.event_dp_ts: np.ndarray | None = None
+        self.event_ar_ts: np.ndarray | None = None
+        self.station_ids = planned.station_ids
+        self.trip_ids = planned.trip_ids
+        self.routes = planned.routes
+        self.trip_route = planned.trip_route
+        self.trip_route_type = planned.trip_route_type
+        self.trip_agency = planned.trip_agency
+        self.agencies = planned.agencies
+
+        # Number of remaining planned connections before each removed one
+        self.removed_offsets = removed - np.arange(len(removed))
+        inserted = np.searchsorted(planned.dp_ts, overlay.dp_ts, side='right')
+        self.overlay_positions = (
+            inserted - np.searchsorted(removed, inserted) + np.arange(len(overlay))
+        )
+
+    @staticmethod
+    def apply(
+        planned: Timetable,
+        removed: np.ndarray,
+        event_dp_ts: np.ndarray,
+        event_ar_ts: np.ndarray,
+        changes: list[StopEventChange],
+    ) -> 'RealtimeTimetable | None':
+        """Apply the changes to planned, whose connections at the removed
+        positions already have the real-time times of their events. None if
+        none of the changes matches a connection."""
+        changed = []
+        for arrival in (False, True):
+            events = [
+                (
+                    change.trip_id,
+                    change.stop_id,
+                    change.planned_ar_ts if arrival else change.planned_dp_ts,
+                    change.ar_ts if arrival else change.dp_ts,
+                )
+                for change in changes
+                if (change.ar_ts if arrival else change.dp_ts) is not None
+            ]
+            if not events:
+                continue
+            trip_ids, stop_ids, planned_ts, ts = (
+                np.array(column, dtype=np.int64) for column in zip(*events)
+            )
+            positions = planned.event_positions(
+                trip_ids, stop_ids, planned_ts, arrival=arrival
+            )
+            found = positions >= 0
+            changed.append((arrival, positions[found], ts[found]))
+        if not any(len(positions) for _, positions, _ in changed):
+            return None
+
+        # All connections of the trips that were not changed before join the
+        # overlay with their planned times
+        trips = np.unique(
+            planned.trip[np.concatenate([positions for _, positions, _ in changed])]
+        )
+        starts = planned.trip_offsets[trips]
+        lengths = planned.trip_offsets[trips + 1] - starts
+        added = planned.trip_positions[
+            np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+            + np.arange(lengths.sum())
+        ].astype(np.int64)
+        added = added[~np.isin(added, removed, assume_unique=True)]
+        removed = np.concatenate([removed, added])
+        order = np.argsort(removed, kind='stable')
+        removed = removed[order]
+        event_dp_ts = np.concatenate([event_dp_ts, planned.dp_ts[added]])[order]
+        event_ar_ts = np.concatenate([event_ar_ts, planned.ar_ts[added]])[order]
+        for arrival, positions, ts in changed:
+            event_ts = event_ar_ts if arrival else event_dp_ts
+            event_ts[np.searchsorted(removed, positions)] = ts
+
+        # A connection is cancelled if either of its events is
+        cancelled = (event_dp_ts == CANCELLED_TS) | (event_ar_ts == CANCELLED_TS)
+        dp_ts = np.where(cancelled, CANCELLED_TS, event_dp_ts)
+        ar_ts = np.where(cancelled, CANCELLED_TS, np.maximum(event_ar_ts, event_dp_ts))
+        # Connections of a trip departing at the same time keep their order
+        order = np.lexsort((removed, dp_ts))
+        positions = removed[order]
+        columns = {
+            name: getattr(planned, name)[positions] for name, _ in SNAPSHOT_COLUMNS
+        }
+        columns['dp_ts'] = dp_ts[order]
+        columns['ar_ts'] = ar_ts[order]
+        overlay = Timetable(
+            service_date=planned.service_date, version=planned.version, **columns
+        )
+        overlay.station_ids = planned.station_ids
+        overlay.dp_stop = planned.dp_stop[positions]
+        overlay.ar_stop = planned.ar_stop[positions]
+        overlay.trip_ids = planned.trip_ids
+        overlay.trip = planned.trip[positions]
+        overlay.routes = planned.routes
+        overlay.trip_route = planned.trip_route
+        overlay.trip_route_type = planned.trip_route_type
+        overlay.trip_agency = planned.trip_agency
+        overlay.agencies = planned.agencies
+        overlay.build_trip_index()
+
+        timetable = RealtimeTimetable(planned, removed, overlay, time.time_ns())
+        timetable.event_dp_ts = event_dp_ts
+        timetable.event_ar_ts = event_ar_ts
+        return timetable
+
+    def with_changes(self, changes: list[StopEventChange]) -> Timetable:
+        timetable = RealtimeTimetable.apply(
+            self.planned, self.removed, self.event_dp_ts, self.event_ar_ts, changes
+        )
+        return self if timetable is None else timetable
+
+    def filtered(self, connection_filter: ConnectionFilter) -> Timetable:
+        if not connection_filter:
+            return self
+        with self.views_lock:
+            if connection_filter in self.views:
+                self.views.move_to_end(connection_filter)
+                return self.views[connection_filter]
+
+            planned = self.planned.filtered(connection_filter)
+            # Positions of the removed connections the filter allows in planned
+            removed = np.searchsorted(planned.parent_positions, self.removed)
+            kept = removed < len(planned)
+            kept[kept] = planned.parent_positions[removed[kept]] == self.removed[kept]
+            view = RealtimeTimetable(
+                planned,
+                removed[kept],
+                self.overlay.filtered(connection_filter),
+                self.version,
+            )
+
+            self.views[connection_filter] = view
+            while len(self.views) > N_CACHED_VIEWS:
+                self.views.popitem(last=False)
+            return view
+
+    def split(self, positions: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Position in planned and index in the overlay at which the connections
+        from the positions onwards start"""
+        overlay = np.searchsorted(self.overlay_positions, positions, side='left')
+        remaining = positions - overlay
+        planned = remaining + np.searchsorted(
+            self.removed_offsets, remaining, side='right'
+        )
+        return planned, overlay
+
+    def from_planned(self, planned: np.ndarray) -> np.ndarray:
+        """Positions of remaining connections given by their position in planned"""
+        return (
+            planned
+            - np.searchsorted(self.removed, planned)
+            + np.searchsorted(
+                self.overlay.dp_ts, self.planned.dp_ts[planned], side='left'
+            )
+        )
+
+    def columns(self, start: int, end: int, *names: str) -> list[np.ndarray]:
+        (planned_start, overlay_start), (planned_end, overlay_end) = (
+            self.split(start),
+            self.split(end),
+        )
+        removed = (
+            self.removed[
+                np.searchsorted(self.removed, planned_start) : np.searchsorted(
+                    self.removed, planned_end
+                )
+            ]
+            - planned_start
+        )
+        inserted = self.overlay_positions[overlay_start:overlay_end] - start
+        if not len(removed) and not len(inserted):
+            return self.planned.columns(planned_start, planned_end, *names)
+        from_planned = np.ones(end - start, dtype=bool)
+        from_planned[inserted] = False
+        result = []
+        for name in names:
+            planned_column = getattr(self.planned, name)
+            column = np.empty(end - start, dtype=planned_column.dtype)
+            column[inserted] = getattr(self.overlay, name)[overlay_start:overlay_end]
+            column[from_planned] = np.delete(
+                planned_column[planned_start:planned_end], removed
+            )
+            result.append(column)
+        return result
+
+    def take(self, positions: np.ndarray, *names: str) -> list[np.ndarray]:
+        positions = np.asarray(positions, dtype=np.int64)
+        planned, overlay = self.split(positions)
+        in_overlay = overlay < len(self.overlay)
+        in_overlay[in_overlay] = (
+            self.overlay_positions[overlay[in_overlay]] == positions[in_overlay]
+        )
+        planned = planned[~in_overlay]
+        overlay = overlay[in_overlay]
+        result = []
+        for name in names:
+            planned_column = getattr(self.planned, name)
+            column = np.empty(len(positions), dtype=planned_column.dtype)
+            column[~in_overlay] = planned_column[planned]
+            column[in_overlay] = getattr(self.overlay, name)[overlay]
+            result.append(column)
+        return result
+
+    def trip_rows(self, trip: int) -> np.ndarray:
+        # The connections of a trip are either all planned or all in the overlay
+        overlay = self.overlay.trip_rows(trip)
+        if len(overlay):
+            return self.overlay_positions[overlay]
+        return self.from_planned(self.planned.trip_rows(trip))
+
+    def __len__(self) -> int:
+        return len(self.planned) - len(self.removed) + len(self.overlay)
+
+    def __getitem__(self, index: int) -> Connection:
+        planned, overlay = self.split(index)
+        if overlay < len(self.overlay) and self.overlay_positions[overlay] == index:
+            return self.overlay[int(overlay)]
+        return self.planned[int(planned)]
+
+    def arrival_positions(self, from_ts: int, to_ts: int) -> np.ndarray:
+        planned = self.planned.arrival_positions(from_ts, to_ts)
+        planned = planned[~np.isin(planned, self.removed)]
+        overlay = self.overlay.arrival_positions(from_ts, to_ts)
+        positions = np.concatenate(
+            [self.from_planned(planned), self.overlay_positions[overlay]]
+        )
+        ar_ts = np.concatenate(
+            [self.planned.ar_ts[planned], self.overlay.ar_ts[overlay]]
+        )
+        return positions[np.lexsort((positions, ar_ts))]
+
+    def index_of(self, ts: int) -> int:
+        planned = int(np.searchsorted(self.planned.dp_ts, ts, side='left'))
+        return (
+            planned
+            - int(np.searchsorted(self.removed, planned))
+            + int(np.searchsorted(self.overlay.dp_ts, ts, side='left'))
+        )
+
+
+def snapshot_mtime(path: str) -> int | None:
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+class TimetableStore:
+    """Keeps the indexed timetables of the most recently used service dates
+    in memory. A timetable is reloaded once its snapshot has been rewritten.
+    Real-time changes are applied to the loaded timetables and again to each
+    timetable that is loaded later."""
+
+    def __init__(
+        self,
+        station_ids: np.ndarray,
+        max_size: int = N_CACHED_TIMETABLES,
+        snapshot_dir: str = SNAPSHOT_DIR,
+    ):
+        self.station_ids = station_ids
+        self.max_size = max_size
+        self.snapshot_dir = snapshot_dir
+        self.timetables: OrderedDict[date, Timetable] = OrderedDict()
+        # Modification time of the snapshot of each timetable when it was loaded
+        self.snapshot_mtimes: dict[date, int | None] = {}
+        # Timetables being loaded, so that concurrent searches load each once
+        self.loading: dict[date, Future] = {}
+        # Latest change of each stop event, by trip, stop and planned times
+        self.changes: dict[tuple, StopEventChange] = {}
+        self.lock = threading.Lock()
+        self.prefetch_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='timetable-prefetch'
+        )
+        self.Session = None
+
+    def get(self, session: SessionType, service_date: date) -> Timetable:
+        path = snapshot_path(service_date, self.snapshot_dir)
+        mtime = snapshot_mtime(path)
+        with self.lock:
+            if (
+                service_date in self.timetables
+                and self.snapshot_mtimes[service_date] == mtime
+            ):
+                self.timetables.move_to_end(service_date)
+                return self.timetables[service_date]
+            future = self.loading.get(service_date)
+            is_loading = future is not None
+            if not is_loading:
+                future = self.loading[service_date] = Future()
+        if is_loading:
+            return future.result()
+
+        try:
+            timetable = self.load(session, service_date, path, mtime)
+        except Exception as e:
+            with self.lock:
+                del self.loading[service_date]
+            future.set_exception(e)
+            raise
+
+        with self.lock:
+            del self.loading[service_date]
+            self.timetables[service_date] = timetable
+            self.timetables.move_to_end(service_date)
+            self.snapshot_mtimes[service_date] = mtime
+            while len(self.timetables) > self.max_size:
+                evicted, _ = self.timetables.popitem(last=False)
+                del self.snapshot_mtimes[evicted]
+        future.set_result(timetable)
+        return timetable
+
+    def load(
+        self, session: SessionType, service_date: date, path: str, mtime: int | None
+    ) -> Timetable:
+        if mtime is not None:
+            timetable = Timetable.from_snapshot(path)
+        else:
+            timetable = Timetable.from_db(session, service_date)
+        timetable.build_index(self.station_ids)
+        timetable.set_trip_routes(get_trip_routes(session, timetable.trip_ids))
+        with self.lock:
+            changes = list(self.changes.values())
+        if changes:
+            timetable = timetable.with_changes(changes)
+        for connection_filter in COMMON_FILTERS:
+            timetable.filtered(connection_filter)
+        return timetable
+
+    def apply_changes(self, changes: list[StopEventChange]):
+        """Replace the loaded timetables by versions with the changes applied.
+        Searches that already run keep the timetable they started with."""
+        with self.lock:
+            for change in changes:
+                self.changes[change[:4]] = change
+            # Changes of events before all loaded timetables are no longer needed
+            if self.timetables:
+                from_ts = min(
+                    Timetable.time_range(service_date)[0].timestamp()
+                    for service_date in self.timetables
+                )
+                self.changes = {
+                    key: change
+                    for key, change in self.changes.items()
+                    if max(change.planned_ar_ts or 0, change.planned_dp_ts or 0)
+                    >= from_ts
+                }
+            timetables = list(self.timetables.items())
+
+        for service_date, timetable in timetables:
+            updated = timetable.with_changes(changes)
+            if updated is timetable:
+                continue
+            for connection_filter in COMMON_FILTERS:
+                updated.filtered(connection_filter)
+            with self.lock:
+                # Timetables reloaded in the meantime already have the changes
+                if self.timetables.get(service_date) is timetable:
+                    self.timetables[service_date] = updated
+
+    def prefetch(self, service_date: date):
+        """Load the timetable of service_date in the background, so that the
+        first search on that date does not wait for it"""
+        with self.lock:
+            if service_date in self.timetables or service_date in self.loading:
+                return
+        self.prefetch_executor.submit(self._prefetch, service_date)
+
+    def _prefetch(self, service_date: date):
+        if self.Session is None:
+            _, self.Session = sessionfactory()
+        try:
+            with self.Session() as session:
+                self.get(session, service_date)
+        except Exception:
+            logging.exception(f'Prefetching the timetable of {service_date} failed')
+
+
+def affected_timetable_dates(service_date: date) -> list[date]:
+    """Service dates whose timetable contains connections of trips of service_date.
+    Trips may run past midnight and each timetable reaches into the following day."""
+    return [service_date + timedelta(days=days) for days in (-1, 0, 1)]
+
+
+def write_snapshots(session: SessionType, service_dates: Iterable[date]):
+    for service_date in service_dates:
+        Timetable.from_db(session, service_date).to_snapshot(
+            snapshot_path(service_date)
+        )
+
+
+def prune_snapshots(first_date: date, snapshot_dir: str = SNAPSHOT_DIR):
+    """Delete the snapshots of the service dates before first_date"""
+    if not os.path.isdir(snapshot_dir):
+        return
+    for name in os.listdir(snapshot_dir):
+        stem, extension = os.path.splitext(name)
+        if extension != '.csatt':
+            continue
+        try:
+            service_date = date.fromisoformat(stem)
+        except ValueError:
+            continue
+        if service_date < first_date:
+            os.remove(os.path.join(snapshot_dir, name))
@@ -28,7 +28,9 @@ predictor = Predictor(n_models=15)
 logging.info('Done!')
 
 logging.info('Initialising router')
-router = RouterCSA()
+# Searches run on timetables with real-time changes, which the alternative
+# workers do not have, so alternatives are searched in the serving process
+router = RouterCSA(realtime=True)
 logging.info('Done!')
 
 
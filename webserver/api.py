@@ -4,6 +4,8 @@ from flask import Blueprint, abort, current_app, jsonify, make_response, request
 from flask.helpers import send_file
 
 from data_analysis import data_stats
+from gtfs.routes import RouteType
+from router.datatypes import ConnectionFilter, Location
 from router.exceptions import NoRouteFound, NoTimetableFound
 from webserver import per_station_time, router, streckennetz
 from webserver.connection import get_and_rate_journeys
@@ -23,6 +25,11 @@ bp.register_error_handler(CUSTOM_500_ERROR, custom_json_error)
 bp_limited.register_error_handler(CUSTOM_500_ERROR, custom_json_error)
 
 
+def bad_request(message: str):
+    """Abort with HTTP 400 and the message as JSON error"""
+    abort(make_response(jsonify({'error': message}), 400))
+
+
 @bp.route('/station_list.json', methods=['GET'])
 @log_activity
 def get_station_list():
@@ -115,17 +122,75 @@ def trip():
     return resp
 
 
+def parse_place(place: str | dict) -> str | Location:
+    """Station name, or location given as {"lat": ..., "lon": ...}"""
+    if isinstance(place, dict):
+        return Location(lat=float(place['lat']), lon=float(place['lon']))
+    return place
+
+
+def parse_connection_filter(data: dict) -> ConnectionFilter:
+    """Filter from `only_regional`, `excluded_route_types` (names like "BUS")
+    and `excluded_agencies` (agency ids)"""
+    try:
+        excluded_route_types = frozenset(
+            RouteType[route_type] for route_type in data.get('excluded_route_types', [])
+        )
+    except KeyError as e:
+        bad_request(f'Unknown route type: {e.args[0]}')
+    return ConnectionFilter(
+        only_regional=data.get('only_regional', False),
+        excluded_route_types=excluded_route_types,
+        excluded_agencies=frozenset(data.get('excluded_agencies', [])),
+    )
+
+
 @bp_limited.route('/journeys', methods=['POST'])
 @log_activity
 def journeys():
-    origin = request.json['origin']
-    destination = request.json['destination']
+    origin = parse_place(request.json['origin'])
+    destination = parse_place(request.json['destination'])
     departure = datetime.fromisoformat(request.json['departure'])
+    # If true, departure is the latest arrival at the destination
+    search_for_arrival = request.json.get('search_for_arrival', False)
+    if search_for_arrival and (
+        isinstance(origin, Location) or isinstance(destination, Location)
+    ):
+        bad_request('Searches for arrival only support station names')
+    # If true, the journeys are paged from a profile over a departure window,
+    # so asking for earlier or later journeys reuses the same search
+    departure_window = request.json.get('departure_window', False)
+    if departure_window and (
+        search_for_arrival
+        or isinstance(origin, Location)
+        or isinstance(destination, Location)
+    ):
+        bad_request('Departure windows only support departures between stations')
+    connection_filter = parse_connection_filter(request.json)
 
-    current_app.logger.info(f'Routing from {origin} to {destination} at {departure}')
+    current_app.logger.info(
+        f'Routing from {origin} to {destination} '
+        f'{"arriving" if search_for_arrival else "departing"} at {departure}'
+    )
 
     try:
-        journeys = router.do_routing(origin, destination, departure, db.session)
+        if departure_window:
+            journeys = router.do_profile_routing(
+                origin,
+                destination,
+                departure,
+                db.session,
+                connection_filter=connection_filter,
+            )
+        else:
+            journeys = router.do_routing(
+                origin,
+                destination,
+                departure,
+                db.session,
+                search_for_arrival=search_for_arrival,
+                connection_filter=connection_filter,
+            )
     except NoTimetableFound as e:
         current_app.logger.error(f'No timetable found: {e}')
         abort(CUSTOM_500_ERROR, str(e))
@@ -133,7 +198,8 @@ def journeys():
         current_app.logger.error(f'No route found: {e}')
         abort(CUSTOM_500_ERROR, str(e))
 
-    resp = jsonify(journeys)
+    # The router writes the FPTF JSON itself
+    resp = current_app.response_class(journeys, mimetype='application/json')
     # resp.headers.add("Access-Control-Allow-Origin", "*")
     return resp
 